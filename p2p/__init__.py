@@ -2,14 +2,19 @@
 Python wrapper for the Content Services API
 
 '''
-import requests
 import json
 import os
 import math
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from copy import deepcopy
 
-from cache import NoCache
+from cache import NoCache, DiskCache
+from metrics import Metrics
+from scope import RequestScope
+import resilience
 import utils
 import time
 
@@ -17,6 +22,8 @@ import time
 import logging
 log = logging.getLogger('p2p')
 
+COLLECTION_LAYOUT_QUERY = utils.FrozenQuery({'include': 'items'})
+
 
 def get_connection():
     """
@@ -31,6 +38,7 @@ def get_connection():
         # Optional
         export P2P_API_DEBUG=plz  # display an http log
         export P2P_IMAGE_SERVICES_URL=url_of_image_services_endpoint
+        export P2P_CACHE_PATH=~/.p2p/cache.db  # cache on disk
 
     Or those same settings from your Django settings::
 
@@ -40,6 +48,7 @@ def get_connection():
 
         # Optional
         P2P_IMAGE_SERVICES_URL = url_of_image_services_endpoint
+        P2P_CACHE_PATH = '/var/cache/p2p/cache.db'  # cache on disk
 
     If you need to pass in your config, just create a new p2p object.
     """
@@ -52,7 +61,8 @@ def get_connection():
             auth_token=settings.P2P_API_KEY,
             debug=settings.DEBUG,
             image_services_url=getattr(
-                settings, 'P2P_IMAGE_SERVICES_URL', None)
+                settings, 'P2P_IMAGE_SERVICES_URL', None),
+            cache=_disk_cache(getattr(settings, 'P2P_CACHE_PATH', None))
         )
     except ImportError, e:
         import os
@@ -62,13 +72,20 @@ def get_connection():
                 url=os.environ['P2P_API_URL'],
                 auth_token=os.environ['P2P_API_KEY'],
                 debug=os.environ.get('P2P_API_DEBUG', False),
-                image_services_url=os.environ.get('P2P_IMAGE_SERVICES_URL', None)
+                image_services_url=os.environ.get('P2P_IMAGE_SERVICES_URL', None),
+                cache=_disk_cache(os.environ.get('P2P_CACHE_PATH', None))
             )
 
     raise P2PException("No connection settings available. Please put settings "
                        "in your environment variables or your Django config")
 
 
+def _disk_cache(path):
+    if path:
+        return DiskCache(path)
+    return None
+
+
 # API calls
 class P2P(object):
     """
@@ -91,25 +108,110 @@ class P2P(object):
 
         p2p = P2P(my_p2p_url, my_auth_token, debug=True
                   cache=DjangoCache())
+
+    Failed API calls are retried with exponential backoff, and an endpoint
+    that keeps failing has its circuit opened for a while. See
+    `p2p.resilience`. To serve the last good response while a circuit is
+    open, give it up to `max_stale_bytes` of memory to keep them in::
+
+        p2p = P2P(my_p2p_url, my_auth_token,
+                  retry_policy=RetryPolicy(max_retries=5),
+                  circuit_breakers=CircuitBreakerRegistry(reset_timeout=60),
+                  max_stale_bytes=16 * 1024 * 1024)
+
+    Retries, open circuits and stale responses are counted in
+    `p2p.metrics`.
+
+    One P2P object can be shared by all the threads of a process. The
+    session, cache, metrics, rate limiter and circuit breakers are all
+    safe to use from many threads at once, request scopes belong to the
+    thread that opened them, and the objects we return are never the
+    ones kept in the cache. Don't change the settings of a shared
+    object once threads are using it.
+
+    To stay under the API's quota, share a `p2p.ratelimit.RateLimiter`
+    between everything that calls it::
+
+        p2p = P2P(my_p2p_url, my_auth_token,
+                  rate_limiter=RateLimiter(
+                      buckets={'default': TokenBucket(rate=20)},
+                      max_in_flight=10))
     """
 
     def __init__(self, url, auth_token,
-                 debug=False, cache=NoCache(),
+                 debug=False, cache=None,
                  image_services_url=None,
                  default_content_item_query=None,
-                 content_item_defaults=None):
+                 content_item_defaults=None,
+                 retry_policy=None,
+                 circuit_breakers=None,
+                 timeout=None,
+                 max_stale_bytes=0,
+                 rate_limiter=None,
+                 thumb_ttl=3600,
+                 missing_thumb_ttl=300):
         self.config = {
             'P2P_API_ROOT': url,
             'P2P_AUTH_TOKEN': auth_token,
             'IMAGE_SERVICES_URL': image_services_url,
         }
+        if cache is None:
+            cache = NoCache()
         self.cache = cache
         self.debug = debug
 
+        # slug -> True/False, whether we know a content item exists
+        self._known_slugs = dict()
+        self._known_slugs_lock = threading.Lock()
+        self.max_known_slugs = 10000
+
+        # every thread has its own request scope, see `request_scope`
+        self._scopes = threading.local()
+
+        # HTTP layer. Connections are pooled in the session, failed calls
+        # are retried according to the retry policy and endpoints that
+        # keep failing get their circuit opened.
+        import requests
+        self.session = requests.Session()
+        self.timeout = timeout
+        self.metrics = Metrics()
+        if retry_policy is None:
+            retry_policy = resilience.RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breakers is None:
+            circuit_breakers = resilience.CircuitBreakerRegistry()
+        self.circuit_breakers = circuit_breakers
+        self.rate_limiter = rate_limiter
+        self.hooks = {
+            'before_request': [],
+            'after_request': [],
+            'cache': [],
+        }
+
+        # Last good response for each GET url, served when an endpoint's
+        # circuit is open. Off unless we're given memory for it.
+        self.max_stale_bytes = max_stale_bytes
+        self._stale = OrderedDict()
+        self._stale_bytes = 0
+        self._stale_lock = threading.Lock()
+
+        # How long image services data is cached, and how long we
+        # remember that a slug has no thumbnail
+        self.thumb_ttl = thumb_ttl
+        self.missing_thumb_ttl = missing_thumb_ttl
+
+        # Streamed responses are read this many bytes at a time, and
+        # debug logging shows this much of a response
+        self.stream_chunk_size = 64 * 1024
+        self.max_debug_body = 2000
+
+        # Can be changed, requests use a frozen copy so its query string
+        # is only built once, see `_default_query`
         if default_content_item_query is None:
             self.default_content_item_query = {'include': ['web_url']}
         else:
             self.default_content_item_query = default_content_item_query
+        self._frozen_default = (None, None)
 
         if content_item_defaults is None:
             self.content_item_defaults = {
@@ -121,6 +223,20 @@ class P2P(object):
         else:
             self.content_item_defaults = content_item_defaults
 
+    def _default_query(self):
+        """
+        `default_content_item_query` as a `FrozenQuery`, frozen again
+        whenever it has been changed.
+        """
+        query = self.default_content_item_query
+        if isinstance(query, utils.FrozenQuery):
+            return query
+        seen, frozen = self._frozen_default
+        if frozen is None or query != seen:
+            frozen = utils.FrozenQuery(query)
+            self._frozen_default = (deepcopy(query), frozen)
+        return frozen
+
     def get_content_item(self, slug, query=None, force_update=False):
         """
         Get a single content item by slug.
@@ -133,18 +249,36 @@ class P2P(object):
         item and query.
         """
         if not query:
-            query = self.default_content_item_query
+            query = self._default_query()
+
+        scope = self.current_scope()
+        if scope is not None and not force_update:
+            ci = scope.get(slug=slug, query=query)
+            if ci is not None:
+                self.metrics.incr('scope.hits')
+                return ci
 
         if force_update:
-            j = self.get("/content_items/%s.json" % (slug), query)
-            ci = j['content_item']
-            self.cache.save_content_item(ci, query=query)
+            ci = self._fetch_content_item(slug, query)
         else:
-            ci = self.cache.get_content_item(slug=slug, query=query)
+            ci = self._cache_result(
+                'content_item',
+                self.cache.get_content_item(slug=slug, query=query))
             if ci is None:
-                j = self.get("/content_items/%s.json" % (slug), query)
-                ci = j['content_item']
-                self.cache.save_content_item(ci, query=query)
+                ci = self._fetch_content_item(slug, query)
+        if scope is not None:
+            scope.remember(ci, query)
+        return ci
+
+    def _fetch_content_item(self, slug, query):
+        try:
+            j = self.get("/content_items/%s.json" % (slug), query)
+        except P2PNotFound:
+            self._remember_slug(slug, False)
+            raise
+        ci = j['content_item']
+        self._remember_slug(slug, True)
+        self.cache.save_content_item(ci, query=query)
         return ci
 
     def get_multi_content_items(self, ids, query=None, force_update=False):
@@ -158,14 +292,36 @@ class P2P(object):
         Takes an optional `query` parameter which is dictionary containing
         parameters to pass along in the API call. See the P2P API docs
         for details on parameters.
+
+        Inside a `request_scope`, items we already have aren't fetched
+        again, and each id is only fetched once.
         """
+        if not query:
+            query = self._default_query()
+
+        scope = self.current_scope()
+        if scope is None:
+            return self._get_multi_content_items(ids, query, force_update)
+
+        ret = list()
+        if not force_update:
+            for id in ids:
+                ci = scope.get(id=id, query=query)
+                if ci is not None:
+                    ret.append(ci)
+            self.metrics.incr('scope.hits', len(ret))
+            ids = scope.missing(ids, query)
+        ids = list(OrderedDict.fromkeys(ids))
+        fetched = self._get_multi_content_items(ids, query, force_update)
+        for ci in fetched:
+            scope.remember(ci, query)
+        return ret + fetched
+
+    def _get_multi_content_items(self, ids, query, force_update):
         ret = list()
         items = list()
         if_modified_since = datetime(1900, 1, 1)
 
-        if not query:
-            query = self.default_content_item_query
-
         # Pull as many items out of cache as possible
         for id in ids:
             if force_update:
@@ -174,7 +330,9 @@ class P2P(object):
                     "if_modified_since": utils.formatdate(if_modified_since),
                 })
             else:
-                ci = self.cache.get_content_item(id=id, query=query)
+                ci = self._cache_result(
+                    'content_item',
+                    self.cache.get_content_item(id=id, query=query))
                 if ci is None:
                     items.append({
                         "id": id,
@@ -208,7 +366,10 @@ class P2P(object):
                 multi_query = query.copy()
                 multi_query['content_items'] = items
 
-                resp = self.post_json('/content_items/multi.json', multi_query)
+                # entries are cached as they're decoded
+                resp = self.post_json(
+                    '/content_items/multi.json', multi_query,
+                    idempotent=True, stream=True)
                 for ci_resp in resp:
                     if ci_resp['status'] == 200:
                         ci = ci_resp['body']['content_item']
@@ -225,6 +386,44 @@ class P2P(object):
 
         return ret
 
+    @contextmanager
+    def request_scope(self):
+        """
+        Remember every content item we get until the end of the block,
+        and load content items in batches. See `p2p.scope`::
+
+            with p2p.request_scope() as scope:
+                ...
+
+        Scopes are per thread. Nested scopes share the outer scope.
+        """
+        scope = self.current_scope()
+        if scope is not None:
+            yield scope
+            return
+        scope = self._scopes.current = RequestScope(self)
+        try:
+            yield scope
+        finally:
+            self._scopes.current = None
+
+    def current_scope(self):
+        return getattr(self._scopes, 'current', None)
+
+    def query_cached_content_items(self, **filters):
+        """
+        Find content items in the cache, without asking the API::
+
+            p2p.query_cached_content_items(
+                collection='chi_homepage_top', state_code='live', limit=20)
+
+        The cache has to keep indexes, see `BaseCache.query_content_items`
+        for the filters.
+        """
+        if not filters.get('query'):
+            filters['query'] = self._default_query()
+        return self.cache.query_content_items(**filters)
+
     def update_content_item(self, content_item, slug=None):
         """
         Update a content item.
@@ -244,7 +443,13 @@ class P2P(object):
 
         d = {'content_item': content}
 
-        resp = self.put_json("/content_items/%s.json" % slug, d)
+        try:
+            # replacing a content item is safe to repeat
+            resp = self.put_json(
+                "/content_items/%s.json" % slug, d, idempotent=True)
+        except P2PNotFound:
+            self._remember_slug(slug, False)
+            raise
         return resp
 
     def create_content_item(self, content_item):
@@ -270,16 +475,26 @@ class P2P(object):
 
             create, response = p2p.create_or_update_content_item(item_dict)
 
+        Slugs we've already seen (or seen missing) are remembered, so a new
+        item goes straight to create instead of paying for a failed update.
+
         TODO: swap the tuple that is returned.
         """
+        slug = content_item.get('slug')
         create = False
-        try:
-            response = self.update_content_item(content_item)
-        except P2PException, e:
-            time.sleep(2)
+
+        # Skip the doomed PUT when we already know the slug doesn't exist
+        if self._known_slugs.get(slug) is False:
             response = self.create_content_item(content_item)
             create = True
+        else:
+            try:
+                response = self.update_content_item(content_item)
+            except P2PNotFound, e:
+                response = self.create_content_item(content_item)
+                create = True
 
+        self._remember_slug(slug, True)
         return (create, response)
 
     def junk_content_item(self, slug):
@@ -295,13 +510,69 @@ class P2P(object):
         resp = self.get("/content_items/search.json", params)
         return resp
 
+    def search_modified_since(self, since, query=None, per_page=100):
+        """
+        Iterate over every content item modified since the datetime
+        `since`, oldest first, a page of search results at a time. Pass a
+        `query` to narrow the search. Each page is decoded as it arrives.
+
+        Each page asks for what was modified since the last item we got,
+        rather than for the next page number, so items that are edited
+        while we're going through them can't push others back onto a page
+        we've already read. Items can come up again if they're edited.
+        """
+        from sync import modified_time
+        after = since
+        # where we've got to, and the items we got from there on, which
+        # we'll be sent again
+        newest = modified_time({'last_modified_time': since})
+        recent = dict()
+        page = 1
+        while True:
+            params = dict(query or {})
+            params['conditions'] = dict(params.get('conditions', {}))
+            params['conditions']['last_modified_time_after'] = \
+                utils.formatdate(after)
+            params.update({
+                'order': 'last_modified_time',
+                'page': page,
+                'per_page': per_page,
+            })
+            count = 0
+            last = None
+            for item in self.get("/content_items/search.json", params,
+                                 stream=True, key='content_items'):
+                count += 1
+                if not item.get('last_modified_time'):
+                    yield item
+                    continue
+                last = modified_time(item).replace(microsecond=0)
+                if recent.get(item['id']) == last:
+                    continue
+                recent[item['id']] = last
+                yield item
+            if count < per_page:
+                return
+            if last is not None and last > newest:
+                newest = last
+                # a second early, in case "after" doesn't include items
+                # modified in the same second
+                after = newest - timedelta(seconds=1)
+                recent = dict((id, modified) for id, modified in
+                              recent.iteritems() if modified >= newest)
+                page = 1
+            else:
+                # a page full of one second, or without times
+                page += 1
+
     def get_collection(self, code, query=None, force_update=False):
         if force_update:
             data = self.get('/collections/%s.json' % code, query)
             collection = data['collection']
             self.cache.save_collection(collection, query=query)
         else:
-            collection = self.cache.get_collection(code, query=query)
+            collection = self._cache_result(
+                'collection', self.cache.get_collection(code, query=query))
             if collection is None:
                 data = self.get('/collections/%s.json' % code, query)
                 collection = data['collection']
@@ -349,7 +620,7 @@ class P2P(object):
 
     def get_collection_layout(self, code, query=None, force_update=False):
         if not query:
-            query = {'include': 'items'}
+            query = COLLECTION_LAYOUT_QUERY
 
         if force_update:
             resp = self.get('/current_collections/%s.json' % code, query)
@@ -357,8 +628,9 @@ class P2P(object):
             collection_layout['code'] = code  # response is missing this
             self.cache.save_collection_layout(collection_layout, query=query)
         else:
-            collection_layout = self.cache.get_collection_layout(
-                code, query=query)
+            collection_layout = self._cache_result(
+                'collection_layout',
+                self.cache.get_collection_layout(code, query=query))
             if collection_layout is None:
                 resp = self.get('/current_collections/%s.json' % code, query)
                 collection_layout = resp['collection_layout']
@@ -370,15 +642,21 @@ class P2P(object):
 
     def get_fancy_collection(self, code, with_collection=False,
                              limit_items=25, content_item_query=None,
-                             force_update=False):
+                             force_update=False, with_thumbs=False):
         """
         Make a few API calls to fetch all possible data for a collection
         and its content items. Returns a collection layout with
         extra 'collection' key on the layout, and a 'content_item' key
         on each layout item.
+
+        With `with_thumbs=True`, each layout item also gets a 'thumb' key
+        with its image services data, or None.
         """
-        collection_layout = self.get_collection_layout(
-            code, force_update=force_update)
+        # Build on copies, whatever we got might be shared
+        collection_layout = dict(self.get_collection_layout(
+            code, force_update=force_update))
+        collection_layout['items'] = [
+            dict(item) for item in collection_layout['items']]
         if with_collection:
             # Do we want more detailed data about the collection?
             collection = self.get_collection(code, force_update=force_update)
@@ -403,6 +681,16 @@ class P2P(object):
                     ci['content_item'] = ci2
                     break
 
+        if with_thumbs:
+            thumbs = self.get_thumbs_for_slugs(
+                [ci2['slug'] for ci2 in content_items],
+                force_update=force_update)
+            for ci in collection_layout['items']:
+                if 'content_item' in ci:
+                    ci['thumb'] = thumbs[ci['content_item']['slug']]
+                else:
+                    ci['thumb'] = None
+
         return collection_layout
 
     def get_fancy_content_item(self, slug, query=None,
@@ -413,10 +701,13 @@ class P2P(object):
             query['include'].append('related_items')
 
         if related_items_query is None:
-            related_items_query = self.default_content_item_query
+            related_items_query = self._default_query()
 
-        content_item = self.get_content_item(
-            slug, query, force_update=force_update)
+        # Build on a copy, whatever we got might be shared
+        content_item = dict(self.get_content_item(
+            slug, query, force_update=force_update))
+        content_item['related_items'] = [
+            dict(item_stub) for item_stub in content_item['related_items']]
 
         # We have our content item, now loop through the related
         # items, build a list of content item ids, and retrieve them all
@@ -445,7 +736,8 @@ class P2P(object):
             section = data
             self.cache.save_section(section, path=path)
         else:
-            section = self.cache.get_section(path)
+            section = self._cache_result(
+                'section', self.cache.get_section(path))
             if section is None:
                 data = self.get('/sections/show_collections.json', query)
                 section = data
@@ -453,42 +745,378 @@ class P2P(object):
 
         return section
 
-    def get_thumb_for_slug(self, slug):
+    def get_thumb_for_slug(self, slug, force_update=False):
+        """
+        Get image services data for a slug, or None if there isn't any.
+
+        Thumbnails are cached for `thumb_ttl` seconds, and slugs without
+        one for `missing_thumb_ttl` seconds. Connection errors aren't
+        cached.
+        """
+        if not force_update:
+            thumb = self._cache_result('thumb', self.cache.get_thumb(slug))
+            if thumb is not None:
+                return thumb or None
+        return self._fetch_thumb(slug)
+
+    def get_thumbs_for_slugs(self, slugs, concurrency=8, force_update=False):
+        """
+        Get image services data for a bunch of slugs at once. Returns a
+        dictionary of slug -> data, or None if there isn't any.
+
+        Cached thumbnails are used, and the rest are fetched
+        `concurrency` at a time.
+        """
+        ret = dict()
+        misses = list()
+        for slug in slugs:
+            if slug in ret or slug in misses:
+                continue
+            thumb = None
+            if not force_update:
+                thumb = self._cache_result(
+                    'thumb', self.cache.get_thumb(slug))
+            if thumb is None:
+                misses.append(slug)
+            else:
+                ret[slug] = thumb or None
+
+        if len(misses) == 1:
+            ret[misses[0]] = self._fetch_thumb(misses[0])
+        elif misses:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(concurrency, len(misses)))
+            try:
+                ret.update(zip(misses, pool.map(self._fetch_thumb, misses)))
+            finally:
+                pool.close()
+                pool.join()
+        return ret
+
+    def _fetch_thumb(self, slug):
+        # through _request like any other call, so the rate limiter's
+        # image_services bucket, retries and circuit breakers apply
         url = "%s/photos/turbine/%s.json" % (
             self.config['IMAGE_SERVICES_URL'], slug)
 
-        resp = requests.get(
-            url,
-            headers=self.http_headers(),
-            verify=False)
-
-        if resp.ok:
-            return resp.json()
-        else:
+        import requests
+        try:
+            thumb = self._request('GET', url)
+        except (P2PThrottled, P2PCircuitOpen), e:
+            log.warning("Couldn't get thumb for %s: %s" % (slug, e))
+            self.metrics.incr('thumbs.errors')
+            return None
+        except P2PException:
+            # remember there's nothing there for a while
+            self.cache.save_thumb(slug, False, self.missing_thumb_ttl)
+            self.metrics.incr('thumbs.missing')
+            return None
+        except requests.exceptions.RequestException, e:
+            log.warning("Couldn't get thumb for %s: %s" % (slug, e))
+            self.metrics.incr('thumbs.errors')
             return None
 
+        self.cache.save_thumb(slug, thumb, self.thumb_ttl)
+        return thumb
+
     # Utilities
+    def _exception_for(self, resp, data=None):
+        """
+        Build the right exception for a 4xx response, so callers can tell
+        a missing item or a throttled request apart from a bad one.
+        """
+        args = (resp.content,) if data is None else (resp.content, data)
+        if resp.status_code == 404:
+            return P2PNotFound(*args)
+        elif resp.status_code == 429:
+            e = P2PThrottled(*args)
+            e.retry_after = utils.parse_retry_after(
+                resp.headers.get('Retry-After'))
+            return e
+        return P2PException(*args)
+
+    # Instrumentation
+    def add_hook(self, event, func):
+        """
+        Call `func` with a dictionary of details every time `event`
+        happens. Events are:
+
+        `before_request`
+            An API call is about to be made. Has the `method`, `url`,
+            `endpoint` family and retry `attempt`.
+        `after_request`
+            An API call finished, successfully or not. Adds the response
+            `status`, `bytes` (decompressed), `wire_bytes` (as received),
+            `error` and timings in seconds: `ttfb`
+            (until the response headers arrived), `total` (the whole
+            HTTP exchange), `decode` (JSON decoding) and `parse`
+            (`utils.parse_response`). `stale` is True if we served a
+            stale response because the endpoint's circuit was open.
+            Streamed responses are still being read, so they have no
+            `bytes`, `decode` or `parse`.
+        `cache`
+            We looked something up in the cache. Has the `kind` of object
+            and whether it was a `hit`.
+
+        See `p2p.metrics` for hooks that feed statsd and Prometheus.
+        """
+        # replaced rather than changed, so threads firing hooks never see
+        # a list that's being changed
+        self.hooks[event] = self.hooks[event] + [func]
+
+    def remove_hook(self, event, func):
+        hooks = list(self.hooks[event])
+        hooks.remove(func)
+        self.hooks[event] = hooks
+
+    def fire_hook(self, event, info):
+        for func in self.hooks[event]:
+            try:
+                func(info)
+            except Exception:
+                log.exception('Error in %s hook' % event)
+
+    def _cache_result(self, kind, obj):
+        if self.hooks['cache']:
+            self.fire_hook('cache', {'kind': kind, 'hit': obj is not None})
+        return obj
+
+    def _remember_slug(self, slug, exists):
+        if slug is None:
+            return
+        with self._known_slugs_lock:
+            if len(self._known_slugs) >= self.max_known_slugs:
+                self._known_slugs.clear()
+            self._known_slugs[slug] = exists
+
     def http_headers(self, content_type=None):
         h = {
             'Authorization': 'Bearer %(P2P_AUTH_TOKEN)s' % self.config,
+            'Accept-Encoding': 'gzip, deflate',
         }
         if content_type is not None:
             h['content-type'] = content_type
         return h
 
-    def get(self, url, query=None):
+    def get(self, url, query=None, stream=False, key=None):
+        """
+        GET some JSON. With `stream=True`, returns an iterator over the
+        array in the response (or under `key` in it), decoded as it
+        arrives. See `_iter_response`.
+        """
         if query is not None:
             url += '?' + utils.dict_to_qs(query)
+        return self._request('GET', url, stream=stream, key=key)
+
+    def post_json(self, url, data, idempotent=False, stream=False):
+        """
+        POST some JSON. Pass `idempotent=True` for read-only calls (like
+        multi.json) so they get retried like a GET, and `stream=True` to
+        iterate over the array in the response as it arrives.
+        """
+        return self._request('POST', url, data, idempotent=idempotent,
+                             stream=stream)
+
+    def put_json(self, url, data, idempotent=False):
+        """
+        PUT some JSON. Only retried with `idempotent=True`, since some
+        PUTs (like prepend.json) aren't safe to repeat.
+        """
+        return self._request('PUT', url, data, idempotent=idempotent)
+
+    def _request(self, method, url, data=None, idempotent=None,
+                 stream=False, key=None):
+        """
+        Make an API call, retrying and tripping circuit breakers as
+        configured. Returns the parsed JSON response, or an iterator
+        over it with `stream=True`.
+        """
+        if idempotent is None:
+            idempotent = method in resilience.IDEMPOTENT_METHODS
+        endpoint = utils.endpoint_family(url)
+        breaker = None
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.get(endpoint)
+        policy = self.retry_policy
+
+        attempt = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                self.metrics.incr('circuit_rejected.%s' % endpoint)
+                stale = self._get_stale(method, url)
+                if stale is not None:
+                    self.metrics.incr('stale_served.%s' % endpoint)
+                    return stale
+                raise P2PCircuitOpen(
+                    "Circuit for %s is open, not calling %s" % (
+                        endpoint, url))
+
+            if policy is not None and policy.budget is not None:
+                policy.budget.record_request()
+
+            info = {
+                'method': method,
+                'url': url,
+                'endpoint': endpoint,
+                'attempt': attempt,
+                'status': None,
+                'bytes': None,
+                'wire_bytes': None,
+                'ttfb': None,
+                'total': None,
+                'decode': None,
+                'parse': None,
+                'error': None,
+                'stale': False,
+            }
+            self.fire_hook('before_request', info)
+            try:
+                try:
+                    resp = self._attempt(
+                        method, url, data, endpoint, info, stream)
+                except Exception:
+                    # Something of ours broke (the rate limiter, say), not
+                    # the endpoint, so it doesn't count against it. A
+                    # trial call mustn't leave the circuit half open.
+                    if breaker is not None:
+                        breaker.cancel_trial()
+                    raise
+                error = info['error']
+                status = info['status']
+
+                if breaker is not None:
+                    if error is not None or status >= 500 or status == 429:
+                        if breaker.record_failure():
+                            self.metrics.incr(
+                                'circuit_opened.%s' % endpoint)
+                            log.warn('Circuit for %s opened' % endpoint)
+                    else:
+                        breaker.record_success()
+
+                if (error is not None or status >= 500 or status == 429) \
+                        and policy is not None and policy.should_retry(
+                            attempt, idempotent, status, error):
+                    retry_after = None
+                    if resp is not None:
+                        retry_after = utils.parse_retry_after(
+                            resp.headers.get('Retry-After'))
+                    self.metrics.incr('retries.%s' % endpoint)
+                    time.sleep(policy.delay(attempt, retry_after))
+                    attempt += 1
+                    continue
+
+                failed = error is not None or status >= 500
+                if failed and breaker is not None and \
+                        breaker.state == breaker.OPEN:
+                    stale = self._get_stale(method, url)
+                    if stale is not None:
+                        self.metrics.incr('stale_served.%s' % endpoint)
+                        info['stale'] = True
+                        return stale
+                if error is not None:
+                    raise error
+                if stream and resp.status_code < 400:
+                    return self._iter_response(resp, endpoint, key)
+                return self._handle_response(method, url, resp, info)
+            finally:
+                self.metrics.incr('requests.%s' % endpoint)
+                if info['total'] is not None:
+                    self.metrics.timing(
+                        'request_time.%s' % endpoint, info['total'])
+                self.fire_hook('after_request', info)
+
+    def _attempt(self, method, url, data, endpoint, info, stream=False):
+        """
+        Make one HTTP request, waiting on the rate limiter if we have one.
+        Errors from requests are put in `info` instead of being raised.
+        """
+        import requests
+        try:
+            if self.rate_limiter is None:
+                return self._send(method, url, data, info, stream)
+            start = time.time()
+            with self.rate_limiter.limit(endpoint):
+                self.metrics.timing(
+                    'ratelimit_wait.%s' % endpoint, time.time() - start)
+                return self._send(method, url, data, info, stream)
+        except requests.exceptions.RequestException, e:
+            info['error'] = e
+            return None
+
+    def _send(self, method, url, data=None, info=None, stream=False):
+        if data is None:
+            headers = self.http_headers()
+        else:
+            data = json.dumps(data)
+            headers = self.http_headers('application/json')
 
-        resp = requests.get(
-            self.config['P2P_API_ROOT'] + url,
-            headers=self.http_headers(),
-            verify=False)
-        if self.debug:
-            log.debug('URL: %s' % url)
-            log.debug('HEADERS: %s' % self.http_headers())
-            log.debug('STATUS: %s' % resp.status_code)
-            log.debug('RESPONSE_BODY: %s' % resp.content)
+        start = time.time()
+        try:
+            if not url.startswith(('http://', 'https://')):
+                url = self.config['P2P_API_ROOT'] + url
+            resp = self.session.request(
+                method,
+                url,
+                data=data,
+                headers=headers,
+                timeout=self.timeout,
+                verify=False,
+                stream=stream)
+        finally:
+            if info is not None:
+                info['total'] = time.time() - start
+
+        # streamed bodies are read as they're decoded, unless it's an
+        # error we need to look at
+        streaming = stream and resp.status_code < 400
+        if info is not None:
+            info['status'] = resp.status_code
+            info['ttfb'] = resp.elapsed.total_seconds()
+            if not streaming:
+                info['bytes'] = len(resp.content)
+                info['wire_bytes'] = _wire_bytes(resp)
+
+        if self.debug and log.isEnabledFor(logging.DEBUG):
+            log.debug('URL: %s', url)
+            log.debug('HEADERS: %s', headers)
+            if data is not None:
+                log.debug('PAYLOAD: %s', data)
+            log.debug('STATUS: %s', resp.status_code)
+            if streaming:
+                log.debug('RESPONSE_BODY: (streamed)')
+            elif len(resp.content) > self.max_debug_body:
+                log.debug('RESPONSE_BODY: %s... (%s bytes)',
+                          resp.content[:self.max_debug_body],
+                          len(resp.content))
+            else:
+                log.debug('RESPONSE_BODY: %s', resp.content)
+        return resp
+
+    def _iter_response(self, resp, endpoint, key=None):
+        """
+        Decode the JSON array in a streamed response (or the one under
+        `key`), yielding parsed elements as they come in. Only a chunk of
+        the body and one element are in memory at a time. The connection
+        goes back to the pool once we're done, or the iterator is
+        thrown away.
+        """
+        start = time.time()
+        count = 0
+        try:
+            for item in utils.iter_json_array(
+                    resp.iter_content(self.stream_chunk_size), key=key):
+                count += 1
+                yield utils.parse_response(item)
+        finally:
+            resp.close()
+            self.metrics.timing(
+                'stream_time.%s' % endpoint, time.time() - start)
+            self.metrics.incr('stream_items.%s' % endpoint, count)
+            wire_bytes = _wire_bytes(resp)
+            if wire_bytes:
+                self.metrics.incr('wire_bytes.%s' % endpoint, wire_bytes)
+
+    def _handle_response(self, method, url, resp, info=None):
         if resp.status_code >= 500:
             resp.raise_for_status()
         elif resp.status_code >= 400:
@@ -496,45 +1124,76 @@ class P2P(object):
                 data = resp.json()
             except ValueError:
                 data = resp.text
-            raise P2PException(resp.content, data)
-        return utils.parse_response(resp.json())
-
-    def post_json(self, url, data):
-        resp = requests.post(
-            self.config['P2P_API_ROOT'] + url,
-            data=json.dumps(data),
-            headers=self.http_headers('application/json'),
-            verify=False)
-        if self.debug:
-            log.debug('URL: %s' % url)
-            log.debug('HEADERS: %s' % self.http_headers())
-            log.debug('PAYLOAD: %s' % json.dumps(data))
-            log.debug('STATUS: %s' % resp.status_code)
-            log.debug('RESPONSE_BODY: %s' % resp.content)
-        if resp.status_code >= 500:
-            resp.raise_for_status()
-        elif resp.status_code >= 400:
-            raise P2PException(resp.content, resp.json())
-        return utils.parse_response(resp.json())
-
-    def put_json(self, url, data):
-        resp = requests.put(
-            self.config['P2P_API_ROOT'] + url,
-            data=json.dumps(data),
-            headers=self.http_headers('application/json'),
-            verify=False)
-        if self.debug:
-            log.debug('URL: %s' % url)
-            log.debug('HEADERS: %s' % self.http_headers())
-            log.debug('PAYLOAD: %s' % json.dumps(data))
-            log.debug('STATUS: %s' % resp.status_code)
-            log.debug('RESPONSE_BODY: %s' % resp.content)
-        if resp.status_code >= 500:
-            resp.raise_for_status()
-        elif resp.status_code >= 400:
-            raise P2PException(resp.content)
-        return utils.parse_response(resp.json())
+            raise self._exception_for(resp, data)
+
+        if method == 'GET' and self.max_stale_bytes:
+            self._save_stale(url, resp.content)
+
+        start = time.time()
+        data = resp.json()
+        decoded = time.time()
+        data = utils.parse_response(data)
+        if info is not None:
+            info['decode'] = decoded - start
+            info['parse'] = time.time() - decoded
+        return data
+
+    def _save_stale(self, url, content):
+        # Keep the raw body around, it's cheap to store and we only
+        # have to parse it if the API goes down
+        if len(content) > self.max_stale_bytes:
+            return
+        with self._stale_lock:
+            old = self._stale.pop(url, None)
+            if old is not None:
+                self._stale_bytes -= len(old)
+            self._stale[url] = content
+            self._stale_bytes += len(content)
+            while self._stale_bytes > self.max_stale_bytes:
+                url, old = self._stale.popitem(last=False)
+                self._stale_bytes -= len(old)
+
+    def _get_stale(self, method, url):
+        if method != 'GET':
+            return None
+        with self._stale_lock:
+            content = self._stale.get(url)
+        if content is None:
+            return None
+        log.warn('Serving stale response for %s' % url)
+        return utils.parse_response(json.loads(content))
+
+
+def _wire_bytes(resp):
+    """
+    How many bytes of a response came over the wire, before it was
+    decompressed. None if we can't tell.
+    """
+    try:
+        return resp.raw.tell()
+    except Exception:
+        return None
 
 
 class P2PException(Exception):
     pass
+
+
+class P2PNotFound(P2PException):
+    pass
+
+
+class P2PCircuitOpen(P2PException):
+    """
+    Too many recent failures on this endpoint, so we didn't call it, and
+    there was no stale response to fall back on.
+    """
+    pass
+
+
+class P2PThrottled(P2PException):
+    """
+    The API asked us to back off. `retry_after` is the number of seconds
+    it asked us to wait, or None.
+    """
+    retry_after = None
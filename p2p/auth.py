@@ -1,14 +1,145 @@
-import requests
+"""
+P2P authentication
+------------------
+Check P2P credentials with `authenticate`, or log in to Django with
+them by adding `P2PBackend` to `AUTHENTICATION_BACKENDS`.
+
+Logins go over one pooled session. Successful logins are remembered
+for `auth_cache.ttl` seconds, keyed by a salted hash of the credentials
+so no passwords are kept around, and identical logins made at the same
+time share one request. Local users are remembered for
+`user_cache.ttl` seconds, so changes to a user might take that long to
+show up.
+"""
+from copy import deepcopy
+import hashlib
+import hmac
 import json
-
-
-def authenticate(username=None, password=None, token=None, auth_url=None):
+import os
+import threading
+import time
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    The session logins are made with, so connections are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            _session = requests.Session()
+        return _session
+
+
+class _Call(object):
+    """
+    A fetch in progress, that other threads can wait for.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache(object):
+    """
+    A small thread-safe cache whose entries expire after `ttl` seconds.
+    Values are copied going in and out.
+    """
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = dict()
+        self._calls = dict()
+        self._lock = threading.Lock()
+        self._salt = os.urandom(16)
+
+    def hash_key(self, *parts):
+        """
+        A key for secrets, that can't be turned back into them.
+        """
+        msg = '\0'.join(
+            p.encode('utf-8') if isinstance(p, unicode) else str(p)
+            for p in parts)
+        return hmac.new(self._salt, msg, hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+        return deepcopy(entry[1])
+
+    def set(self, key, value):
+        value = deepcopy(value)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_call(self, key, func):
+        """
+        Return the cached value for `key`, or cache and return what
+        `func()` returns. Threads asking for the same key at the same
+        time wait for one call. Errors aren't cached.
+        """
+        ret = self.get(key)
+        if ret is not None:
+            return ret
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return deepcopy(call.value)
+
+        try:
+            call.value = func()
+            self.set(key, call.value)
+            return call.value
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+# credentials hash -> p2p_user
+auth_cache = TTLCache(ttl=300)
+
+# local username or user id -> django user
+user_cache = TTLCache(ttl=60)
+
+
+def authenticate(username=None, password=None, token=None, auth_url=None,
+                 use_cache=True):
 
     if username is not None and password is not None:
         # we need the url to request against
         if auth_url is None:
             # First try the environment
-            import os
             if 'P2P_AUTH_URL' in os.environ:
                 auth_url = os.environ['P2P_AUTH_URL']
             else:
@@ -22,22 +153,28 @@ def authenticate(username=None, password=None, token=None, auth_url=None):
                         "No connection settings available. Please put settings"
                         " in your environment variables or your Django config")
 
-        resp = requests.post(
-            auth_url,
-            params={
-                'username': username,
-                'password': password,
-                'token': token,
-            },
-            verify=False)
-
-        if not resp.ok:
-            if resp.status_code == 403:
-                raise P2PAuthError('Incorrect username or password')
-            else:
-                raise P2PAuthError(resp.content)
-
-        return json.loads(resp.content)['p2p_user']
+        def login():
+            resp = get_session().post(
+                auth_url,
+                params={
+                    'username': username,
+                    'password': password,
+                    'token': token,
+                },
+                verify=False)
+
+            if not resp.ok:
+                if resp.status_code == 403:
+                    raise P2PAuthError('Incorrect username or password')
+                else:
+                    raise P2PAuthError(resp.content)
+
+            return json.loads(resp.content)['p2p_user']
+
+        if not use_cache:
+            return login()
+        return auth_cache.get_or_call(
+            auth_cache.hash_key(auth_url, username, password, token), login)
     else:
         raise NotImplementedError
 
@@ -56,6 +193,10 @@ try:
                 # that you use for authentication
                 local_username = '.'.join(('p2p', userinfo['username']))
 
+                user = user_cache.get(('username', local_username))
+                if user is not None:
+                    return user
+
                 try:
                     user = User.objects.get(username=local_username)
 
@@ -70,6 +211,7 @@ try:
                     user.is_superuser = True
                     user.save()
 
+                user_cache.set(('username', local_username), user)
                 return user
 
             except P2PAuthError, e:
@@ -78,10 +220,15 @@ try:
             return None
 
         def get_user(self, user_id):
+            user = user_cache.get(('id', user_id))
+            if user is not None:
+                return user
             try:
-                return User.objects.get(pk=user_id)
+                user = User.objects.get(pk=user_id)
             except User.DoesNotExist:
                 return None
+            user_cache.set(('id', user_id), user)
+            return user
 
 except ImportError, e:
     pass
@@ -0,0 +1,508 @@
+"""
+P2P Benchmarks
+--------------
+Measure the client against a local stub of the Content Services API,
+so performance can be compared between versions without credentials or
+a network::
+
+    p2pbench > before.json
+    # ... hack hack hack ...
+    p2pbench > after.json
+
+Fixtures are generated, or you can record real ones from the API
+(with the usual P2P_API_KEY and P2P_API_URL settings) and replay them::
+
+    p2pbench --record fixtures.json --collection chi_na_lorem
+    p2pbench --fixtures fixtures.json --latency 0.02
+
+Use `--scenario` to run only some of the scenarios.
+"""
+from copy import deepcopy
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from __init__ import P2P, get_connection
+from stubserver import StubServer
+import cache
+import utils
+
+COLLECTION_CODE = 'chi_bench_collection'
+SECTION_PATH = '/news/bench'
+
+
+def build_fixtures(num_items=500, layout_items=25):
+    """
+    Generate fixtures shaped like real API responses.
+    """
+    content_items = list()
+    for i in range(num_items):
+        content_items.append({
+            'id': 1000000 + i,
+            'slug': 'chi-bench-item-%d' % i,
+            'title': 'Benchmark item number %d' % i,
+            'body': '<p>%s</p>' % ('Lorem ipsum dolor sit amet. ' * 40),
+            'byline': 'By A. Reporter',
+            'content_item_type_code': 'story',
+            'content_item_state_code': 'live',
+            'product_affiliate_code': 'chinews',
+            'source_code': 'chicagotribune',
+            'web_url': 'http://www.example.com/news/chi-bench-item-%d' % i,
+            'thumbnail_url': None,
+            'create_time': '2012-06-24T17:34:50Z',
+            'last_modified_time': '2012-06-25T13:17:26Z',
+            'display_time': '2012-06-25T13:17:26Z',
+            'publish_time': '2012-06-25T13:17:26Z',
+            'live_time': '2012-06-25T13:17:26Z',
+            'expire_time': 'null',
+            'related_items': [],
+        })
+
+    layout = {
+        'id': 1523354,
+        'code': COLLECTION_CODE,
+        'collection_id': 214280,
+        'last_modified_time': '2012-06-24T17:34:50Z',
+        'items': [{
+            'id': 129236536 + i,
+            'contentitem_id': ci['id'],
+            'slug': ci['slug'],
+            'sequence': i + 1,
+            'headline': None,
+            'abstract': None,
+            'subheadline': None,
+            'content_item_type_code': 'story',
+            'content_item_state_code': 'live',
+            'productaffiliatesection_id': 46013,
+            'last_modified_time': '2012-06-25T13:17:26Z',
+        } for i, ci in enumerate(content_items[:layout_items])],
+    }
+    collection = {
+        'id': 214280,
+        'code': COLLECTION_CODE,
+        'name': 'Benchmark collection',
+        'sequence': 1,
+        'max_elements': layout_items,
+        'productaffiliatesection_id': 46013,
+        'collection_type_code': 'misc',
+        'exclusivity': 'N',
+        'created_at': '2012-06-24T17:34:50Z',
+        'last_modified_time': '2012-06-24T17:34:50Z',
+    }
+    section = {'collections': [COLLECTION_CODE]}
+
+    return {
+        'content_items': content_items,
+        'collections': [collection],
+        'collection_layouts': [layout],
+        'sections': {SECTION_PATH: section},
+    }
+
+
+def record_fixtures(p2p, collection_codes, section_paths=()):
+    """
+    Pull fixtures from the live API for the given collections and
+    sections.
+    """
+    def raw(url, query=None):
+        if query is not None:
+            url += '?' + utils.dict_to_qs(query)
+        resp = p2p.session.get(
+            p2p.config['P2P_API_ROOT'] + url,
+            headers=p2p.http_headers(), verify=False)
+        resp.raise_for_status()
+        return resp.json()
+
+    fixtures = {'content_items': [], 'collections': [],
+                'collection_layouts': [], 'sections': {}}
+    for code in collection_codes:
+        fixtures['collections'].append(
+            raw('/collections/%s.json' % code)['collection'])
+        layout = raw('/current_collections/%s.json' % code,
+                     {'include': 'items'})['collection_layout']
+        layout['code'] = code
+        fixtures['collection_layouts'].append(layout)
+        for item in layout['items']:
+            fixtures['content_items'].append(raw(
+                '/content_items/%s.json' % item['slug'],
+                p2p.default_content_item_query)['content_item'])
+    for path in section_paths:
+        fixtures['sections'][path] = raw(
+            '/sections/show_collections.json',
+            {'section_path': path, 'product_affiliate_code': 'chinews'})
+    return fixtures
+
+
+def measure(name, func, iterations, setup=None):
+    """
+    Run `func` `iterations` times and summarize how long it took.
+    `setup` is run, untimed, before every iteration.
+    """
+    times = list()
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return summarize(name, times)
+
+
+def measure_together(funcs, iterations):
+    """
+    Like `measure`, for (name, func) pairs run in turn each iteration,
+    so they're compared under the same conditions.
+    """
+    times = [list() for name, func in funcs]
+    for i in range(iterations):
+        for (name, func), t in zip(funcs, times):
+            start = time.time()
+            func()
+            t.append(time.time() - start)
+    return [summarize(name, t) for (name, func), t in zip(funcs, times)]
+
+
+def summarize(name, times):
+    times = sorted(times)
+    return {
+        'name': name,
+        'iterations': len(times),
+        'total': sum(times),
+        'mean': sum(times) / len(times),
+        'min': times[0],
+        'p50': times[len(times) // 2],
+        'p90': times[int(len(times) * 0.9)],
+        'max': times[-1],
+    }
+
+
+def cache_backends():
+    """
+    Cache backends we can benchmark here, as (name, factory) pairs. Every
+    cache made by a factory starts out empty.
+    """
+    counter = [0]
+
+    def prefixed(cls):
+        def factory():
+            counter[0] += 1
+            return cls(prefix='p2pbench%d' % counter[0])
+        return factory
+
+    def tiered(factory):
+        return lambda: cache.TieredCache(factory())
+
+    def disk():
+        counter[0] += 1
+        return cache.DiskCache(os.path.join(
+            tempfile.gettempdir(), 'p2pbench-%d-%d.db' % (
+                os.getpid(), counter[0])))
+
+    backends = [('DictionaryCache', cache.DictionaryCache),
+                ('MemoryCache', cache.MemoryCache),
+                ('DiskCache', disk),
+                ('NoCache', cache.NoCache)]
+    for name in ('DjangoCache', 'RedisCache'):
+        cls = getattr(cache, name, None)
+        if cls is None:
+            continue
+        try:
+            c = prefixed(cls)()
+            c.save_section({}, path='/ping')
+            _clear(c)
+        except Exception:
+            continue
+        backends.append((name, prefixed(cls)))
+        backends.append(('TieredCache.%s' % name, tiered(prefixed(cls))))
+    return backends
+
+
+def _clear(c):
+    if isinstance(c, cache.DiskCache):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(c.path + suffix):
+                os.remove(c.path + suffix)
+    if hasattr(c, 'l2'):
+        _clear(c.l2)
+    if hasattr(c, 'r'):
+        # only ever our own benchmark prefix
+        for key in c.r.keys(c.prefix + '_*'):
+            c.r.delete(key)
+
+
+def collection_codes(fixtures):
+    """
+    The codes of the collections in `fixtures`, recorded or made up.
+    """
+    codes = [cl['code'] for cl in fixtures.get('collection_layouts', [])]
+    return codes or [COLLECTION_CODE]
+
+
+def scenario_fancy_collection(server, fixtures, iterations):
+    results = list()
+    codes = collection_codes(fixtures)
+    for name, factory in cache_backends():
+        p2p = P2P(server.url, 'token', cache=factory())
+
+        def cold_setup():
+            _clear(p2p.cache)
+            p2p.cache = factory()
+
+        def work():
+            for code in codes:
+                p2p.get_fancy_collection(code, with_collection=True)
+
+        results.append(measure(
+            'get_fancy_collection.cold.%s' % name, work, iterations,
+            setup=cold_setup))
+        work()
+        results.append(measure(
+            'get_fancy_collection.warm.%s' % name, work, iterations))
+        _clear(p2p.cache)
+    return results
+
+
+def scenario_multi_content_items(server, fixtures, iterations):
+    results = list()
+    ids = [ci['id'] for ci in fixtures['content_items']]
+    p2p = P2P(server.url, 'token')
+    for n in (25, 100, 500):
+        results.append(measure(
+            'get_multi_content_items.%d' % n,
+            lambda: p2p.get_multi_content_items(ids[:n]),
+            iterations))
+    return results
+
+
+def scenario_parse_response(server, fixtures, iterations):
+    body = json.dumps([{'id': ci['id'], 'status': 200,
+                        'body': {'content_item': ci}}
+                       for ci in fixtures['content_items']])
+    return [measure(
+        'parse_response.%d_items' % len(fixtures['content_items']),
+        lambda: utils.parse_response(json.loads(body)),
+        iterations)]
+
+
+def scenario_cache_backends(server, fixtures, iterations):
+    results = list()
+    items = fixtures['content_items'][:100]
+    for name, factory in cache_backends():
+        c = factory()
+
+        def save():
+            for ci in items:
+                c.save_content_item(ci)
+
+        def get():
+            for ci in items:
+                c.get_content_item(slug=ci['slug'])
+
+        results.append(measure(
+            'cache.%s.save_content_item.100' % name, save, iterations))
+        results.append(measure(
+            'cache.%s.get_content_item.100' % name, get, iterations))
+        _clear(c)
+    return results
+
+
+def legacy_dict_to_qs(dictionary):
+    """
+    `utils.dict_to_qs` as it was in 1.2.1, to compare against.
+    """
+    qs = list()
+
+    for k, v in dictionary.items():
+        if isinstance(v, dict):
+            for k2, v2 in v.items():
+                if type(v2) in (str, unicode, int, float, bool):
+                    qs.append("%s[%s]=%s" % (k, k2, v2))
+                elif type(v2) in (list, tuple):
+                    for v3 in v2:
+                        qs.append("%s[%s][]=%s" % (k, k2, v3))
+                else:
+                    raise TypeError
+        elif type(v) in (str, unicode, int, float, bool):
+            qs.append("%s=%s" % (k, v))
+        elif type(v) in (list, tuple):
+            for v2 in v:
+                qs.append("%s[]=%s" % (k, v2))
+        else:
+            raise TypeError
+
+    return "&".join(qs)
+
+
+def assert_not_slower(result, baseline, tolerance=1.1):
+    """
+    Fail if `result` took longer than `baseline`, give or take
+    `tolerance` for timing noise. Compares the fastest runs.
+    """
+    assert result['min'] <= baseline['min'] * tolerance, (
+        "%s took %.4fs, %s took %.4fs" % (
+            result['name'], result['min'], baseline['name'],
+            baseline['min']))
+
+
+def scenario_query_string(server, fixtures, iterations):
+    queries = (
+        ('flat', {'section_path': '/news/local', 'page': 2,
+                  'product_affiliate_code': 'chinews'}),
+        ('default', {'include': ['web_url']}),
+        ('nested', {'conditions': {'content_item_type_code': 'story',
+                                   'last_modified_time_after':
+                                   '2012-06-25T13:17:26Z'},
+                    'include': ['web_url', 'related_items'],
+                    'order': 'last_modified_time', 'per_page': 100}),
+    )
+    results = list()
+    for name, query in queries:
+        frozen_query = utils.FrozenQuery(query)
+        legacy, unfrozen, frozen = measure_together([
+            ('query_string.%s.%s.10000' % (name, impl),
+             lambda func=func, q=q: [func(q) for i in xrange(10000)])
+            for impl, func, q in (('legacy', legacy_dict_to_qs, query),
+                                  ('dict_to_qs', utils.dict_to_qs, query),
+                                  ('frozen', utils.dict_to_qs,
+                                   frozen_query))],
+            iterations)
+        results.extend([legacy, unfrozen, frozen])
+        # encoding shouldn't cost plain dictionaries anything
+        assert_not_slower(unfrozen, legacy)
+    return results
+
+
+def scenario_threads(server, fixtures, iterations):
+    """
+    The same work split between more and more threads sharing one P2P
+    object, uncached and with a shared `MemoryCache`.
+    """
+    import threading
+    results = list()
+    slugs = [ci['slug'] for ci in fixtures['content_items'][:100]]
+    for name, factory in (('NoCache', cache.NoCache),
+                          ('MemoryCache', cache.MemoryCache)):
+        p2p = P2P(server.url, 'token', cache=factory())
+        # so every run is warm
+        for slug in slugs:
+            p2p.get_content_item(slug)
+        for num_threads in (1, 2, 4, 8):
+            def work():
+                threads = [threading.Thread(
+                    target=lambda part: [p2p.get_content_item(slug)
+                                         for slug in part],
+                    args=(slugs[i::num_threads],))
+                    for i in range(num_threads)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+            result = measure(
+                'threads.%s.%d.get_content_item.%d' % (
+                    name, num_threads, len(slugs)),
+                work, iterations)
+            result['per_second'] = len(slugs) / result['mean']
+            results.append(result)
+    return results
+
+
+SCENARIOS = (
+    ('fancy_collection', scenario_fancy_collection),
+    ('multi_content_items', scenario_multi_content_items),
+    ('parse_response', scenario_parse_response),
+    ('cache_backends', scenario_cache_backends),
+    ('query_string', scenario_query_string),
+    ('threads', scenario_threads),
+)
+
+
+def run(fixtures=None, scenarios=None, iterations=20,
+        latency=0, error_rate=0):
+    """
+    Run the benchmarks against a stub server, and return the results
+    as a dictionary.
+    """
+    if fixtures is None:
+        fixtures = build_fixtures()
+    server = StubServer(latency=latency, error_rate=error_rate)
+    server.load_fixtures(fixtures)
+    server.start()
+    try:
+        results = list()
+        for name, func in SCENARIOS:
+            if scenarios and name not in scenarios:
+                continue
+            results.extend(func(server, deepcopy(fixtures), iterations))
+    finally:
+        server.stop()
+
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('p2p').version
+    except Exception:
+        version = None
+
+    return {
+        'p2p_version': version,
+        'python': platform.python_version(),
+        'timestamp': utils.formatdate(datetime.utcnow()),
+        'latency': latency,
+        'error_rate': error_rate,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark p2p against a local stub API")
+    parser.add_argument("-s", "--scenario", dest="scenarios",
+                        action="append",
+                        choices=[name for name, func in SCENARIOS],
+                        help="Scenario to run, can be repeated")
+    parser.add_argument("-n", "--iterations", dest="iterations",
+                        type=int, default=20)
+    parser.add_argument("--latency", dest="latency", type=float, default=0,
+                        help="Seconds of latency to add to every response")
+    parser.add_argument("--error-rate", dest="error_rate", type=float,
+                        default=0, help="Fraction of requests that fail")
+    parser.add_argument("--fixtures", dest="fixtures",
+                        type=argparse.FileType('r'),
+                        help="Replay fixtures from this JSON file")
+    parser.add_argument("--record", dest="record",
+                        type=argparse.FileType('w'),
+                        help="Record fixtures from the live API to this file")
+    parser.add_argument("--collection", dest="collections",
+                        action="append", default=[],
+                        help="Collection to record, can be repeated")
+    parser.add_argument("--section", dest="sections",
+                        action="append", default=[],
+                        help="Section to record, can be repeated")
+    parser.add_argument("-o", "--output", dest="output",
+                        type=argparse.FileType('w'), default=sys.stdout,
+                        help="Write the results to this file")
+    args = parser.parse_args()
+
+    if args.record:
+        fixtures = record_fixtures(
+            get_connection(), args.collections, args.sections)
+        json.dump(fixtures, args.record, indent=2)
+        return
+
+    fixtures = None
+    if args.fixtures:
+        fixtures = json.load(args.fixtures)
+
+    results = run(fixtures, args.scenarios, args.iterations,
+                  args.latency, args.error_rate)
+    json.dump(results, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
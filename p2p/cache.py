@@ -1,31 +1,369 @@
 # (almost) pure python
+from collections import OrderedDict
 from copy import deepcopy
+import bisect
+import calendar
+import json
+import os
+import pickle
+import threading
+import time
 import utils
+from metrics import Histogram
+
+
+class CacheStats(object):
+    """
+    Per-cache statistics. For each kind of object (content_items,
+    collections, collection_layouts, sections) we count gets, hits,
+    misses, sets, evictions and bytes read and written, and keep get
+    and set latency histograms.
+
+    All the counting is done under a lock, so one cache can be shared
+    between threads. Use `snapshot(reset=True)` to read and zero the
+    stats in one go, `report_every` to do that on a timer, or `export`
+    to send them to statsd.
+    """
+    KINDS = ('content_items', 'collections', 'collection_layouts',
+             'sections', 'thumbs')
+    COUNTERS = ('gets', 'hits', 'misses', 'sets', 'evictions',
+                'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reporter = None
+        self._reset()
+
+    def _reset(self):
+        self.counters = dict(
+            (kind, dict((c, 0) for c in self.COUNTERS))
+            for kind in self.KINDS)
+        self.get_latency = dict((kind, Histogram()) for kind in self.KINDS)
+        self.set_latency = dict((kind, Histogram()) for kind in self.KINDS)
+
+    def record_get(self, kind, hit, seconds, nbytes=None):
+        with self._lock:
+            c = self.counters[kind]
+            c['gets'] += 1
+            if hit:
+                c['hits'] += 1
+            else:
+                c['misses'] += 1
+            if nbytes:
+                c['bytes_read'] += nbytes
+            self.get_latency[kind].observe(seconds)
+
+    def record_set(self, kind, seconds, nbytes=None):
+        with self._lock:
+            c = self.counters[kind]
+            c['sets'] += 1
+            if nbytes:
+                c['bytes_written'] += nbytes
+            self.set_latency[kind].observe(seconds)
+
+    def record_eviction(self, kind, count=1):
+        with self._lock:
+            self.counters[kind]['evictions'] += count
+
+    def snapshot(self, reset=False):
+        """
+        Returns a dictionary of stats for each kind of object. Pass
+        `reset=True` to start counting from zero again.
+        """
+        with self._lock:
+            ret = dict()
+            for kind in self.KINDS:
+                ret[kind] = dict(self.counters[kind])
+                ret[kind]['get_latency'] = self.get_latency[kind].snapshot()
+                ret[kind]['set_latency'] = self.set_latency[kind].snapshot()
+            if reset:
+                self._reset()
+        return ret
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def export(self, client, prefix='p2p.cache', reset=True):
+        """
+        Send the stats to a statsd client. Counters are sent with `incr`,
+        so by default the stats are reset once they've been sent.
+        """
+        snap = self.snapshot(reset=reset)
+        for kind, stats in snap.items():
+            for counter in self.COUNTERS:
+                if stats[counter]:
+                    client.incr(
+                        '%s.%s.%s' % (prefix, kind, counter), stats[counter])
+            for op in ('get', 'set'):
+                latency = stats['%s_latency' % op]
+                for p in ('p50', 'p90', 'p99'):
+                    if latency[p] is not None:
+                        client.gauge('%s.%s.%s_latency.%s' % (
+                            prefix, kind, op, p), latency[p] * 1000)
+        return snap
+
+    def report_every(self, seconds, callback):
+        """
+        Call `callback` with `snapshot(reset=True)` every `seconds`, from a
+        background thread. Call `stop_reporting` to make it stop.
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(seconds):
+                callback(self.snapshot(reset=True))
+
+        self.stop_reporting()
+        self._reporter = stop
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def stop_reporting(self):
+        if self._reporter is not None:
+            self._reporter.set()
+            self._reporter = None
+
+
+def timestamp(value):
+    """
+    Seconds since the epoch of a datetime or date string, for sorting.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, basestring):
+        value = utils.parsedate(value)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+class ContentIndex(object):
+    """
+    Secondary indexes over cached content items, kept in memory: sorted
+    by `last_modified_time` and `display_time`, and sets of items by
+    type, state and the collections they're in.
+    """
+    SORTED = ('last_modified_time', 'display_time')
+    FIELDS = ('content_item_type_code', 'content_item_state_code')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # id -> what we indexed it under, so we can take it out again
+        self._entries = dict()
+        # field -> sorted list of (timestamp, id)
+        self._sorted = dict((field, []) for field in self.SORTED)
+        # (field, value) -> ids
+        self._sets = dict()
+        # collection code -> ids
+        self._collections = dict()
+
+    def add(self, content_item):
+        id = content_item['id']
+        entry = dict()
+        for field in self.SORTED:
+            entry[field] = timestamp(content_item.get(field))
+        for field in self.FIELDS:
+            entry[field] = content_item.get(field)
+        with self._lock:
+            self._remove(id)
+            self._entries[id] = entry
+            for field in self.SORTED:
+                if entry[field] is not None:
+                    bisect.insort(self._sorted[field], (entry[field], id))
+            for field in self.FIELDS:
+                self._sets.setdefault((field, entry[field]), set()).add(id)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        # call with the lock held
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return
+        for field in self.SORTED:
+            if entry[field] is not None:
+                l = self._sorted[field]
+                i = bisect.bisect_left(l, (entry[field], id))
+                if i < len(l) and l[i] == (entry[field], id):
+                    del l[i]
+        for field in self.FIELDS:
+            ids = self._sets.get((field, entry[field]))
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self._sets[(field, entry[field])]
+
+    def set_collection(self, code, ids):
+        with self._lock:
+            self._collections[code] = set(ids)
+
+    def query(self, collection=None, type_code=None, state_code=None,
+              since=None, order_by='last_modified_time'):
+        """
+        Ids of the indexed content items that match, newest first.
+        """
+        since = timestamp(since)
+        with self._lock:
+            sets = list()
+            if collection is not None:
+                sets.append(self._collections.get(collection, set()))
+            if type_code is not None:
+                sets.append(self._sets.get(
+                    ('content_item_type_code', type_code), set()))
+            if state_code is not None:
+                sets.append(self._sets.get(
+                    ('content_item_state_code', state_code), set()))
+
+            if not sets:
+                l = self._sorted[order_by]
+                start = 0 if since is None else \
+                    bisect.bisect_left(l, (since,))
+                return [id for t, id in reversed(l[start:])]
+
+            ids = set.intersection(*sorted(sets, key=len))
+            ret = list()
+            for id in ids:
+                t = self._entries.get(id, {}).get(order_by)
+                if t is not None and (since is None or t >= since):
+                    ret.append((t, id))
+        ret.sort(reverse=True)
+        return [id for t, id in ret]
+
+
+class RedisContentIndex(object):
+    """
+    The same indexes as `ContentIndex`, in Redis sorted sets and sets, so
+    every process sharing the cache can query them.
+    """
+    def __init__(self, r, prefix='p2p'):
+        self.r = r
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return "_".join((self.prefix, 'index') + tuple(
+            unicode(p) for p in parts))
+
+    def add(self, content_item):
+        id = content_item['id']
+        entry = dict((field, content_item.get(field))
+                     for field in ContentIndex.FIELDS)
+        pipe = self.r.pipeline()
+        self._remove(pipe, id)
+        for field in ContentIndex.SORTED:
+            t = timestamp(content_item.get(field))
+            if t is not None:
+                pipe.zadd(self._key(field), {id: t})
+        for field in ContentIndex.FIELDS:
+            if entry[field] is not None:
+                pipe.sadd(self._key(field, entry[field]), id)
+        pipe.set(self._key('item', id), json.dumps(entry))
+        pipe.execute()
+
+    def remove(self, id):
+        pipe = self.r.pipeline()
+        self._remove(pipe, id)
+        pipe.execute()
+
+    def _remove(self, pipe, id):
+        old = self.r.get(self._key('item', id))
+        for field in ContentIndex.SORTED:
+            pipe.zrem(self._key(field), id)
+        if old:
+            for field, value in json.loads(old).items():
+                if value is not None:
+                    pipe.srem(self._key(field, value), id)
+        pipe.delete(self._key('item', id))
+
+    def set_collection(self, code, ids):
+        pipe = self.r.pipeline()
+        pipe.delete(self._key('collection', code))
+        if ids:
+            pipe.sadd(self._key('collection', code), *ids)
+        pipe.execute()
+
+    def query(self, collection=None, type_code=None, state_code=None,
+              since=None, order_by='last_modified_time'):
+        since = timestamp(since)
+        keys = list()
+        if collection is not None:
+            keys.append(self._key('collection', collection))
+        if type_code is not None:
+            keys.append(self._key('content_item_type_code', type_code))
+        if state_code is not None:
+            keys.append(self._key('content_item_state_code', state_code))
+
+        key = self._key(order_by)
+        low = '-inf' if since is None else since
+        if not keys:
+            return [int(id) for id in
+                    self.r.zrevrangebyscore(key, '+inf', low)]
+
+        import uuid
+        tmp = self._key('query', uuid.uuid4().hex)
+        weights = dict((k, 0) for k in keys)
+        weights[key] = 1
+        pipe = self.r.pipeline()
+        pipe.zinterstore(tmp, weights)
+        pipe.zrevrangebyscore(tmp, '+inf', low)
+        pipe.delete(tmp)
+        return [int(id) for id in pipe.execute()[1]]
 
 
 class BaseCache(object):
     """
     Base cache object for P2P. All P2P caching objects need to
     extend this class and implement its methods.
+
+    Caches are shared by every thread using a P2P object, so backends
+    keep all their state on the instance, guard it with their own locks
+    and hand out copies, never the objects they store.
     """
-    content_items_hits = 0
-    content_items_gets = 0
-    content_items_by_slug = dict()
-    content_items_by_id = dict()
+    # secondary indexes, if the cache keeps them
+    index = None
 
-    collections_hits = 0
-    collections_gets = 0
-    collections_by_slug = dict()
-    collections_by_id = dict()
+    def __init__(self):
+        self.stats = CacheStats()
 
-    collection_layouts_hits = 0
-    collection_layouts_gets = 0
-    collection_layouts_by_slug = dict()
-    collection_layouts_by_id = dict()
+    def query_content_items(self, collection=None, type_code=None,
+                            state_code=None, since=None,
+                            order_by='last_modified_time', limit=20,
+                            query=None):
+        """
+        Find cached content items, newest first by `order_by`
+        (`last_modified_time` or `display_time`), without asking the API::
+
+            cache.query_content_items(collection='chi_homepage_top',
+                                      type_code='story', state_code='live')
 
-    sections_hits = 0
-    sections_gets = 0
-    sections_by_path = dict()
+        Only caches created with `indexes=True` can do this. Items that
+        aren't cached with `query` are skipped.
+        """
+        if self.index is None:
+            raise NotImplementedError(
+                "%s doesn't keep indexes" % self.__class__.__name__)
+        ret = list()
+        for id in self.index.query(collection, type_code, state_code,
+                                   since, order_by):
+            ci = self.get_content_item(id=id, query=query)
+            if ci is not None:
+                ret.append(ci)
+                if limit and len(ret) >= limit:
+                    break
+        return ret
+
+    def _index_content_item(self, content_item):
+        if self.index is not None:
+            self.index.add(content_item)
+
+    def _index_collection_layout(self, collection_layout):
+        if self.index is not None:
+            self.index.set_collection(
+                collection_layout['code'],
+                [item['contentitem_id']
+                 for item in collection_layout.get('items', [])])
 
     def get_content_item(self, slug=None, id=None, query=None):
         raise NotImplementedError()
@@ -51,76 +389,150 @@ class BaseCache(object):
     def save_section(self, section, path=None):
         raise NotImplementedError()
 
+    def get_thumb(self, slug):
+        """
+        Image services data for a slug. None if we don't know, False if
+        we know there's no thumbnail. Caches that don't keep thumbnails
+        don't need to override this.
+        """
+        return None
+
+    def save_thumb(self, slug, thumb, ttl):
+        """
+        Keep a thumbnail, or False for no thumbnail, for `ttl` seconds.
+        """
+        pass
+
+    def _got(self, kind, start, ret, nbytes=None):
+        """
+        Record a get that started at `start` and returned `ret`.
+        """
+        self.stats.record_get(
+            kind, ret is not None, time.time() - start, nbytes)
+        return ret
+
+    def _set(self, kind, start, nbytes=None):
+        self.stats.record_set(kind, time.time() - start, nbytes)
+
     def get_stats(self):
-        return {
-            "content_item_gets": self.content_items_gets,
-            "content_item_hits": self.content_items_hits,
-            "collections_gets": self.collections_gets,
-            "collections_hits": self.collections_hits,
-            "collection_layouts_gets": self.collection_layouts_gets,
-            "collection_layouts_hits": self.collection_layouts_hits,
-            "sections_gets": self.sections_gets,
-            "sections_hits": self.sections_hits,
-        }
+        stats = self.stats.snapshot()
+        ret = dict()
+        for kind, prefix in (('content_items', 'content_item'),
+                             ('collections', 'collections'),
+                             ('collection_layouts', 'collection_layouts'),
+                             ('sections', 'sections'),
+                             ('thumbs', 'thumbs')):
+            for counter in ('gets', 'hits', 'misses', 'sets', 'evictions'):
+                ret['%s_%s' % (prefix, counter)] = stats[kind][counter]
+        return ret
 
 
 class DictionaryCache(BaseCache):
     """
     Cache object for P2P that stores stuff in dictionaries. Essentially
-    a local memory cache.
+    a local memory cache. Pass `indexes=True` to be able to
+    `query_content_items`.
     """
+    def __init__(self, indexes=False):
+        super(DictionaryCache, self).__init__()
+        if indexes:
+            self.index = ContentIndex()
+        self._lock = threading.Lock()
+
+        self.content_items_by_slug = dict()
+        self.content_items_by_id = dict()
+
+        self.collections_by_slug = dict()
+        self.collections_by_id = dict()
+
+        self.collection_layouts_by_slug = dict()
+        self.collection_layouts_by_id = dict()
+
+        self.sections_by_path = dict()
+
+        self.thumbs_by_slug = dict()
+
     def get_content_item(self, slug=None, id=None, query=None):
-        self.content_items_gets += 1
-        try:
-            if slug:
-                ret = deepcopy(self.content_items_by_slug[slug])
-            elif id:
-                ret = deepcopy(self.content_items_by_id[id])
-            else:
-                raise TypeError("get_content_item() takes either a slug or id keyword argument")
-            self.content_items_hits += 1
-            return ret
-        except (KeyError, IndexError), e:
-            return None
+        start = time.time()
+        if slug:
+            ret = self.content_items_by_slug.get(slug)
+        elif id:
+            ret = self.content_items_by_id.get(id)
+        else:
+            raise TypeError("get_content_item() takes either a slug or id keyword argument")
+        return self._got('content_items', start, deepcopy(ret))
 
     def save_content_item(self, content_item, query=None):
+        start = time.time()
         cache_copy = deepcopy(content_item)
-        self.content_items_by_slug[content_item['slug']] = cache_copy
-        self.content_items_by_id[content_item['id']] = cache_copy
+        with self._lock:
+            self.content_items_by_slug[content_item['slug']] = cache_copy
+            self.content_items_by_id[content_item['id']] = cache_copy
+        self._index_content_item(cache_copy)
+        self._set('content_items', start)
 
     def get_collection(self, slug=None, id=None, query=None):
-        self.collections_gets += 1
-        try:
-            if slug:
-                ret = deepcopy(self.collections_by_slug[slug])
-            elif id:
-                ret = deepcopy(self.collections_by_id[id])
-            else:
-                raise TypeError("get_collection() takes either a slug or id keyword argument")
-            self.collections_hits += 1
-            return ret
-        except (KeyError, IndexError), e:
-            return None
+        start = time.time()
+        if slug:
+            ret = self.collections_by_slug.get(slug)
+        elif id:
+            ret = self.collections_by_id.get(id)
+        else:
+            raise TypeError("get_collection() takes either a slug or id keyword argument")
+        return self._got('collections', start, deepcopy(ret))
 
     def save_collection(self, collection, query=None):
+        start = time.time()
         cache_copy = deepcopy(collection)
-        self.collections_by_slug[collection['code']] = cache_copy
-        self.collections_by_id[collection['id']] = cache_copy
+        with self._lock:
+            self.collections_by_slug[collection['code']] = cache_copy
+            self.collections_by_id[collection['id']] = cache_copy
+        self._set('collections', start)
 
     def get_collection_layout(self, slug, query=None):
-        self.collection_layouts_gets += 1
-        try:
-            ret = deepcopy(self.collection_layouts_by_slug[slug])
+        start = time.time()
+        ret = deepcopy(self.collection_layouts_by_slug.get(slug))
+        if ret is not None:
             ret['code'] = slug
-            self.collection_layouts_hits += 1
-            return ret
-        except (KeyError, IndexError), e:
-            return None
+        return self._got('collection_layouts', start, ret)
 
     def save_collection_layout(self, collection_layout, query=None):
+        start = time.time()
         cache_copy = deepcopy(collection_layout)
-        self.collection_layouts_by_slug[collection_layout['code']] = cache_copy
-        self.collection_layouts_by_id[collection_layout['id']] = cache_copy
+        with self._lock:
+            self.collection_layouts_by_slug[
+                collection_layout['code']] = cache_copy
+            self.collection_layouts_by_id[
+                collection_layout['id']] = cache_copy
+        self._index_collection_layout(cache_copy)
+        self._set('collection_layouts', start)
+
+    def get_section(self, path=None):
+        start = time.time()
+        ret = deepcopy(self.sections_by_path.get(path))
+        return self._got('sections', start, ret)
+
+    def save_section(self, section, path=None):
+        start = time.time()
+        self.sections_by_path[path] = deepcopy(section)
+        self._set('sections', start)
+
+    def get_thumb(self, slug):
+        start = time.time()
+        expires, ret = self.thumbs_by_slug.get(slug, (None, None))
+        if expires is not None and expires < start:
+            with self._lock:
+                # unless someone saved a new one meanwhile
+                if self.thumbs_by_slug.get(slug, (None,))[0] == expires:
+                    del self.thumbs_by_slug[slug]
+            self.stats.record_eviction('thumbs')
+            ret = None
+        return self._got('thumbs', start, deepcopy(ret))
+
+    def save_thumb(self, slug, thumb, ttl):
+        start = time.time()
+        self.thumbs_by_slug[slug] = (start + ttl, deepcopy(thumb))
+        self._set('thumbs', start)
 
 
 class NoCache(BaseCache):
@@ -129,227 +541,792 @@ class NoCache(BaseCache):
     development and such.
     """
     def get_content_item(self, slug=None, id=None, query=None):
-        return None
+        return self._got('content_items', time.time(), None)
 
     def save_content_item(self, content_item, query=None):
         pass
 
     def get_collection(self, slug=None, id=None, query=None):
-        return None
+        return self._got('collections', time.time(), None)
 
     def save_collection(self, collection, query=None):
         pass
 
     def get_collection_layout(self, slug=None, id=None, query=None):
-        return None
+        return self._got('collection_layouts', time.time(), None)
 
     def save_collection_layout(self, collection_layout, query=None):
         pass
 
     def get_section(self, path=None):
-        pass
+        return self._got('sections', time.time(), None)
 
     def save_section(self, section, path=None):
         pass
 
+    def get_thumb(self, slug):
+        return self._got('thumbs', time.time(), None)
+
+    def save_thumb(self, slug, thumb, ttl):
+        pass
+
 
-try:
-    from django.core.cache import cache
+class MemoryCache(BaseCache):
+    """
+    A bounded, in-process cache. Keeps at most `max_items` objects, for
+    at most `ttl` seconds each, evicting the least recently used ones
+    first. Meant to be the small, fast first tier of a `TieredCache`.
 
-    class DjangoCache(BaseCache):
+    Pass `indexes=True` to be able to `query_content_items`. Items drop
+    out of the indexes when they're evicted.
+    """
+    def __init__(self, max_items=1000, ttl=30, indexes=False):
+        super(MemoryCache, self).__init__()
+        self.max_items = max_items
+        self.ttl = ttl
+        if indexes:
+            self.index = ContentIndex()
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        # (kind, slug or id) -> keys of every copy of that object, so it
+        # can be invalidated whichever way it was stored
+        self._aliases = dict()
+        # key -> the (kind, slug or id) sets it's in, to clean them up
+        self._alias_of = dict()
+
+    def _key(self, kind, ident, query=None):
+        return (kind, ident, utils.dict_to_qs(query) if query else '')
+
+    def _get(self, kind, ident, query=None):
+        start = time.time()
+        key = self._key(kind, ident, query)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] < start:
+                    self._drop(key)
+                    self.stats.record_eviction(kind)
+                    entry = None
+                else:
+                    # most recently used goes to the end
+                    del self._data[key]
+                    self._data[key] = entry
+        ret = None if entry is None else deepcopy(entry[1])
+        return self._got(kind, start, ret)
+
+    def _save(self, kind, idents, obj, query=None, ttl=None):
+        start = time.time()
+        cache_copy = deepcopy(obj)
+        expires = start + min(ttl or self.ttl, self.ttl)
+        keys = [self._key(kind, ident, query) for ident in idents]
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._unlink(key)
+                self._data[key] = (expires, cache_copy)
+            for ident in idents:
+                self._aliases.setdefault((kind, ident), set()).update(keys)
+            for key in keys:
+                self._alias_of[key] = set((kind, ident) for ident in idents)
+            evicted = 0
+            while len(self._data) > self.max_items:
+                key, entry = self._data.popitem(last=False)
+                self._drop(key)
+                evicted += 1
+        if evicted:
+            self.stats.record_eviction(kind, evicted)
+        self._set(kind, start)
+
+    def _unlink(self, key):
+        # call with the lock held
+        for alias in self._alias_of.pop(key, ()):
+            keys = self._aliases.get(alias)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._aliases[alias]
+
+    def _drop(self, key):
+        # call with the lock held
+        self._data.pop(key, None)
+        self._unlink(key)
+
+        kind, ident = key[:2]
+        if kind == 'content_items' and self.index is not None and \
+                not isinstance(ident, basestring):
+            # queries look items up by id, so once no copy is stored
+            # under the id, the item is gone as far as they're concerned
+            if not [k for k in self._aliases.get(key[:2], ())
+                    if k[1] == ident and k in self._data]:
+                self.index.remove(ident)
+
+    def invalidate(self, kind, ident):
         """
-        Cache object for P2P that stores stuff using Django's cache API.
+        Forget every copy of an object, stored under any query. `kind`
+        is one of `CacheStats.KINDS`, `ident` its slug, code, id or path.
         """
-        def __init__(self, prefix='p2p'):
-            """
-            Takes one parameter, the name of this cache
-            """
-            self.prefix = prefix
+        with self._lock:
+            keys = list(self._aliases.get((kind, ident), ()))
+            for key in keys:
+                self._drop(key)
+        if keys:
+            self.stats.record_eviction(kind, len(keys))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._aliases.clear()
+            self._alias_of.clear()
+            if self.index is not None:
+                self.index = ContentIndex()
 
-        def get_content_item(self, slug=None, id=None, query=None):
-            self.content_items_gets += 1
+    def get_content_item(self, slug=None, id=None, query=None):
+        if not (slug or id):
+            raise TypeError("get_content_item() takes either a slug or id keyword argument")
+        return self._get('content_items', slug or id, query)
 
-            if slug:
-                key = "_".join([self.prefix, 'content_item',
-                                slug,
-                                self.query_to_key(query)])
-            elif id:
-                key = "_".join([self.prefix, 'content_item',
-                                str(id),
-                                self.query_to_key(query)])
-            else:
-                raise TypeError("get_content_item() takes either a slug or "
-                                "id keyword argument")
-            ret = cache.get(key)
-            if ret:
-                self.content_items_hits += 1
-            return ret
-
-        def save_content_item(self, content_item, query=None):
+    def save_content_item(self, content_item, query=None):
+        self._save('content_items',
+                   (content_item['slug'], content_item['id']),
+                   content_item, query)
+        self._index_content_item(content_item)
+
+    def get_collection(self, slug=None, id=None, query=None):
+        if not (slug or id):
+            raise TypeError("get_collection() takes either a slug or id keyword argument")
+        return self._get('collections', slug or id, query)
+
+    def save_collection(self, collection, query=None):
+        self._save('collections', (collection['code'], collection['id']),
+                   collection, query)
+
+    def get_collection_layout(self, slug, query=None):
+        ret = self._get('collection_layouts', slug, query)
+        if ret is not None:
+            ret['code'] = slug
+        return ret
+
+    def save_collection_layout(self, collection_layout, query=None):
+        self._save('collection_layouts',
+                   (collection_layout['code'], collection_layout['id']),
+                   collection_layout, query)
+        self._index_collection_layout(collection_layout)
+
+    def get_section(self, path=None):
+        return self._get('sections', path)
+
+    def save_section(self, section, path=None):
+        self._save('sections', (path,), section)
+
+    def get_thumb(self, slug):
+        return self._get('thumbs', slug)
+
+    def save_thumb(self, slug, thumb, ttl):
+        self._save('thumbs', (slug,), thumb, ttl=ttl)
+
+
+class TieredCache(BaseCache):
+    """
+    Puts a small in-process cache in front of a shared one::
+
+        cache = TieredCache(RedisCache(), MemoryCache(max_items=500, ttl=10))
+
+    Reads try the first tier (`l1`) and fill it from the second (`l2`).
+    Writes go to both. Defaults to a `MemoryCache` for `l1`.
+
+    Other processes writing to the shared cache can't reach into our
+    `l1`, so keep its TTL short or invalidate it. Call `listen_redis` to
+    invalidate on messages published by other TieredCaches through Redis,
+    or pass `notification_callback` to `p2p.notifications.start_listening`
+    to invalidate whenever P2P says something changed.
+    """
+    def __init__(self, l2, l1=None, redis_client=None,
+                 channel='p2p_invalidate'):
+        super(TieredCache, self).__init__()
+        if l1 is None:
+            l1 = MemoryCache()
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_thumb_ttl = 60
+        # queries go to the shared tier's indexes, if it keeps them
+        self.index = l2.index
+        self.redis_client = redis_client
+        self.channel = channel
+        import uuid
+        self.origin = uuid.uuid4().hex
+        self._listener = None
+
+    def _tiered_get(self, kind, l1_get, l2_get, l1_save):
+        start = time.time()
+        ret = l1_get()
+        if ret is None:
+            ret = l2_get()
+            if ret is not None:
+                l1_save(ret)
+        return self._got(kind, start, ret)
+
+    def get_content_item(self, slug=None, id=None, query=None):
+        return self._tiered_get(
+            'content_items',
+            lambda: self.l1.get_content_item(slug=slug, id=id, query=query),
+            lambda: self.l2.get_content_item(slug=slug, id=id, query=query),
+            lambda ci: self.l1.save_content_item(ci, query=query))
+
+    def save_content_item(self, content_item, query=None):
+        start = time.time()
+        self.l2.save_content_item(content_item, query=query)
+        self.l1.save_content_item(content_item, query=query)
+        self._set('content_items', start)
+        self.publish_invalidation(
+            'content_items', content_item['slug'], content_item['id'])
+
+    def get_collection(self, slug=None, id=None, query=None):
+        return self._tiered_get(
+            'collections',
+            lambda: self.l1.get_collection(slug=slug, id=id, query=query),
+            lambda: self.l2.get_collection(slug=slug, id=id, query=query),
+            lambda c: self.l1.save_collection(c, query=query))
+
+    def save_collection(self, collection, query=None):
+        start = time.time()
+        self.l2.save_collection(collection, query=query)
+        self.l1.save_collection(collection, query=query)
+        self._set('collections', start)
+        self.publish_invalidation(
+            'collections', collection['code'], collection['id'])
+
+    def get_collection_layout(self, slug, query=None):
+        return self._tiered_get(
+            'collection_layouts',
+            lambda: self.l1.get_collection_layout(slug, query=query),
+            lambda: self.l2.get_collection_layout(slug, query=query),
+            lambda cl: self.l1.save_collection_layout(cl, query=query))
+
+    def save_collection_layout(self, collection_layout, query=None):
+        start = time.time()
+        self.l2.save_collection_layout(collection_layout, query=query)
+        self.l1.save_collection_layout(collection_layout, query=query)
+        self._set('collection_layouts', start)
+        self.publish_invalidation(
+            'collection_layouts', collection_layout['code'],
+            collection_layout['id'])
+
+    def get_section(self, path=None):
+        return self._tiered_get(
+            'sections',
+            lambda: self.l1.get_section(path),
+            lambda: self.l2.get_section(path),
+            lambda s: self.l1.save_section(s, path=path))
+
+    def save_section(self, section, path=None):
+        start = time.time()
+        self.l2.save_section(section, path=path)
+        self.l1.save_section(section, path=path)
+        self._set('sections', start)
+        self.publish_invalidation('sections', path)
+
+    def get_thumb(self, slug):
+        # we don't know how long l2 has left, so l1 keeps it briefly
+        return self._tiered_get(
+            'thumbs',
+            lambda: self.l1.get_thumb(slug),
+            lambda: self.l2.get_thumb(slug),
+            lambda thumb: self.l1.save_thumb(
+                slug, thumb, self.l1_thumb_ttl))
+
+    def save_thumb(self, slug, thumb, ttl):
+        start = time.time()
+        self.l2.save_thumb(slug, thumb, ttl)
+        self.l1.save_thumb(slug, thumb, min(ttl, self.l1_thumb_ttl))
+        self._set('thumbs', start)
+
+    # Invalidation
+    def invalidate(self, kind, *idents):
+        """
+        Drop an object from the first tier, by any of its slugs, codes,
+        ids or paths.
+        """
+        for ident in idents:
+            if ident is not None:
+                self.l1.invalidate(kind, ident)
+
+    def publish_invalidation(self, kind, *idents):
+        """
+        Tell the other TieredCaches listening on our Redis channel to
+        drop an object from their first tier.
+        """
+        if self.redis_client is None:
+            return
+        self.redis_client.publish(self.channel, json.dumps({
+            'origin': self.origin, 'kind': kind, 'idents': idents}))
+
+    def handle_invalidation(self, message):
+        data = json.loads(message)
+        if data.get('origin') != self.origin:
+            self.invalidate(data['kind'], *data['idents'])
+
+    def listen_redis(self, redis_client=None):
+        """
+        Start a background thread that invalidates the first tier when
+        other processes publish changes through Redis.
+        """
+        if redis_client is not None:
+            self.redis_client = redis_client
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{
+            self.channel: lambda m: self.handle_invalidation(m['data'])})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return self._listener
+
+    def stop_listening(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def notification_callback(self, message):
+        """
+        Invalidate the first tier from a P2P notification. Use as (or
+        call from) the callback of `p2p.notifications.start_listening`.
+        """
+        if 'code' in message:
+            self.invalidate('collection_layouts',
+                            message['code'], message.get('id'))
+            self.invalidate('collections',
+                            message['code'], message.get('id'))
+        else:
+            self.invalidate('content_items',
+                            message.get('slug'), message.get('id'))
+
+
+class DiskCache(BaseCache):
+    """
+    Cache object for P2P that stores stuff in a SQLite database on disk,
+    so batch jobs and command line runs can start warm::
+
+        cache = DiskCache('/var/cache/p2p/cache.db', ttl=3600)
+
+    The database is in WAL mode, so any number of processes on the same
+    host can share it. Entries expire after `ttl` seconds, and once the
+    cache grows past `max_bytes` the oldest entries are dropped.
+    """
+    def __init__(self, path, ttl=3600, max_bytes=256 * 1024 * 1024,
+                 prefix='p2p', check_every=100):
+        super(DiskCache, self).__init__()
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.check_every = check_every
+        self._local = threading.local()
+        self._sets = 0
+        self._sets_lock = threading.Lock()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # somebody else made it first
+                pass
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS p2p_cache ("
+                "key TEXT PRIMARY KEY, kind TEXT, value BLOB, "
+                "size INTEGER, stored REAL, expires REAL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS p2p_cache_stored "
+                "ON p2p_cache (stored)")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or
+        # processes, so every thread of every process gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _key(self, kind, ident, query=None):
+        return "_".join([self.prefix, kind, unicode(ident),
+                         self.query_to_key(query)])
+
+    def _get(self, kind, key, start):
+        row = self._connection().execute(
+            "SELECT value, expires FROM p2p_cache WHERE key = ?",
+            (key,)).fetchone()
+        if row is None or row[1] < start:
+            return self._got(kind, start, None)
+        data = str(row[0])
+        return self._got(kind, start, pickle.loads(data), len(data))
+
+    def _save(self, kind, keys, obj, start, ttl=None):
+        import sqlite3
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO p2p_cache "
+                "(key, kind, value, size, stored, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, kind, sqlite3.Binary(data), len(data), start,
+                  start + (ttl or self.ttl)) for key in keys])
+        self._set(kind, start, len(data) * len(keys))
+
+        with self._sets_lock:
+            self._sets += 1
+            check = self._sets % self.check_every == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries, then the oldest ones until we're under
+        `max_bytes`.
+        """
+        conn = self._connection()
+        with conn:
+            expired = conn.execute(
+                "SELECT kind, COUNT(*) FROM p2p_cache WHERE expires < ? "
+                "GROUP BY kind", (time.time(),)).fetchall()
+            conn.execute(
+                "DELETE FROM p2p_cache WHERE expires < ?", (time.time(),))
+            for kind, count in expired:
+                self.stats.record_eviction(kind, count)
+
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM p2p_cache").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = conn.execute(
+                "SELECT key, kind, size FROM p2p_cache "
+                "ORDER BY stored").fetchall()
+            doomed = list()
+            for key, kind, size in rows:
+                if total <= self.max_bytes:
+                    break
+                total -= size
+                doomed.append((key,))
+                self.stats.record_eviction(kind)
+            conn.executemany("DELETE FROM p2p_cache WHERE key = ?", doomed)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM p2p_cache")
+
+    def get_content_item(self, slug=None, id=None, query=None):
+        start = time.time()
+        if not (slug or id):
+            raise TypeError("get_content_item() takes either a slug or "
+                            "id keyword argument")
+        return self._get('content_items', self._key(
+            'content_item', slug or id, query), start)
+
+    def save_content_item(self, content_item, query=None):
+        self._save('content_items', [
+            self._key('content_item', content_item['slug'], query),
+            self._key('content_item', content_item['id'], query),
+        ], content_item, time.time())
+
+    def get_collection(self, slug=None, id=None, query=None):
+        start = time.time()
+        if not (slug or id):
+            raise TypeError("get_collection() takes either a slug or id keyword argument")
+        return self._get('collections', self._key(
+            'collection', slug or id, query), start)
+
+    def save_collection(self, collection, query=None):
+        self._save('collections', [
+            self._key('collection', collection['code'], query),
+            self._key('collection', collection['id'], query),
+        ], collection, time.time())
+
+    def get_collection_layout(self, slug, query=None):
+        start = time.time()
+        ret = self._get('collection_layouts', self._key(
+            'collection_layout', slug, query), start)
+        if ret:
+            ret['code'] = slug
+        return ret
+
+    def save_collection_layout(self, collection_layout, query=None):
+        self._save('collection_layouts', [self._key(
+            'collection_layout', collection_layout['code'], query)],
+            collection_layout, time.time())
+
+    def get_section(self, path=None):
+        start = time.time()
+        return self._get('sections', self._key('section', path), start)
+
+    def save_section(self, section, path=None):
+        self._save('sections', [self._key('section', path)],
+                   section, time.time())
+
+    def get_thumb(self, slug):
+        start = time.time()
+        return self._get('thumbs', self._key('thumb', slug), start)
+
+    def save_thumb(self, slug, thumb, ttl):
+        self._save('thumbs', [self._key('thumb', slug)], thumb,
+                   time.time(), ttl=ttl)
+
+    def query_to_key(self, query):
+        if query is None:
+            return ''
+
+        return utils.dict_to_qs(query)
+
+
+class DjangoCache(BaseCache):
+    """
+    Cache object for P2P that stores stuff using Django's cache API.
+    """
+    def __init__(self, prefix='p2p'):
+        """
+        Takes one parameter, the name of this cache
+        """
+        super(DjangoCache, self).__init__()
+        from django.core.cache import cache
+        self.cache = cache
+        self.prefix = prefix
+
+    def get_content_item(self, slug=None, id=None, query=None):
+        start = time.time()
+
+        if slug:
             key = "_".join([self.prefix, 'content_item',
-                            content_item['slug'],
+                            slug,
                             self.query_to_key(query)])
-            cache.set(key, content_item)
-
+        elif id:
             key = "_".join([self.prefix, 'content_item',
-                            str(content_item['id']),
+                            str(id),
                             self.query_to_key(query)])
-            cache.set(key, content_item)
-
-        def get_collection(self, slug=None, id=None, query=None):
-            self.collections_gets += 1
-
-            if slug:
-                key = "_".join([self.prefix, 'collection',
-                                slug,
-                                self.query_to_key(query)])
-            elif id:
-                key = "_".join([self.prefix, 'collection',
-                                str(id), self.query_to_key(query)])
-            else:
-                raise TypeError("get_collection() takes either a slug or id keyword argument")
-            ret = cache.get(key)
-            if ret:
-                self.collections_hits += 1
-            return ret
+        else:
+            raise TypeError("get_content_item() takes either a slug or "
+                            "id keyword argument")
+        return self._got('content_items', start, self.cache.get(key))
 
-        def save_collection(self, collection, query=None):
-            key = "_".join([self.prefix, 'collection',
-                            collection['code'],
-                            self.query_to_key(query)])
-            cache.set(key, collection)
+    def save_content_item(self, content_item, query=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'content_item',
+                        content_item['slug'],
+                        self.query_to_key(query)])
+        self.cache.set(key, content_item)
+
+        key = "_".join([self.prefix, 'content_item',
+                        str(content_item['id']),
+                        self.query_to_key(query)])
+        self.cache.set(key, content_item)
+        self._set('content_items', start)
 
+    def get_collection(self, slug=None, id=None, query=None):
+        start = time.time()
+
+        if slug:
             key = "_".join([self.prefix, 'collection',
-                            str(collection['id']),
+                            slug,
                             self.query_to_key(query)])
-            cache.set(key, collection)
+        elif id:
+            key = "_".join([self.prefix, 'collection',
+                            str(id), self.query_to_key(query)])
+        else:
+            raise TypeError("get_collection() takes either a slug or id keyword argument")
+        return self._got('collections', start, self.cache.get(key))
 
-        def get_collection_layout(self, slug, query=None):
-            self.collection_layouts_gets += 1
+    def save_collection(self, collection, query=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'collection',
+                        collection['code'],
+                        self.query_to_key(query)])
+        self.cache.set(key, collection)
+
+        key = "_".join([self.prefix, 'collection',
+                        str(collection['id']),
+                        self.query_to_key(query)])
+        self.cache.set(key, collection)
+        self._set('collections', start)
 
-            key = "_".join([self.prefix, 'collection_layout',
-                            slug, self.query_to_key(query)])
-            ret = cache.get(key)
-            if ret:
-                ret['code'] = slug
-                self.collection_layouts_hits += 1
-            return ret
+    def get_collection_layout(self, slug, query=None):
+        start = time.time()
 
-        def save_collection_layout(self, collection_layout, query=None):
-            key = "_".join([self.prefix, 'collection_layout',
-                           collection_layout['code'],
-                           self.query_to_key(query)])
-            cache.set(key, collection_layout)
+        key = "_".join([self.prefix, 'collection_layout',
+                        slug, self.query_to_key(query)])
+        ret = self.cache.get(key)
+        if ret:
+            ret['code'] = slug
+        return self._got('collection_layouts', start, ret)
 
-        def query_to_key(self, query):
-            if query is None:
-                return ''
+    def save_collection_layout(self, collection_layout, query=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'collection_layout',
+                       collection_layout['code'],
+                       self.query_to_key(query)])
+        self.cache.set(key, collection_layout)
+        self._set('collection_layouts', start)
 
-            return utils.dict_to_qs(query)
+    def get_section(self, path=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'section', path])
+        return self._got('sections', start, self.cache.get(key))
 
+    def save_section(self, section, path=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'section', path])
+        self.cache.set(key, section)
+        self._set('sections', start)
 
-except ImportError, e:
-    pass
+    def get_thumb(self, slug):
+        start = time.time()
+        key = "_".join([self.prefix, 'thumb', slug])
+        return self._got('thumbs', start, self.cache.get(key))
 
-try:
-    import redis
-    import pickle
+    def save_thumb(self, slug, thumb, ttl):
+        start = time.time()
+        key = "_".join([self.prefix, 'thumb', slug])
+        self.cache.set(key, thumb, ttl)
+        self._set('thumbs', start)
 
-    class RedisCache(BaseCache):
+    def query_to_key(self, query):
+        if query is None:
+            return ''
+
+        return utils.dict_to_qs(query)
+
+
+class RedisCache(BaseCache):
+    """
+    Cache object for P2P that stores stuff in Redis.
+    """
+    def __init__(self, prefix='p2p', host='localhost', port=6379, db=0,
+                 indexes=False):
         """
-        Cache object for P2P that stores stuff in Redis.
+        Takes one parameter, the name of this cache. Pass `indexes=True`
+        to be able to `query_content_items`.
         """
-        def __init__(self, prefix='p2p', host='localhost', port=6379, db=0):
-            """
-            Takes one parameter, the name of this cache
-            """
-            self.prefix = prefix
-            self.r = redis.StrictRedis(host=host, port=port, db=db)
+        super(RedisCache, self).__init__()
+        import redis
+        self.prefix = prefix
+        self.r = redis.StrictRedis(host=host, port=port, db=db)
+        if indexes:
+            self.index = RedisContentIndex(self.r, prefix)
+
+    def _get(self, kind, key, start):
+        ret = self.r.get(key)
+        if ret:
+            self._got(kind, start, ret, len(ret))
+            return pickle.loads(ret)
+        return self._got(kind, start, None)
 
-        def get_content_item(self, slug=None, id=None, query=None):
-            self.content_items_gets += 1
+    def get_content_item(self, slug=None, id=None, query=None):
+        start = time.time()
 
-            if slug:
-                key = "_".join([self.prefix, 'content_item',
-                                slug,
-                                self.query_to_key(query)])
-            elif id:
-                key = "_".join([self.prefix, 'content_item',
-                                str(id),
-                                self.query_to_key(query)])
-            else:
-                raise TypeError("get_content_item() takes either a slug or "
-                                "id keyword argument")
-            ret = self.r.get(key)
-            if ret:
-                self.content_items_hits += 1
-                return pickle.loads(ret)
-            return ret
-
-        def save_content_item(self, content_item, query=None):
+        if slug:
             key = "_".join([self.prefix, 'content_item',
-                            content_item['slug'],
+                            slug,
                             self.query_to_key(query)])
-            self.r.set(key, pickle.dumps(content_item))
-
+        elif id:
             key = "_".join([self.prefix, 'content_item',
-                            str(content_item['id']),
-                            self.query_to_key(query)])
-            self.r.set(key, pickle.dumps(content_item))
-
-        def get_collection(self, slug=None, id=None, query=None):
-            self.collections_gets += 1
-
-            if slug:
-                key = "_".join([self.prefix, 'collection',
-                                slug,
-                                self.query_to_key(query)])
-            elif id:
-                key = "_".join([self.prefix, 'collection',
-                                str(id), self.query_to_key(query)])
-            else:
-                raise TypeError("get_collection() takes either a slug or id keyword argument")
-            ret = self.r.get(key)
-            if ret:
-                self.collections_hits += 1
-                return pickle.loads(ret)
-            return ret
-
-        def save_collection(self, collection, query=None):
-            key = "_".join([self.prefix, 'collection',
-                            collection['code'],
+                            str(id),
                             self.query_to_key(query)])
-            self.r.set(key, pickle.dumps(collection))
+        else:
+            raise TypeError("get_content_item() takes either a slug or "
+                            "id keyword argument")
+        return self._get('content_items', key, start)
 
+    def save_content_item(self, content_item, query=None):
+        start = time.time()
+        data = pickle.dumps(content_item)
+        key = "_".join([self.prefix, 'content_item',
+                        content_item['slug'],
+                        self.query_to_key(query)])
+        self.r.set(key, data)
+
+        key = "_".join([self.prefix, 'content_item',
+                        str(content_item['id']),
+                        self.query_to_key(query)])
+        self.r.set(key, data)
+        self._index_content_item(content_item)
+        self._set('content_items', start, len(data) * 2)
+
+    def get_collection(self, slug=None, id=None, query=None):
+        start = time.time()
+
+        if slug:
             key = "_".join([self.prefix, 'collection',
-                            str(collection['id']),
+                            slug,
                             self.query_to_key(query)])
-            self.r.set(key, pickle.dumps(collection))
-
-        def get_collection_layout(self, slug, query=None):
-            self.collection_layouts_gets += 1
+        elif id:
+            key = "_".join([self.prefix, 'collection',
+                            str(id), self.query_to_key(query)])
+        else:
+            raise TypeError("get_collection() takes either a slug or id keyword argument")
+        return self._get('collections', key, start)
 
-            key = "_".join([self.prefix, 'collection_layout',
-                            slug, self.query_to_key(query)])
-            ret = self.r.get(key)
-            if ret:
-                ret = pickle.loads(ret)
-                ret['code'] = slug
-                self.collection_layouts_hits += 1
-            return ret
+    def save_collection(self, collection, query=None):
+        start = time.time()
+        data = pickle.dumps(collection)
+        key = "_".join([self.prefix, 'collection',
+                        collection['code'],
+                        self.query_to_key(query)])
+        self.r.set(key, data)
+
+        key = "_".join([self.prefix, 'collection',
+                        str(collection['id']),
+                        self.query_to_key(query)])
+        self.r.set(key, data)
+        self._set('collections', start, len(data) * 2)
 
-        def save_collection_layout(self, collection_layout, query=None):
-            key = "_".join([self.prefix, 'collection_layout',
-                           collection_layout['code'],
-                           self.query_to_key(query)])
-            self.r.set(key, pickle.dumps(collection_layout))
+    def get_collection_layout(self, slug, query=None):
+        start = time.time()
 
-        def query_to_key(self, query):
-            if query is None:
-                return ''
+        key = "_".join([self.prefix, 'collection_layout',
+                        slug, self.query_to_key(query)])
+        ret = self._get('collection_layouts', key, start)
+        if ret:
+            ret['code'] = slug
+        return ret
 
-            return utils.dict_to_qs(query)
+    def save_collection_layout(self, collection_layout, query=None):
+        start = time.time()
+        data = pickle.dumps(collection_layout)
+        key = "_".join([self.prefix, 'collection_layout',
+                       collection_layout['code'],
+                       self.query_to_key(query)])
+        self.r.set(key, data)
+        self._index_collection_layout(collection_layout)
+        self._set('collection_layouts', start, len(data))
 
+    def get_section(self, path=None):
+        start = time.time()
+        key = "_".join([self.prefix, 'section', path])
+        return self._get('sections', key, start)
 
-except ImportError, e:
-    pass
+    def save_section(self, section, path=None):
+        start = time.time()
+        data = pickle.dumps(section)
+        key = "_".join([self.prefix, 'section', path])
+        self.r.set(key, data)
+        self._set('sections', start, len(data))
+
+    def get_thumb(self, slug):
+        start = time.time()
+        key = "_".join([self.prefix, 'thumb', slug])
+        return self._get('thumbs', key, start)
+
+    def save_thumb(self, slug, thumb, ttl):
+        start = time.time()
+        data = pickle.dumps(thumb)
+        key = "_".join([self.prefix, 'thumb', slug])
+        self.r.setex(key, int(ttl), data)
+        self._set('thumbs', start, len(data))
+
+    def query_to_key(self, query):
+        if query is None:
+            return ''
+
+        return utils.dict_to_qs(query)
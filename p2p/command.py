@@ -1,18 +1,14 @@
 # -*- coding: utf-8 -*-
 
+# Imports that aren't needed by every command are done in the command,
+# so the command line starts fast. See TestImportTime.
 import os
 import argparse
-import clint
-import requests
 import json
+import sys
 
-from __init__ import get_connection
-from clint.textui import puts, colored, indent
-
-from notifications import start_listening
-
-import pprint
-pp = pprint.PrettyPrinter(indent=4)
+from __init__ import get_connection, P2PException
+import utils
 
 
 def content_item_cli():
@@ -20,13 +16,24 @@ def content_item_cli():
     commands_description = """%(prog)s"""
 
     parser = argparse.ArgumentParser(
-        usage="%(prog)s get|save|mv [options] slug",
+        usage="%(prog)s get|save|mv [options] slug\n"
+              "       %(prog)s get|save|mv [options] --batch [FILE]",
         description=commands_description)
     parser.add_argument("command", choices=('get', 'save', 'mv'),
                         help="Action to take")
-    parser.add_argument("slug",
+    parser.add_argument("slug", nargs="?",
                         help="Slug of the content item to work with.")
 
+    # Batch
+    parser.add_argument("-b", "--batch", dest="batch_file", nargs="?",
+                        type=argparse.FileType('r'), const='-',
+                        help="Work on every slug, or JSON content item, "
+                             "in a file, one per line. Reads stdin "
+                             "without a file.")
+    parser.add_argument("-j", "--concurrency", dest="concurrency",
+                        type=int, default=8,
+                        help="Requests to make at once in batch mode.")
+
     parser.add_argument("-F", "--from-file", dest="body_file",
                         type=argparse.FileType('r'), default='-',
                         help="Load the body from a file")
@@ -50,6 +57,21 @@ def content_item_cli():
                         help="Field to output")
 
     args = parser.parse_args()
+    import requests
+
+    if args.batch_file:
+        defaults = dict(content_item_type_code=args.type)
+        if args.state:
+            defaults['content_item_state_code'] = args.state
+        if args.title:
+            defaults['title'] = args.title
+        errors = run_batch(get_connection(), args.command, args.batch_file,
+                           sys.stdout, concurrency=args.concurrency,
+                           defaults=defaults, field_name=args.field_name)
+        sys.exit(1 if errors else 0)
+
+    if not args.slug:
+        parser.error("Give me a slug, or --batch")
 
     slug = args.slug
     content_item = dict()
@@ -98,6 +120,148 @@ def content_item_cli():
             print(e.__dict__['response'].content)
 
 
+def read_batch(lines):
+    """
+    Parse batch input. Each line is a slug, a content item id, a JSON
+    content item, or for `mv` an old and a new slug. Lines we can't read
+    come out as `{'line': n, 'error': ...}`.
+    """
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield {'line': n, 'error': 'Bad JSON'}
+        elif line.isdigit():
+            yield {'id': int(line)}
+        elif ' ' in line:
+            slug, new_slug = line.split(None, 1)
+            yield {'slug': slug, 'new_slug': new_slug.strip()}
+        else:
+            yield {'slug': line}
+
+
+def run_batch(p2p, command, lines, output, concurrency=8, defaults=None,
+              field_name=None):
+    """
+    Run `command` on every item in `lines`, `concurrency` at a time, and
+    write a JSON line to `output` for each as it finishes. Content items
+    we have ids for are fetched with `get_multi_content_items`. Returns
+    the number of errors.
+    """
+    from multiprocessing.pool import ThreadPool
+    import requests
+    items = list(read_batch(lines))
+
+    def result(item, content_item=None, error=None):
+        ret = {'slug': item.get('slug'), 'id': item.get('id')}
+        if 'line' in item:
+            ret['line'] = item['line']
+        if content_item is not None:
+            ret['slug'] = content_item.get('slug', ret['slug'])
+            ret['id'] = content_item.get('id', ret['id'])
+        if error is not None:
+            ret['error'] = str(error)
+        if content_item is not None:
+            if field_name:
+                content_item = {field_name: content_item.get(field_name)}
+            ret['content_item'] = content_item
+        return ret
+
+    def get(item):
+        try:
+            return result(item, p2p.get_content_item(item['slug']))
+        except (P2PException, requests.exceptions.RequestException), e:
+            return result(item, error=e)
+
+    def save(item):
+        if not item.get('slug'):
+            return result(item, error='No slug')
+        content_item = dict(defaults or {})
+        content_item.update(item)
+        try:
+            p2p.create_or_update_content_item(content_item)
+            return result(item)
+        except (P2PException, requests.exceptions.RequestException), e:
+            return result(item, error=e)
+
+    def mv(item):
+        if not item.get('slug') or not item.get('new_slug'):
+            return result(item, error='mv needs slug and new_slug')
+        try:
+            p2p.update_content_item(
+                {'slug': item['new_slug']}, slug=item['slug'])
+            return result(item)
+        except (P2PException, requests.exceptions.RequestException), e:
+            return result(item, error=e)
+
+    errors = [0]
+
+    def write(ret):
+        if 'error' in ret:
+            errors[0] += 1
+        output.write(utils.to_json(ret) + '\n')
+        output.flush()
+
+    for item in items:
+        if 'error' in item:
+            write(result(item, error=item['error']))
+    items = [item for item in items if 'error' not in item]
+
+    if command == 'get':
+        # ids can come in as strings from JSON lines, the API's are ints
+        by_id = dict()
+        by_slug = list()
+        for item in items:
+            if item.get('id') is not None:
+                try:
+                    item['id'] = int(item['id'])
+                except (TypeError, ValueError):
+                    write(result(item, error='Bad id'))
+                    continue
+                by_id.setdefault(item['id'], []).append(item)
+            elif item.get('slug'):
+                by_slug.append(item)
+            else:
+                write(result(item, error='No slug or id'))
+        # a chunk at a time, so one failed request only costs its ids
+        ids = by_id.keys()
+        for i in range(0, len(ids), 25):
+            chunk = ids[i:i + 25]
+            try:
+                found = p2p.get_multi_content_items(chunk)
+            except (P2PException, requests.exceptions.RequestException), e:
+                for id in chunk:
+                    for item in by_id.pop(id):
+                        write(result(item, error=e))
+                continue
+            for ci in found:
+                for item in by_id.pop(ci['id'], ()):
+                    write(result(item, ci))
+            for id in chunk:
+                for item in by_id.pop(id, ()):
+                    write(result(item, error='Not found'))
+        items = by_slug
+        func = get
+    elif command == 'save':
+        func = save
+    else:
+        func = mv
+
+    if items:
+        pool = ThreadPool(min(concurrency, len(items)))
+        try:
+            for ret in pool.imap_unordered(func, items):
+                write(ret)
+        finally:
+            pool.close()
+            pool.join()
+    return errors[0]
+
+
 def runwatcher():
     commands_description = """%(prog)s"""
 
@@ -109,6 +273,12 @@ def runwatcher():
 
     parser.add_argument("-u", "--url", dest="url", default=None,
                         help="RabbitMQ URL to connect to.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=1,
+                        help="Listener processes to run.")
+    parser.add_argument("--sharded", dest="sharded", action="store_true",
+                        help="Give every process its own share of the "
+                             "notifications, instead of sharing queues.")
 
     #parser.add_argument("-c", "--collection", dest="collection",
                         #action='store_true', help="Look for collections.")
@@ -116,6 +286,7 @@ def runwatcher():
                         #action='store_true', help="Look for items.")
 
     args = parser.parse_args()
+    from notifications import start_listening, Supervisor
 
     def print_message(message):
         if "slug" in message and message['slug'] == args.slug:
@@ -123,8 +294,78 @@ def runwatcher():
         elif "code" in message and message['code'] == args.slug:
             print(json.dumps(message))
 
+    if args.workers > 1:
+        Supervisor('watcher', print_message, args.workers, args.url,
+                   'chinews', sharded=args.sharded).run_forever()
+        return
+
     start_listening(
         'watcher',
         print_message,
         args.url,
         'chinews')
+
+
+def runwarmer():
+    commands_description = """%(prog)s"""
+
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options]",
+        description=commands_description)
+    parser.add_argument("-c", "--collection", dest="collections",
+                        action="append", default=[],
+                        help="Collection code to keep warm. Can be repeated.")
+    parser.add_argument("-s", "--section", dest="sections",
+                        action="append", default=[],
+                        help="Section path whose collections we keep warm. "
+                             "Can be repeated.")
+    parser.add_argument("-i", "--interval", dest="interval", type=int,
+                        default=300,
+                        help="Seconds between refreshes, usually your "
+                             "cache TTL.")
+    parser.add_argument("-a", "--refresh-ahead", dest="refresh_ahead",
+                        type=float, default=0.2,
+                        help="Fraction of the interval to refresh early.")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int,
+                        default=4, help="Collections to refresh at once.")
+    parser.add_argument("--once", dest="once", action="store_true",
+                        help="Refresh everything once and exit.")
+    parser.add_argument("-l", "--listen", dest="listen", default=None,
+                        metavar="NAME",
+                        help="After warming, refresh collections from "
+                             "notifications, listening as NAME.")
+    parser.add_argument("-u", "--url", dest="url", default=None,
+                        help="RabbitMQ URL to connect to.")
+
+    args = parser.parse_args()
+
+    if not args.collections and not args.sections:
+        parser.error("Give me at least one collection or section")
+
+    from warmer import CacheWarmer
+    from refresher import CollectionRefresher
+
+    p2p = get_connection()
+    warmer = CacheWarmer(
+        p2p,
+        collections=args.collections,
+        sections=args.sections,
+        interval=args.interval,
+        refresh_ahead=args.refresh_ahead,
+        concurrency=args.concurrency)
+
+    if args.once:
+        codes = warmer.run_once(force=True)
+        print("Warmed %s" % ", ".join(codes))
+    elif args.listen:
+        refresher = CollectionRefresher(p2p, warmer.discover())
+        refresher.prime()
+        try:
+            refresher.listen(args.listen, args.url)
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            warmer.run_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,307 @@
+"""
+P2P Exporter
+------------
+Dump whole sections, with every collection in them and every content
+item in those, for static fallbacks and search indexes::
+
+    exporter = Exporter(get_connection(), JSONLinesWriter('site.jsonl'),
+                        checkpoint='site.checkpoint')
+    exporter.export(sections=['/news/local', '/sports'])
+
+Collections are exported `checkpoint_every` at a time: their layouts
+are fetched `concurrency` at once, then all their content items, 25 at
+a time with `get_multi_content_items`, `concurrency` batches at once.
+Records are written as they arrive. Content items in more than one
+collection are only fetched and written once.
+
+Every record is a dictionary like `{"type": "content_item", "key": 123,
+"data": {...}}`. Use `SQLiteWriter` instead to get a database with one
+row per record.
+
+With a `checkpoint` file, an interrupted export picks up where it left
+off: finished sections and collections are skipped, and items already
+written aren't written again. Progress is appended to the checkpoint,
+one line per group of collections, so it's cheap however big the
+export gets. Records written after the last checkpoint might be written
+twice.
+
+Or from the command line, use `p2pexport`.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from warmer import section_collection_codes
+import utils
+
+log = logging.getLogger('p2p')
+
+
+class JSONLinesWriter(object):
+    """
+    Writes one JSON record per line to a path or a file object.
+    """
+    def __init__(self, output, append=False):
+        if isinstance(output, basestring):
+            output = open(output, 'a' if append else 'w')
+        self.output = output
+
+    def write(self, kind, key, data):
+        self.output.write(utils.to_json(
+            {'type': kind, 'key': key, 'data': data}) + '\n')
+
+    def commit(self):
+        self.output.flush()
+
+    def close(self):
+        self.commit()
+        if self.output not in (sys.stdout, sys.stderr):
+            self.output.close()
+
+
+class SQLiteWriter(object):
+    """
+    Writes records to an `export` table in a SQLite database. Writing a
+    record again replaces it.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS export ("
+            "type TEXT, key TEXT, data TEXT, PRIMARY KEY (type, key))")
+
+    def write(self, kind, key, data):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO export (type, key, data) "
+            "VALUES (?, ?, ?)", (kind, unicode(key), utils.to_json(data)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+class Exporter(object):
+    def __init__(self, p2p, writer, checkpoint=None, concurrency=4,
+                 batch_size=25, with_collection=True,
+                 content_item_query=None, force_update=True,
+                 checkpoint_every=20):
+        self.p2p = p2p
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.with_collection = with_collection
+        self.content_item_query = content_item_query
+        self.force_update = force_update
+        self.checkpoint_every = checkpoint_every
+
+        self.sections_done = set()
+        self.collections_done = set()
+        # ids of content items we've written
+        self.content_items_done = set()
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut off by a crash
+                    continue
+                self.sections_done.update(entry.get('sections', ()))
+                self.collections_done.update(entry.get('collections', ()))
+                self.content_items_done.update(
+                    entry.get('content_items', ()))
+
+    def save_checkpoint(self, sections=(), collections=(),
+                        content_items=()):
+        """
+        Record what's been finished since the last checkpoint.
+        """
+        # what's in the checkpoint has to be on disk first
+        self.writer.commit()
+        if not self.checkpoint:
+            return
+        with open(self.checkpoint, 'a') as f:
+            f.write(json.dumps({'sections': list(sections),
+                                'collections': list(collections),
+                                'content_items': list(content_items)}) +
+                    '\n')
+
+    def export(self, sections=(), collections=()):
+        """
+        Export the sections and collections, and all their content items.
+        Returns how many records were written.
+        """
+        from multiprocessing.pool import ThreadPool
+        start = time.time()
+        written = 0
+        pool = ThreadPool(self.concurrency)
+        try:
+            for path in sections:
+                if path in self.sections_done:
+                    continue
+                section = self.p2p.get_section(
+                    path, force_update=self.force_update)
+                self.writer.write('section', path, section)
+                written += 1
+                written += self._export_collections(
+                    pool, section_collection_codes(section))
+                self.sections_done.add(path)
+                self.save_checkpoint(sections=[path])
+
+            written += self._export_collections(pool, collections)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.p2p.metrics.timing('exporter.export', time.time() - start)
+        return written
+
+    def export_collection(self, code):
+        return self.export(collections=[code])
+
+    def _export_collections(self, pool, codes):
+        todo = list()
+        for code in codes:
+            if code not in self.collections_done and code not in todo:
+                todo.append(code)
+        written = 0
+        for i in range(0, len(todo), self.checkpoint_every):
+            written += self._export_group(
+                pool, todo[i:i + self.checkpoint_every])
+        return written
+
+    def _fetch_collection(self, code):
+        collection = None
+        if self.with_collection:
+            collection = self.p2p.get_collection(
+                code, force_update=self.force_update)
+        layout = self.p2p.get_collection_layout(
+            code, force_update=self.force_update)
+        return code, collection, layout
+
+    def _export_group(self, pool, codes):
+        """
+        Export some collections and their content items, then checkpoint.
+        """
+        written = 0
+        ids = list()
+        seen = set(self.content_items_done)
+        for code, collection, layout in pool.imap_unordered(
+                self._fetch_collection, codes):
+            if self.with_collection:
+                self.writer.write('collection', code, collection)
+                written += 1
+            self.writer.write('collection_layout', code, layout)
+            written += 1
+            for item in layout['items']:
+                id = item['contentitem_id']
+                if id not in seen:
+                    seen.add(id)
+                    ids.append(id)
+
+        new_ids = self._export_content_items(pool, ids)
+        written += len(new_ids)
+
+        self.collections_done.update(codes)
+        self.p2p.metrics.incr('exporter.collections', len(codes))
+        self.save_checkpoint(collections=codes, content_items=new_ids)
+        return written
+
+    def export_content_items(self, ids):
+        """
+        Fetch content items in batches, `concurrency` batches at a time,
+        and write them as they come in.
+        """
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.concurrency)
+        try:
+            new_ids = self._export_content_items(pool, ids)
+        finally:
+            pool.close()
+            pool.join()
+        self.save_checkpoint(content_items=new_ids)
+        return len(new_ids)
+
+    def _export_content_items(self, pool, ids):
+        """
+        Returns the ids of the content items we wrote.
+        """
+        batches = [ids[i:i + self.batch_size]
+                   for i in range(0, len(ids), self.batch_size)]
+
+        def fetch(batch):
+            return self.p2p.get_multi_content_items(
+                batch, query=self.content_item_query,
+                force_update=self.force_update)
+
+        new_ids = list()
+        for items in pool.imap_unordered(fetch, batches):
+            for ci in items:
+                if ci['id'] in self.content_items_done:
+                    continue
+                self.writer.write('content_item', ci['id'], ci)
+                self.content_items_done.add(ci['id'])
+                new_ids.append(ci['id'])
+        self.p2p.metrics.incr('exporter.content_items', len(new_ids))
+        return new_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export sections and collections, with all their "
+                    "content items")
+    parser.add_argument("-s", "--section", dest="sections",
+                        action="append", default=[],
+                        help="Section path to export, can be repeated")
+    parser.add_argument("-c", "--collection", dest="collections",
+                        action="append", default=[],
+                        help="Collection code to export, can be repeated")
+    parser.add_argument("-o", "--output", dest="output", default="-",
+                        help="Where to write. Files ending in .db or "
+                             ".sqlite get a SQLite database, anything "
+                             "else JSON lines. Defaults to stdout.")
+    parser.add_argument("--checkpoint", dest="checkpoint", default=None,
+                        help="Checkpoint file, to resume an interrupted "
+                             "export")
+    parser.add_argument("-j", "--concurrency", dest="concurrency",
+                        type=int, default=4,
+                        help="Batches of content items to fetch at once")
+    args = parser.parse_args()
+
+    if not args.sections and not args.collections:
+        parser.error("Give me at least one section or collection")
+
+    if os.path.splitext(args.output)[1] in ('.db', '.sqlite'):
+        writer = SQLiteWriter(args.output)
+    elif args.output == '-':
+        writer = JSONLinesWriter(sys.stdout)
+    else:
+        # keep what an interrupted run wrote
+        resume = args.checkpoint and os.path.exists(args.checkpoint)
+        writer = JSONLinesWriter(args.output, append=resume)
+
+    from __init__ import get_connection
+    exporter = Exporter(get_connection(), writer,
+                        checkpoint=args.checkpoint,
+                        concurrency=args.concurrency)
+    try:
+        written = exporter.export(args.sections, args.collections)
+    finally:
+        writer.close()
+    log.info('Exported %s records' % written)
+
+
+if __name__ == '__main__':
+    main()
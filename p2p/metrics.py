@@ -0,0 +1,186 @@
+"""
+Simple, thread-safe metrics for a P2P client.
+
+Every P2P object has a `metrics` attribute. Counters are bumped with
+`incr`, current values set with `gauge` and durations recorded with
+`timing`::
+
+    p2p.metrics.snapshot()
+    {'counters': {'retries': 3, ...}, 'timings': {...}}
+
+To send request and cache metrics somewhere else, install one of the
+hook adapters on your P2P object::
+
+    StatsdHooks(statsd.StatsClient()).install(p2p)
+    PrometheusHooks().install(p2p)
+"""
+import bisect
+import threading
+
+# Latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets. Not thread-safe on its own,
+    guard it with the owner's lock.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the `p`th percentile (0-100).
+        """
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Metrics(object):
+    """
+    Counters and timing summaries, safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.timings = dict()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            t = self.timings.get(name)
+            if t is None:
+                t = self.timings[name] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0}
+            t['count'] += 1
+            t['total'] += seconds
+            if seconds > t['max']:
+                t['max'] = seconds
+
+    def snapshot(self, reset=False):
+        """
+        Return a copy of all the metrics. Pass `reset=True` to zero
+        everything at the same time.
+        """
+        with self._lock:
+            ret = {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': dict(
+                    (k, dict(v)) for k, v in self.timings.items()),
+            }
+            if reset:
+                self.counters = dict()
+                self.timings = dict()
+        return ret
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+
+class StatsdHooks(object):
+    """
+    Sends request and cache metrics to a statsd client (anything with
+    `incr(name)` and `timing(name, milliseconds)` methods).
+    """
+    def __init__(self, client, prefix='p2p'):
+        self.client = client
+        self.prefix = prefix
+
+    def install(self, p2p):
+        p2p.add_hook('after_request', self.after_request)
+        p2p.add_hook('cache', self.cache)
+        return self
+
+    def after_request(self, info):
+        name = '%s.%s' % (self.prefix, info['endpoint'])
+        if info['error'] is not None:
+            self.client.incr('%s.errors' % name)
+        else:
+            self.client.incr('%s.status.%s' % (name, info['status']))
+        for phase in ('ttfb', 'total', 'decode', 'parse'):
+            if info[phase] is not None:
+                self.client.timing(
+                    '%s.%s' % (name, phase), info[phase] * 1000)
+
+    def cache(self, info):
+        self.client.incr('%s.cache.%s.%s' % (
+            self.prefix, info['kind'], 'hits' if info['hit'] else 'misses'))
+
+
+class PrometheusHooks(object):
+    """
+    Records request and cache metrics with prometheus_client.
+    """
+    def __init__(self, namespace='p2p', registry=None):
+        from prometheus_client import Counter, Histogram, REGISTRY
+        if registry is None:
+            registry = REGISTRY
+        self.requests = Counter(
+            'requests_total', 'Content Services API requests',
+            ['endpoint', 'status'], namespace=namespace, registry=registry)
+        self.latency = Histogram(
+            'request_seconds', 'Content Services API request latency',
+            ['endpoint', 'phase'], namespace=namespace, registry=registry)
+        self.response_bytes = Counter(
+            'response_bytes_total', 'Bytes received from the API',
+            ['endpoint'], namespace=namespace, registry=registry)
+        self.cache_lookups = Counter(
+            'cache_lookups_total', 'P2P cache lookups',
+            ['kind', 'result'], namespace=namespace, registry=registry)
+
+    def install(self, p2p):
+        p2p.add_hook('after_request', self.after_request)
+        p2p.add_hook('cache', self.cache)
+        return self
+
+    def after_request(self, info):
+        endpoint = info['endpoint']
+        status = 'error' if info['error'] is not None else info['status']
+        self.requests.labels(endpoint, str(status)).inc()
+        if info['bytes']:
+            self.response_bytes.labels(endpoint).inc(info['bytes'])
+        for phase in ('ttfb', 'total', 'decode', 'parse'):
+            if info[phase] is not None:
+                self.latency.labels(endpoint, phase).observe(info[phase])
+
+    def cache(self, info):
+        self.cache_lookups.labels(
+            info['kind'], 'hit' if info['hit'] else 'miss').inc()
@@ -29,19 +29,98 @@ Create/update/delete notifications are published via AMQP server.
 
 The payload is a JSON hash. The 'action' key is "U" for create/update,
 and "D" for deletes.
+
+Keeping up with bursts
+----------------------
+
+By default every notification is handled, and acknowledged, one at a
+time. If your callback is slow (say it calls the API), give the
+listener some `workers`::
+
+    start_listening('my_app', refresh, workers=8, prefetch_count=100)
+
+Callbacks then run on a pool of threads. Notifications about the same
+content item or collection are never handled by two threads at once,
+so they're handled in order, and a burst of notifications about one
+item that piles up while it's busy is handled with one callback, with
+the latest notification. Messages are acknowledged as soon as they're
+handled, in batches where they finished in order, so one slow callback
+doesn't hold up the rest. With workers the server sends at most
+`prefetch_count` unacknowledged messages, 10 per worker by default.
+
+The listener's `metrics` has the backlog (`backlog`, received but not
+yet acknowledged) and how long callbacks take (`callback`).
+
+Not missing anything
+--------------------
+
+The listener reconnects, with backoff, whenever it loses the server.
+To make sure nothing slips by while it's gone, use durable queues,
+which keep collecting notifications while nobody is listening, and a
+catch up hook, which asks the API what changed::
+
+    start_listening('my_app', refresh, heartbeat=30, durable=True,
+                    resume_file='/var/run/my_app.p2p',
+                    catch_up=api_catch_up(p2p, refresh))
+
+The time of the last notification is saved to `resume_file`, and on
+every (re)connection `catch_up` is called with that time.
+
+More than one process
+---------------------
+
+When one process can't keep up, run several with a `Supervisor`::
+
+    Supervisor('my_app', refresh, processes=4, workers=8).run_forever()
+
+The processes share the listener's queues, and the server hands each
+notification to one of them. That spreads the load but two processes
+might handle notifications about the same thing out of order. With
+`sharded=True` every process gets its own queues and only handles the
+notifications whose key hashes to it, so they stay in order.
+
+The supervisor restarts processes that die, and `stats` adds up the
+metrics of all of them. From the command line, `p2pwatcher --workers`.
 """
+from collections import deque, OrderedDict
+from datetime import datetime
+from multiprocessing import Process, Queue as ProcessQueue
 from kombu import Exchange, Queue, Connection
 from kombu.mixins import ConsumerMixin
 from kombu.utils.debug import setup_logging
 import json
+import logging
+import os
+from Queue import Queue as WorkQueue, Empty
+import threading
+import time
+import zlib
+
+from metrics import Metrics
+
+log = logging.getLogger('p2p')
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 
+def _acks_multiple(message):
+    """
+    Whether acking `message` with multiple=True acks the ones before it.
+    kombu's own transports, like memory://, ack just the one.
+    """
+    from kombu.transport import virtual
+    return not isinstance(getattr(message, 'channel', None), virtual.Channel)
+
+
 class Listener(ConsumerMixin):
+    PREFETCH_PER_WORKER = 10
 
-    def __init__(self, connection, name, callback, product_code=None):
+    def __init__(self, connection, name, callback, product_code=None,
+                 prefetch_count=None, workers=0, max_batch=100,
+                 durable=False, catch_up=None, resume_file=None,
+                 catch_up_margin=60, save_every=10, shard=None,
+                 report=None, report_every=10):
         """
         Setup connection, setup queues, and bind them to the exchange
         """
@@ -49,6 +128,54 @@ class Listener(ConsumerMixin):
         self.callback = callback
         self.product_affiliate_code = product_code
         self.exchange = Exchange('updated_content')
+        if workers and prefetch_count is None:
+            # otherwise the server sends everything it has, and it all
+            # piles up in the workers' queues
+            prefetch_count = workers * self.PREFETCH_PER_WORKER
+        elif workers and not prefetch_count:
+            raise ValueError("workers need a prefetch_count")
+        self.prefetch_count = prefetch_count
+        self.max_batch = max_batch
+        self.metrics = Metrics()
+
+        # Resuming after a disconnect or restart
+        self.catch_up = catch_up
+        self.catch_up_margin = catch_up_margin
+        self.resume_file = resume_file
+        self.save_every = save_every
+        self.last_seen = self._load_last_seen()
+        self._saved_last_seen = self.last_seen
+        self._saved_at = time.time()
+        self._consume_connection = None
+
+        # (index, count) of the shard of notifications we handle, and
+        # where to send our metrics
+        self.shard = shard
+        self.report = report
+        self.report_every = report_every
+        self._reported_at = 0
+
+        # With workers, messages pile up by key in _pending, and keys
+        # that aren't being handled wait in _ready for the next free
+        # thread. A key is only handled by one thread at a time, so a
+        # slow one holds up nothing else. Their tags are handed back
+        # through _done to be acked by this thread. Delivery tags start
+        # over on every connection, so they're paired with which
+        # connection this is.
+        self._unacked = deque()
+        self._done = WorkQueue()
+        self._acked = set()
+        self._generation = 0
+        self._pending = dict()
+        self._busy = set()
+        self._ready = WorkQueue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
 
         if self.product_affiliate_code:
             ci_key = 'update.content_item.%s.#' % self.product_affiliate_code
@@ -57,20 +184,32 @@ class Listener(ConsumerMixin):
             ci_key = 'update.content_item.#'
             c_key = 'update.collection.#'
 
+        if shard is not None:
+            name = '%s_%d' % (name, shard[0])
+
+        # Durable queues outlive us, so notifications that arrive while
+        # we're disconnected or restarting wait for us
         self.queues = [
             Queue(name + '_content_items',
                   exchange=self.exchange,
                   routing_key=ci_key,
                   channel=self.connection,
-                  auto_delete=True),
+                  durable=durable,
+                  auto_delete=not durable),
             Queue(name + '_collections',
                   exchange=self.exchange,
                   routing_key=c_key,
                   channel=self.connection,
-                  auto_delete=True)
+                  durable=durable,
+                  auto_delete=not durable)
         ]
 
+        self.declare_queues()
+
+    def declare_queues(self, channel=None):
         for queue in self.queues:
+            if channel is not None:
+                queue = queue.bind(channel)
             # We declare and bind the queues manually. If we let kombu
             # autodeclare things later, it tries to redeclare the exchange
             # which just utterly fails.
@@ -81,8 +220,12 @@ class Listener(ConsumerMixin):
         """
         Create the Consumer objects that kombu wants
         """
+        # This runs on every (re)connect. Non-durable queues went away
+        # with the old connection, so declare them again.
+        self.declare_queues(channel)
         return [Consumer(queues=self.queues,
                          callbacks=[self.process_task, ],
+                         prefetch_count=self.prefetch_count,
                          auto_declare=False), ]
 
     def process_task(self, body, message):
@@ -90,12 +233,507 @@ class Listener(ConsumerMixin):
         Here we actually do interesting things
         """
         data = json.loads(body)
-        self.callback(data)
+        self.last_seen = time.time()
+        key = message_key(data)
+        if self.shard is not None and \
+                shard_for(key, self.shard[1]) != self.shard[0]:
+            # another process has this one
+            self.metrics.incr('skipped')
+            if self._workers:
+                tag = (self._generation, message.delivery_tag)
+                self._unacked.append((tag, message))
+                self._done.put(tag)
+            else:
+                message.ack()
+            return
+
+        if not self._workers:
+            start = time.time()
+            self.callback(data)
+            self.metrics.timing('callback', time.time() - start)
+            message.ack()
+            return
+
+        tag = (self._generation, message.delivery_tag)
+        self._unacked.append((tag, message))
+        self.metrics.incr('received')
+        with self._lock:
+            if key in self._pending:
+                # already waiting its turn
+                self._pending[key].append((data, tag, time.time()))
+            else:
+                self._pending[key] = [(data, tag, time.time())]
+                if key not in self._busy:
+                    self._ready.put(key)
+
+    def _work(self):
+        """
+        Worker thread. Take the next key that's ready and handle what's
+        piled up for it with one callback, with the latest notification.
+        """
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                pending = self._pending[key]
+                batch = pending[:self.max_batch]
+                del pending[:self.max_batch]
+                if not pending:
+                    del self._pending[key]
+                self._busy.add(key)
+            self.metrics.incr('coalesced', len(batch) - 1)
+
+            data = batch[-1][0]
+            start = time.time()
+            try:
+                self.callback(data)
+            except Exception:
+                # we don't requeue, a bad message would just come right
+                # back
+                log.exception('Error handling notification %s' % data)
+                self.metrics.incr('errors')
+            self.metrics.timing('callback', time.time() - start)
 
-        message.ack()
+            now = time.time()
+            for data, tag, received in batch:
+                self.metrics.timing('latency', now - received)
+                self._done.put(tag)
+
+            with self._lock:
+                self._busy.discard(key)
+                if key in self._pending:
+                    # more came in while we were busy
+                    self._ready.put(key)
+
+    def ack_finished(self):
+        """
+        Acknowledge every message that has been handled, with as few acks
+        as we can. Call from the consumer thread only.
+        """
+        while True:
+            try:
+                self._acked.add(self._done.get_nowait())
+            except Empty:
+                break
+
+        # Acking with multiple=True covers every earlier message, so it
+        # does for the run that's finished from the front
+        run = list()
+        while self._unacked and self._unacked[0][0] in self._acked:
+            tag, message = self._unacked.popleft()
+            self._acked.discard(tag)
+            run.append(message)
+        if run and _acks_multiple(run[-1]):
+            run[-1].ack(multiple=True)
+            self.metrics.incr('acks')
+        else:
+            for message in run:
+                message.ack()
+                self.metrics.incr('acks')
+
+        # and anything finished behind one that's still going is acked
+        # on its own, so it doesn't count against prefetch_count
+        if self._acked:
+            waiting = deque()
+            for tag, message in self._unacked:
+                if tag in self._acked:
+                    self._acked.discard(tag)
+                    message.ack()
+                    self.metrics.incr('acks')
+                else:
+                    waiting.append((tag, message))
+            self._unacked = waiting
+        # leftovers from a connection we lost
+        self._acked.clear()
+
+    def backlog(self):
+        """
+        How many messages we've received but haven't acknowledged yet.
+        """
+        return len(self._unacked)
+
+    def on_iteration(self):
+        if self._workers:
+            self.ack_finished()
+            self.metrics.gauge('backlog', self.backlog())
+
+        conn = self._consume_connection
+        if conn is not None and conn.heartbeat:
+            # tell the server we're alive, and find out if it's gone
+            conn.heartbeat_check()
+
+        if time.time() - self._saved_at >= self.save_every:
+            self._save_last_seen()
+
+        if self.report is not None and \
+                time.time() - self._reported_at >= self.report_every:
+            self._reported_at = time.time()
+            self.report(self.metrics.snapshot())
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        """
+        We're connected. If we've seen notifications before, catch up on
+        anything we might have missed since.
+        """
+        self._consume_connection = connection
+        # messages from a lost connection can't be acked on this one,
+        # the server will send them again
+        self._generation += 1
+        self._unacked.clear()
+        self.metrics.incr('connects')
+
+        if self.catch_up is not None and self.last_seen is not None:
+            since = datetime.utcfromtimestamp(
+                self.last_seen - self.catch_up_margin)
+            start = time.time()
+            try:
+                self.catch_up(since)
+            except Exception:
+                log.exception("Couldn't catch up since %s" % since)
+                self.metrics.incr('catch_up_errors')
+            self.metrics.timing('catch_up', time.time() - start)
+
+    def on_connection_error(self, exc, interval):
+        self.metrics.incr('connection_errors')
+        log.warn('Lost connection to the notification server: %s. '
+                 'Trying again in %ss' % (exc, interval))
+
+    def _load_last_seen(self):
+        if not self.resume_file:
+            return None
+        try:
+            with open(self.resume_file) as f:
+                return float(f.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _save_last_seen(self):
+        self._saved_at = time.time()
+        if not self.resume_file or self.last_seen == self._saved_last_seen:
+            return
+        tmp = self.resume_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(repr(self.last_seen))
+        os.rename(tmp, self.resume_file)
+        self._saved_last_seen = self.last_seen
+
+    def close(self, timeout=10):
+        """
+        Let the workers finish what they have, and try to ack it. Anything
+        we can't ack will be redelivered.
+        """
+        for t in self._workers:
+            self._ready.put(None)
+        for t in self._workers:
+            t.join(timeout)
+        self._workers = []
+        try:
+            self.ack_finished()
+        except Exception:
+            log.warn("Couldn't ack the last messages, they'll be redelivered")
+        self._save_last_seen()
+
+
+def api_catch_up(p2p, callback=None, query=None):
+    """
+    Make a `catch_up` function for a Listener that refetches, into the
+    cache, every content item modified while we weren't listening. If you
+    pass a `callback`, it gets a notification for each of those items,
+    as if they had come from the server.
+    """
+    def catch_up(since):
+        ids = [ci['id'] for ci in p2p.search_modified_since(since)]
+        if not ids:
+            return
+        log.info('Catching up on %s content items modified since %s' % (
+            len(ids), since))
+        items = p2p.get_multi_content_items(
+            ids, query=query, force_update=True)
+        if callback is not None:
+            for ci in items:
+                callback({'action': 'U', 'id': ci['id'], 'slug': ci['slug']})
+    return catch_up
 
 
-def start_listening(name, callback, amqp_url=None, product_code=None):
+class Coalescer(object):
+    """
+    Sits between a Listener and your callback and collapses bursts of
+    notifications. The first notification about an object (by type,
+    id or slug, and action) starts a `window` of seconds, and at the end
+    of it the callback gets only the latest notification about that
+    object::
+
+        coalescer = Coalescer(refresh, window=5)
+        start_listening('my_app', coalescer)
+
+    Or just pass `coalesce_window=5` to `start_listening`.
+
+    At most `max_pending` objects are held; past that the oldest is sent
+    early. Call `close` to send everything that's pending. `suppressed`
+    counts the notifications we didn't pass on.
+
+    Pending notifications have already been acked, so they're lost if
+    the process dies before the window ends.
+    """
+    def __init__(self, callback, window=2.0, max_pending=10000):
+        self.callback = callback
+        self.window = window
+        self.max_pending = max_pending
+        self.metrics = Metrics()
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def suppressed(self):
+        return self.metrics.snapshot()['counters'].get('suppressed', 0)
+
+    def __call__(self, message):
+        key = message_key(message) + (message.get('action'),)
+        overflow = None
+        with self._cond:
+            if key in self._pending:
+                deadline = self._pending[key][0]
+                self._pending[key] = (deadline, message)
+                self.metrics.incr('suppressed')
+                return
+            self._pending[key] = (time.time() + self.window, message)
+            if len(self._pending) > self.max_pending:
+                overflow = self._pending.popitem(last=False)[1][1]
+                self.metrics.incr('overflow')
+            self.metrics.gauge('pending', len(self._pending))
+            self._cond.notify()
+        if overflow is not None:
+            self._emit(overflow)
+
+    def _emit(self, message):
+        try:
+            self.callback(message)
+        except Exception:
+            log.exception('Error handling notification %s' % message)
+            self.metrics.incr('errors')
+        self.metrics.incr('emitted')
+
+    def _run(self):
+        while True:
+            ready = []
+            with self._cond:
+                while not self._closed:
+                    if self._pending:
+                        deadline = self._pending.itervalues().next()[0]
+                        wait = deadline - time.time()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                now = time.time()
+                # windows all have the same length, so oldest is first
+                while self._pending:
+                    key, (deadline, message) = \
+                        self._pending.iteritems().next()
+                    if deadline > now and not self._closed:
+                        break
+                    del self._pending[key]
+                    ready.append(message)
+                self.metrics.gauge('pending', len(self._pending))
+                closed = self._closed
+            for message in ready:
+                self._emit(message)
+            if closed:
+                return
+
+    def flush(self):
+        """
+        Send everything that's pending right now.
+        """
+        with self._cond:
+            ready = [message for deadline, message in
+                     self._pending.values()]
+            self._pending.clear()
+            self.metrics.gauge('pending', 0)
+        for message in ready:
+            self._emit(message)
+
+    def close(self):
+        """
+        Send everything that's pending and stop.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def message_key(data):
+    """
+    What a notification is about, as a hashable key.
+    """
+    if 'code' in data:
+        return ('collection', data['code'])
+    return ('content_item', data.get('slug') or data.get('id'))
+
+
+def shard_for(key, count):
+    """
+    Which of `count` shards handles notifications with this key. The
+    same in every process.
+    """
+    return (zlib.crc32(repr(key)) & 0xffffffff) % count
+
+
+class Supervisor(object):
+    """
+    Runs `processes` listeners, each in its own process, and keeps them
+    running. Keyword arguments are passed to `start_listening`.
+    """
+    def __init__(self, name, callback, processes=2, amqp_url=None,
+                 product_code=None, sharded=False, restart_delay=1,
+                 report_every=10, **listener_options):
+        self.name = name
+        self.callback = callback
+        self.processes = processes
+        self.amqp_url = get_amqp_url(amqp_url)
+        self.product_code = product_code
+        self.sharded = sharded
+        self.restart_delay = restart_delay
+        self.report_every = report_every
+        self.listener_options = listener_options
+        self.metrics = Metrics()
+
+        self._workers = [None] * processes
+        self._started = [0] * processes
+        self._stats = dict()
+        self._reports = ProcessQueue()
+        self._stopped = False
+
+    def _run(self, index):
+        options = dict(self.listener_options)
+        if self.sharded:
+            options['shard'] = (index, self.processes)
+        reports = self._reports
+        start_listening(
+            self.name, self.callback, self.amqp_url, self.product_code,
+            report=lambda snapshot: reports.put((index, snapshot)),
+            report_every=self.report_every, **options)
+
+    def _spawn(self, index):
+        p = Process(target=self._run, args=(index,),
+                    name='%s-%d' % (self.name, index))
+        p.daemon = True
+        p.start()
+        self._workers[index] = p
+        self._started[index] = time.time()
+
+    def start(self):
+        self._stopped = False
+        for i in range(self.processes):
+            self._spawn(i)
+        return self
+
+    def check(self):
+        """
+        Restart any process that died, and collect the latest metrics.
+        """
+        for i, p in enumerate(self._workers):
+            if self._stopped or p is None or p.is_alive():
+                continue
+            # don't spin if it dies as soon as it starts
+            if time.time() - self._started[i] < self.restart_delay:
+                continue
+            log.warn('Listener process %s exited with %s, restarting' % (
+                p.name, p.exitcode))
+            self.metrics.incr('restarts')
+            self._spawn(i)
+
+        while True:
+            try:
+                index, snapshot = self._reports.get_nowait()
+            except Empty:
+                break
+            self._stats[index] = snapshot
+
+    def pids(self):
+        return [p.pid for p in self._workers if p is not None]
+
+    def stats(self):
+        """
+        The metrics of every process, added up. The longest timing of
+        any process is the `max`.
+        """
+        ret = {'counters': {}, 'gauges': {}, 'timings': {},
+               'processes': len(self._stats)}
+        for snapshot in self._stats.values():
+            for kind in ('counters', 'gauges'):
+                for k, v in snapshot[kind].items():
+                    ret[kind][k] = ret[kind].get(k, 0) + v
+            for k, v in snapshot['timings'].items():
+                t = ret['timings'].setdefault(
+                    k, {'count': 0, 'total': 0.0, 'max': 0.0})
+                t['count'] += v['count']
+                t['total'] += v['total']
+                t['max'] = max(t['max'], v['max'])
+        ret['counters']['restarts'] = \
+            self.metrics.snapshot()['counters'].get('restarts', 0)
+        return ret
+
+    def run_forever(self, poll=1.0):
+        """
+        Start the processes, and watch them until we're interrupted.
+        """
+        self.start()
+        reported = time.time()
+        try:
+            while not self._stopped:
+                time.sleep(poll)
+                self.check()
+                if time.time() - reported >= self.report_every:
+                    reported = time.time()
+                    log.info('Listener stats: %s' % self.stats())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10):
+        self._stopped = True
+        for p in self._workers:
+            if p is not None and p.is_alive():
+                p.terminate()
+        for p in self._workers:
+            if p is not None:
+                p.join(timeout)
+
+
+def get_amqp_url(amqp_url=None):
+    """
+    Figure out the URL of the messaging server, from the environment or
+    Django settings, unless we were given one.
+    """
+    if amqp_url is not None:
+        return amqp_url
+
+    # Try getting settings from environment variables
+    if 'P2P_AMQP_URL' in os.environ:
+        return os.environ['P2P_AMQP_URL']
+
+    # Try getting settings from Django
+    try:
+        from django.conf import settings
+        return settings.P2P_AMQP_URL
+    except ImportError, e:
+        raise P2PNotificationError(
+            "No connection settings available. Please put settings in"
+            " your environment variables or your Django config")
+
+
+def start_listening(name, callback, amqp_url=None, product_code=None,
+                    coalesce_window=None, heartbeat=None,
+                    **listener_options):
     """
     Connect to the messaging server and listen for notifications. Takes
     the URL of the server to connect to and a function to call for every
@@ -106,29 +744,36 @@ def start_listening(name, callback, amqp_url=None, product_code=None):
     You must name every listener. Two listeners with the same name can't
     be listening at the same time. Or something, I think.
 
+    Other keyword arguments (`prefetch_count`, `workers`, `max_batch`,
+    `durable`, `catch_up`, `resume_file`, `shard`) are passed to the
+    `Listener`.
+    Pass `coalesce_window` to collapse bursts of notifications about the
+    same thing, see `Coalescer`, and `heartbeat` to check on the server
+    that many seconds apart.
+
     This function will run indefinitely.
     """
     #setup_logging(loglevel='INFO')
 
-    if amqp_url is None:
-        import os
+    amqp_url = get_amqp_url(amqp_url)
 
-        # Try getting settings from environment variables
-        if 'P2P_AMQP_URL' in os.environ:
-            amqp_url = os.environ['P2P_AMQP_URL']
-        else:
-            # Try getting settings from Django
-            try:
-                from django.conf import settings
-                amqp_url = settings.P2P_AMQP_URL
-            except ImportError, e:
-                raise P2PNotificationError(
-                    "No connection settings available. Please put settings in"
-                    " your environment variables or your Django config")
-
-    with Connection(amqp_url) as conn:
+    coalescer = None
+    if coalesce_window:
+        callback = coalescer = Coalescer(callback, coalesce_window)
+
+    with Connection(amqp_url, heartbeat=heartbeat) as conn:
         try:
-            Listener(conn, name, callback, product_code).run()
+            listener = Listener(
+                conn, name, callback, product_code, **listener_options)
+            try:
+                # wake up often enough to ack what the workers finish,
+                # and to keep the heartbeats going
+                listener.run(
+                    safety_interval=0.1 if listener._workers else 1)
+            finally:
+                listener.close()
+                if coalescer is not None:
+                    coalescer.close()
         except KeyboardInterrupt:
             conn.release()
         except:
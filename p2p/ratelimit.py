@@ -0,0 +1,147 @@
+"""
+Client-side rate limiting for the P2P HTTP layer.
+
+Give a P2P object a `RateLimiter` to cap how fast, and how many at once,
+all the threads sharing it can call the API. Limits are set per endpoint
+family (content_items, collections, sections, search, image_services,
+other), with 'default' covering any family not listed::
+
+    from p2p.ratelimit import RateLimiter, TokenBucket
+
+    limiter = RateLimiter(
+        buckets={'default': TokenBucket(rate=20, burst=40),
+                 'search': TokenBucket(rate=2, burst=5)},
+        max_in_flight=10,
+        family_max_in_flight={'search': 2})
+    p2p = P2P(url, token, rate_limiter=limiter)
+
+To keep every worker on a host under one quota, use a `RedisTokenBucket`
+with the same key in each process.
+
+Time spent waiting is recorded in `p2p.metrics` as
+`ratelimit_wait.<family>`.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average, and bursts of up to
+    `burst` requests.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+
+    def _reserve(self, tokens):
+        """
+        Take `tokens` if they're available. Otherwise return how many
+        seconds until they will be.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Block until we're allowed to make a request. Returns the number of
+        seconds we waited.
+        """
+        waited = 0.0
+        while True:
+            wait = self._reserve(tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    A token bucket that lives in Redis, so it can be shared by every
+    process that uses the same `key`.
+    """
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local requested = tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= requested then
+        tokens = tokens - requested
+    else
+        wait = (requested - tokens) / rate
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, rate, burst=None, key='p2p_ratelimit',
+                 host='localhost', port=6379, db=0, client=None):
+        super(RedisTokenBucket, self).__init__(rate, burst)
+        if client is None:
+            import redis
+            client = redis.StrictRedis(host=host, port=port, db=db)
+        self.key = key
+        self.r = client
+        self._script = self.r.register_script(self.SCRIPT)
+
+    def _reserve(self, tokens):
+        return float(self._script(
+            keys=[self.key],
+            args=[self.rate, self.burst, time.time(), tokens]))
+
+
+class RateLimiter(object):
+    """
+    Combines token buckets and max-in-flight limits for each endpoint
+    family. Share one between everything that should share a quota.
+    """
+    def __init__(self, buckets=None, max_in_flight=None,
+                 family_max_in_flight=None):
+        self.buckets = buckets or dict()
+        self.in_flight = None
+        if max_in_flight:
+            self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.family_in_flight = dict(
+            (k, threading.BoundedSemaphore(v))
+            for k, v in (family_max_in_flight or dict()).items())
+
+    def _get(self, d, family):
+        return d.get(family, d.get('default'))
+
+    @contextmanager
+    def limit(self, family):
+        """
+        Wait for our turn to call an endpoint in `family`, and hold a
+        request slot until the block is done.
+        """
+        bucket = self._get(self.buckets, family)
+        if bucket is not None:
+            bucket.acquire()
+
+        sems = [s for s in (self._get(self.family_in_flight, family),
+                            self.in_flight) if s is not None]
+        for s in sems:
+            s.acquire()
+        try:
+            yield
+        finally:
+            for s in reversed(sems):
+                s.release()
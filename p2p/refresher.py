@@ -0,0 +1,142 @@
+"""
+Collection Refresher
+--------------------
+Keep fancy collections fresh from P2P's notifications, instead of
+refetching every collection on a timer::
+
+    refresher = CollectionRefresher(get_connection(),
+                                    ['chi_homepage_top', 'chi_news_local'])
+    refresher.prime()
+    refresher.listen('homepage_refresher')
+
+When a content item in one of the collections changes, only that item
+is refetched into the cache. When a collection changes, only its layout
+is refetched, and then only the content items that are new to it.
+`get_fancy_collection` builds collections out of the cache, so it picks
+up the changes without going back to the API.
+"""
+import logging
+import threading
+
+log = logging.getLogger('p2p')
+
+
+class CollectionRefresher(object):
+    def __init__(self, p2p, collections, limit_items=25,
+                 content_item_query=None):
+        self.p2p = p2p
+        self.collections = list(collections)
+        self.limit_items = limit_items
+        self.content_item_query = content_item_query
+
+        self._lock = threading.Lock()
+        # collection code -> content item ids in its layout
+        self.layout_ids = dict()
+        # content item id or slug -> codes of collections it's in
+        self.item_collections = dict()
+
+    def _track(self, code, layout):
+        items = layout['items']
+        if self.limit_items:
+            items = items[:self.limit_items]
+        ids = [item['contentitem_id'] for item in items]
+
+        with self._lock:
+            old_ids = self.layout_ids.get(code, [])
+            for key in self.item_collections.keys():
+                self.item_collections[key].discard(code)
+                if not self.item_collections[key]:
+                    del self.item_collections[key]
+            for item in items:
+                for key in (item['contentitem_id'], item.get('slug')):
+                    if key is not None:
+                        self.item_collections.setdefault(
+                            key, set()).add(code)
+            self.layout_ids[code] = ids
+        return [id for id in ids if id not in old_ids]
+
+    def prime(self):
+        """
+        Fetch every collection, fresh, and remember what's in it.
+        """
+        for code in self.collections:
+            layout = self.p2p.get_fancy_collection(
+                code, limit_items=self.limit_items,
+                content_item_query=self.content_item_query,
+                force_update=True)
+            self._track(code, layout)
+
+    def collections_for_item(self, message):
+        with self._lock:
+            codes = set()
+            for key in (message.get('id'), message.get('slug')):
+                if key is not None:
+                    codes.update(self.item_collections.get(key, ()))
+                    try:
+                        codes.update(self.item_collections.get(int(key), ()))
+                    except (TypeError, ValueError):
+                        pass
+            return codes
+
+    def refresh_content_item(self, message):
+        """
+        A content item changed. If it's in one of our collections,
+        refetch it into the cache. Deleted items are dropped from their
+        collections' layouts.
+        """
+        codes = self.collections_for_item(message)
+        if not codes:
+            return
+        if message.get('action') == 'D':
+            for code in codes:
+                self.refresh_collection({'code': code})
+            return
+
+        id = message.get('id')
+        if id is not None:
+            self.p2p.get_multi_content_items(
+                [int(id)], query=self.content_item_query, force_update=True)
+        else:
+            self.p2p.get_content_item(
+                message['slug'], query=self.content_item_query,
+                force_update=True)
+        self.p2p.metrics.incr('refresher.content_items')
+
+    def refresh_collection(self, message):
+        """
+        A collection changed. Refetch its layout, then fetch any content
+        items that weren't in it before.
+        """
+        code = message.get('code')
+        if code not in self.layout_ids:
+            return
+        layout = self.p2p.get_collection_layout(code, force_update=True)
+        new_ids = self._track(code, layout)
+        if new_ids:
+            # items already in the cache are left alone
+            self.p2p.get_multi_content_items(
+                new_ids, query=self.content_item_query)
+        self.p2p.metrics.incr('refresher.collections')
+        self.p2p.metrics.incr('refresher.new_content_items', len(new_ids))
+
+    def __call__(self, message):
+        """
+        Handle a notification. Use the refresher as the callback of
+        `p2p.notifications.start_listening`.
+        """
+        try:
+            if 'code' in message:
+                self.refresh_collection(message)
+            else:
+                self.refresh_content_item(message)
+        except Exception:
+            log.exception("Couldn't refresh from notification %s" % message)
+            self.p2p.metrics.incr('refresher.errors')
+
+    def listen(self, name, amqp_url=None, product_code=None):
+        """
+        Subscribe to P2P notifications and refresh from them. Runs
+        forever.
+        """
+        from notifications import start_listening
+        start_listening(name, self, amqp_url, product_code)
@@ -0,0 +1,202 @@
+"""
+Retry and circuit breaker policies for the P2P HTTP layer.
+
+A P2P object retries failed requests according to its `retry_policy`,
+and stops calling an endpoint that keeps failing with a per-endpoint
+`CircuitBreaker`::
+
+    from p2p.resilience import RetryPolicy, CircuitBreakerRegistry
+
+    p2p = P2P(url, token,
+              retry_policy=RetryPolicy(max_retries=5),
+              circuit_breakers=CircuitBreakerRegistry(failure_threshold=3))
+
+Pass `RetryPolicy(max_retries=0)` to turn retries off.
+"""
+from collections import deque
+import threading
+import time
+
+import utils
+
+# PUTs aren't here: prepend, insert and suppress are PUTs that do
+# something again every time. Calls that are safe to repeat pass
+# idempotent=True.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE', 'OPTIONS')
+
+
+class RetryBudget(object):
+    """
+    Caps retries to a fraction of recent requests, so a struggling API
+    doesn't get hammered with retries on top of regular traffic.
+
+    Within any `window` seconds we allow `min_retries` retries, plus
+    `ratio` retries for every request made.
+    """
+    def __init__(self, ratio=0.2, min_retries=10, window=10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._lock = threading.Lock()
+        self._requests = deque()
+        self._retries = deque()
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        for q in (self._requests, self._retries):
+            while q and q[0] < cutoff:
+                q.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._requests.append(now)
+
+    def can_retry(self):
+        """
+        Take a retry out of the budget. Returns False if it's empty.
+        """
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            allowed = self.min_retries + self.ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Decides if and when a failed request should be tried again.
+
+    Idempotent requests are retried on connection errors and on any of
+    `retry_statuses`. Other requests (POST) are only retried when the API
+    tells us it didn't process them (429 Too Many Requests).
+    """
+    def __init__(self, max_retries=3, backoff_base=0.5, backoff_cap=10.0,
+                 retry_statuses=(429, 502, 503, 504),
+                 respect_retry_after=True, max_retry_after=60.0,
+                 budget=None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_statuses = retry_statuses
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_retry_after
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+
+    def should_retry(self, attempt, idempotent, status=None, error=None):
+        """
+        Should we retry after `attempt` retries already? Pass the response
+        `status`, or the connection `error` if there's no response.
+        """
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            retryable = idempotent
+        elif status == 429:
+            retryable = True
+        else:
+            retryable = idempotent and status in self.retry_statuses
+        if not retryable:
+            return False
+        return self.budget is None or self.budget.can_retry()
+
+    def delay(self, attempt, retry_after=None):
+        """
+        How many seconds to wait before retry number `attempt`.
+        """
+        delay = utils.backoff_delay(
+            attempt, self.backoff_base, self.backoff_cap)
+        if self.respect_retry_after and retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to an endpoint after `failure_threshold` failures in a
+    row. After `reset_timeout` seconds one trial call is let through; if
+    it works the circuit closes again, otherwise it stays open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        """
+        Can we make a call right now?
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                # let a single trial call through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def cancel_trial(self):
+        """
+        The trial call failed before it got to the endpoint, so it tells
+        us nothing. Let the next call be the trial.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        """
+        Returns True if this failure opened the circuit.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+class CircuitBreakerRegistry(object):
+    """
+    Hands out one CircuitBreaker per endpoint.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.breakers = dict()
+
+    def get(self, endpoint):
+        with self._lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = self.breakers[endpoint] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def open_circuits(self):
+        return [k for k, b in self.breakers.items()
+                if b.state != CircuitBreaker.CLOSED]
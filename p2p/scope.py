@@ -0,0 +1,98 @@
+"""
+Request scopes
+--------------
+Rendering a page asks for the same content items over and over. Inside
+a request scope, every content item we get is remembered until the
+scope ends, so asking again costs nothing::
+
+    with p2p.request_scope() as scope:
+        collection = p2p.get_fancy_collection('chi_homepage_top')
+        story = p2p.get_content_item('chi-my-story')  # maybe remembered
+
+Content items can also be loaded lazily. `load` returns right away,
+and the first time any of the loaded items is needed, all of them are
+fetched with one `get_multi_content_items` call::
+
+    with p2p.request_scope() as scope:
+        items = [scope.load(id) for id in ids]
+        other = scope.load(other_id)
+        items[0].get()  # fetches everything above at once
+
+Remembered items aren't copied, so don't change them, or copy them
+first.
+"""
+from collections import OrderedDict
+import utils
+
+
+class Deferred(object):
+    """
+    A content item that's fetched when you `get` it.
+    """
+    def __init__(self, scope, id, query):
+        self.scope = scope
+        self.key = scope._key(id, query)
+
+    def get(self):
+        if self.key not in self.scope._by_id:
+            self.scope.dispatch()
+        return self.scope._by_id.get(self.key)
+
+
+class RequestScope(object):
+    def __init__(self, p2p):
+        self.p2p = p2p
+        # (id or slug, query key) -> content item, None if it's missing
+        self._by_id = dict()
+        self._by_slug = dict()
+        # (id, query key) -> (id, query) waiting for dispatch
+        self._pending = OrderedDict()
+
+    def _key(self, ident, query):
+        return (ident, utils.dict_to_qs(query) if query else '')
+
+    def get(self, slug=None, id=None, query=None):
+        """
+        A remembered content item, or None.
+        """
+        if slug:
+            return self._by_slug.get(self._key(slug, query))
+        return self._by_id.get(self._key(id, query))
+
+    def remember(self, content_item, query=None):
+        self._by_id[self._key(content_item['id'], query)] = content_item
+        self._by_slug[self._key(content_item['slug'], query)] = content_item
+
+    def missing(self, ids, query=None):
+        """
+        Which of these ids we don't have yet.
+        """
+        return [id for id in ids if self._key(id, query) not in self._by_id]
+
+    def load(self, id, query=None):
+        """
+        Ask for a content item by id, to be fetched with the others on
+        the first `get`.
+        """
+        if not query:
+            query = self.p2p._default_query()
+        key = self._key(id, query)
+        if key not in self._by_id:
+            self._pending[key] = (id, query)
+        return Deferred(self, id, query)
+
+    def dispatch(self):
+        """
+        Fetch everything that's been loaded, one call per query.
+        """
+        by_query = OrderedDict()
+        for key, (id, query) in self._pending.items():
+            by_query.setdefault(key[1], (query, []))[1].append(id)
+        self._pending.clear()
+
+        for query, ids in by_query.values():
+            self.p2p.get_multi_content_items(ids, query=query)
+            for id in ids:
+                # remember what's missing, so we don't ask again
+                self._by_id.setdefault(self._key(id, query), None)
+            self.p2p.metrics.incr('scope.batches')
@@ -0,0 +1,202 @@
+"""
+A tiny local stand-in for the Content Services API, for tests and
+benchmarks that can't talk to the real thing.
+
+Start it, point a P2P object at it, and tell it what to break::
+
+    server = StubServer()
+    server.start()
+    server.routes['/content_items/chi-na-lorem-a.json'] = (
+        200, {'content_item': {...}})
+    server.inject(503, times=2)
+    p2p = P2P(server.url, 'token')
+    ...
+    server.stop()
+
+It can also replay fixtures, a dictionary of content items,
+collections, collection layouts and sections (see `load_fixtures`),
+with some latency and a random error rate to make things realistic::
+
+    server = StubServer(latency=0.02, error_rate=0.01)
+    server.load_fixtures(json.load(open('fixtures.json')))
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import deque
+from StringIO import StringIO
+import gzip
+import json
+import random
+import threading
+import time
+import urlparse
+
+DROP = 'drop'
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the default of 5 makes concurrent clients wait a second to connect
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        stub = self.server.stub
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else None
+
+        status, headers, payload = stub.respond(
+            self.command, self.path, body)
+        if status == DROP:
+            # close the socket without answering
+            self.close_connection = 1
+            return
+
+        if not isinstance(payload, basestring):
+            payload = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if stub.compress and 'gzip' in (
+                self.headers.getheader('accept-encoding') or ''):
+            out = StringIO()
+            with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(payload)
+            payload = out.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class StubServer(object):
+    """
+    Serves canned JSON responses from `routes`, a dictionary of url
+    path (without the query string) to `(status, payload)` or
+    `(status, payload, headers)`. Every request is recorded in `requests`.
+
+    Faults queued with `inject` are served, in order, before any route.
+    Every response is delayed by `latency` seconds (or a random amount
+    between the two values of a `(min, max)` tuple), and a fraction
+    `error_rate` of requests get a 503. With `compress=True`, responses
+    are gzipped for clients that accept it.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 compress=False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.compress = compress
+        self.routes = dict()
+        self.requests = list()
+        self._faults = deque()
+        self._lock = threading.Lock()
+        self.httpd = _ThreadedHTTPServer((host, port), _Handler)
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def inject(self, status, payload=None, headers=None, times=1):
+        """
+        Serve `status` for the next `times` requests. Use `DROP` as the
+        status to close the connection without a response.
+        """
+        if payload is None:
+            payload = {'error': 'injected fault'}
+        with self._lock:
+            for i in range(times):
+                self._faults.append((status, headers or {}, payload))
+
+    def respond(self, method, path, body):
+        if self.latency:
+            if isinstance(self.latency, tuple):
+                time.sleep(random.uniform(*self.latency))
+            else:
+                time.sleep(self.latency)
+
+        with self._lock:
+            self.requests.append((method, path, body))
+            if self._faults:
+                return self._faults.popleft()
+
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {}, {'error': 'random fault'}
+
+        route = self.routes.get(path.split('?', 1)[0])
+        if route is None:
+            return 404, {}, {'error': 'not found'}
+        if callable(route):
+            route = route(method, path, body)
+        if len(route) == 2:
+            return route[0], {}, route[1]
+        return route[0], route[2], route[1]
+
+    def load_fixtures(self, fixtures):
+        """
+        Serve the API from a dictionary of fixtures::
+
+            {'content_items': [content_item, ...],
+             'collections': [collection, ...],
+             'collection_layouts': [collection_layout, ...],
+             'sections': {path: section, ...}}
+
+        Content items are served by slug and through multi.json,
+        collections and layouts by code, and sections by path.
+        """
+        by_id = dict()
+        for ci in fixtures.get('content_items', []):
+            by_id[ci['id']] = ci
+            self.routes['/content_items/%s.json' % ci['slug']] = (
+                200, {'content_item': ci})
+
+        for c in fixtures.get('collections', []):
+            self.routes['/collections/%s.json' % c['code']] = (
+                200, {'collection': c})
+
+        for cl in fixtures.get('collection_layouts', []):
+            self.routes['/current_collections/%s.json' % cl['code']] = (
+                200, {'collection_layout': cl})
+
+        sections = fixtures.get('sections', {})
+
+        def multi(method, path, body):
+            ret = list()
+            for item in json.loads(body)['content_items']:
+                ci = by_id.get(item['id'])
+                if ci is None:
+                    ret.append({'id': item['id'], 'status': 404})
+                else:
+                    ret.append({'id': item['id'], 'status': 200,
+                                'body': {'content_item': ci}})
+            return 200, ret
+
+        def section(method, path, body):
+            query = urlparse.parse_qs(urlparse.urlparse(path).query)
+            data = sections.get(query.get('section_path', [None])[0])
+            if data is None:
+                return 404, {'error': 'not found'}
+            return 200, data
+
+        self.routes['/content_items/multi.json'] = multi
+        self.routes['/sections/show_collections.json'] = section
@@ -0,0 +1,267 @@
+"""
+P2P Sync
+--------
+Keep a local copy of content items up to date, so reads don't have to
+go to the API::
+
+    store = SQLiteStore('/var/lib/my_app/p2p.db')
+    syncer = Syncer(get_connection(), store, query={
+        'conditions': {'product_affiliate_code': 'chinews'}})
+    syncer.run('my_app_sync')
+
+    store.get_content_item(slug='chi-my-story')
+
+The first run backfills the store by paging through search results
+modified since the beginning of time, and fetching the items with
+`get_multi_content_items`. After that, notifications from the
+messaging server update or delete items as they change, and every
+`reconcile_every` seconds a sweep fetches everything modified since the
+high-water mark, in case we missed a notification. The high-water mark
+is kept in the store, so a restart picks up where we left off.
+
+A store is anything with the methods of `SQLiteStore`.
+"""
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+import time
+
+import utils
+
+log = logging.getLogger('p2p')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class SQLiteStore(object):
+    """
+    Stores content items, and the sync state, in a SQLite database.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS p2p_content_items ("
+                "id INTEGER PRIMARY KEY, slug TEXT UNIQUE, data TEXT, "
+                "last_modified_time TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS p2p_sync_state ("
+                "key TEXT PRIMARY KEY, value TEXT)")
+
+    def save_content_items(self, content_items):
+        rows = [(ci['id'], ci['slug'], utils.to_json(ci),
+                 utils.formatdate(modified_time(ci)))
+                for ci in content_items]
+        with self._lock:
+            with self.conn:
+                # a slug can move to a new item
+                self.conn.executemany(
+                    "DELETE FROM p2p_content_items "
+                    "WHERE slug = ? AND id != ?",
+                    [(row[1], row[0]) for row in rows])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO p2p_content_items "
+                    "(id, slug, data, last_modified_time) "
+                    "VALUES (?, ?, ?, ?)", rows)
+
+    def delete_content_item(self, slug=None, id=None):
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM p2p_content_items WHERE id = ? OR slug = ?",
+                    (id, slug))
+
+    def get_content_item(self, slug=None, id=None):
+        if slug:
+            where, arg = "slug = ?", slug
+        elif id:
+            where, arg = "id = ?", id
+        else:
+            raise TypeError("get_content_item() takes either a slug or id "
+                            "keyword argument")
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data FROM p2p_content_items WHERE " + where,
+                (arg,)).fetchone()
+        if row is None:
+            return None
+        return utils.parse_response(json.loads(row[0]))
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM p2p_content_items").fetchone()[0]
+
+    def get_state(self, key):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM p2p_sync_state WHERE key = ?",
+                (key,)).fetchone()
+        return row and row[0]
+
+    def set_state(self, key, value):
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO p2p_sync_state (key, value) "
+                    "VALUES (?, ?)", (key, value))
+
+
+class Syncer(object):
+    def __init__(self, p2p, store, query=None, content_item_query=None,
+                 per_page=100, batch_size=25, overlap=60,
+                 reconcile_every=900):
+        self.p2p = p2p
+        self.store = store
+        self.query = query
+        self.content_item_query = content_item_query
+        self.per_page = per_page
+        self.batch_size = batch_size
+        # how far before the high-water mark a sweep starts, for clock
+        # skew and items saved while we were sweeping
+        self.overlap = overlap
+        self.reconcile_every = reconcile_every
+        self._stopped = threading.Event()
+
+    @property
+    def high_water_mark(self):
+        value = self.store.get_state('high_water_mark')
+        if value is None:
+            return None
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+    def sync_since(self, since):
+        """
+        Fetch and store everything modified since the datetime `since`,
+        and move the high-water mark up as we go. Returns how many
+        content items we stored.
+        """
+        # Everything before where the sweep has got to is stored, but an
+        # item edited while we're sweeping can come up early, so the mark
+        # only goes as far as the sweep until it's done
+        start = self.high_water_mark or EPOCH
+        newest = start
+        count = 0
+        ids = list()
+        for ci in self.p2p.search_modified_since(
+                since, query=self.query, per_page=self.per_page):
+            ids.append(ci['id'])
+            modified = modified_time(ci)
+            newest = max(newest, modified)
+            if len(ids) == self.per_page:
+                count += self._fetch(ids, max(start, modified))
+                ids = list()
+        count += self._fetch(ids, newest)
+        return count
+
+    def _fetch(self, ids, mark):
+        for i in range(0, len(ids), self.batch_size):
+            items = self.p2p.get_multi_content_items(
+                ids[i:i + self.batch_size], query=self.content_item_query,
+                force_update=True)
+            self.store.save_content_items(items)
+        if mark > EPOCH:
+            # only once everything before it is stored
+            self.store.set_state('high_water_mark', utils.formatdate(mark))
+        self.p2p.metrics.incr('sync.content_items', len(ids))
+        return len(ids)
+
+    def backfill(self):
+        """
+        Store every content item there is.
+        """
+        start = time.time()
+        count = self.sync_since(EPOCH)
+        self.p2p.metrics.timing('sync.backfill', time.time() - start)
+        log.info('Backfilled %s content items' % count)
+        return count
+
+    def reconcile(self):
+        """
+        Store everything modified since the high-water mark, or backfill
+        if we've never synced.
+        """
+        mark = self.high_water_mark
+        if mark is None:
+            return self.backfill()
+        start = time.time()
+        count = self.sync_since(mark - timedelta(seconds=self.overlap))
+        self.p2p.metrics.timing('sync.reconcile', time.time() - start)
+        return count
+
+    def __call__(self, message):
+        """
+        Apply a notification. Use the syncer as the callback of
+        `p2p.notifications.start_listening`.
+        """
+        if 'code' in message:
+            # we only mirror content items
+            return
+        try:
+            if message.get('action') == 'D':
+                self.store.delete_content_item(
+                    slug=message.get('slug'), id=message.get('id'))
+                self.p2p.metrics.incr('sync.deletes')
+                return
+            if message.get('id') is not None:
+                items = self.p2p.get_multi_content_items(
+                    [int(message['id'])], query=self.content_item_query,
+                    force_update=True)
+            else:
+                items = [self.p2p.get_content_item(
+                    message['slug'], query=self.content_item_query,
+                    force_update=True)]
+            self.store.save_content_items(items)
+            self.p2p.metrics.incr('sync.updates')
+        except Exception:
+            log.exception("Couldn't sync from notification %s" % message)
+            self.p2p.metrics.incr('sync.errors')
+
+    def _reconcile_forever(self):
+        while not self._stopped.wait(self.reconcile_every):
+            try:
+                self.reconcile()
+            except Exception:
+                log.exception("Couldn't reconcile")
+                self.p2p.metrics.incr('sync.errors')
+
+    def run(self, name, amqp_url=None, product_code=None,
+            **listener_options):
+        """
+        Catch up, then keep the store in sync from notifications and
+        sweeps until interrupted.
+        """
+        from notifications import start_listening
+        self.reconcile()
+        self._stopped.clear()
+        t = threading.Thread(target=self._reconcile_forever)
+        t.daemon = True
+        t.start()
+        # notifications wait for us while we're restarting
+        listener_options.setdefault('durable', True)
+        try:
+            start_listening(name, self, amqp_url, product_code,
+                            **listener_options)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def modified_time(content_item):
+    """
+    When a content item was last modified, as a naive UTC datetime.
+    """
+    value = content_item.get('last_modified_time')
+    if isinstance(value, basestring):
+        value = utils.parsedate(value)
+    if value is None:
+        return EPOCH
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
@@ -1,11 +1,39 @@
 #! /usr/bin/env python
 import unittest
 
-from __init__ import get_connection
-from auth import authenticate, P2PAuthError
+from __init__ import get_connection, P2P, P2PNotFound, P2PCircuitOpen
+from auth import authenticate, P2PAuthError, TTLCache
+import auth
+from resilience import RetryPolicy, RetryBudget, CircuitBreakerRegistry
+from ratelimit import RateLimiter, TokenBucket
+from metrics import StatsdHooks
+import benchmarks
+from warmer import CacheWarmer
+from refresher import CollectionRefresher
+from notifications import Listener, Coalescer, Supervisor, shard_for
+from kombu import Connection, Exchange, Producer
+from stubserver import StubServer, DROP
+from command import run_batch
+from exporter import Exporter, JSONLinesWriter, SQLiteWriter
+from sync import Syncer, SQLiteStore
 import cache
+import utils
+from copy import deepcopy
+from datetime import datetime
+import requests
+import threading
+import time
 import inspect
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+from StringIO import StringIO
 import sys
+import tempfile
+import urllib
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
@@ -84,14 +112,17 @@ class TestP2P(unittest.TestCase):
         test_backends = ('DictionaryCache', 'DjangoCache', 'RedisCache')
         cache_backends = list()
         for backend in test_backends:
-            if hasattr(cache, backend):
-                cache_backends.append(getattr(cache, backend))
+            # backends import their libraries when they're created
+            try:
+                cache_backends.append(getattr(cache, backend)())
+            except ImportError:
+                pass
 
         content_item_ids = [
             58253183, 56809651, 56810874, 56811192, 58253247]
 
-        for cls in cache_backends:
-            self.p2p.cache = cls()
+        for c in cache_backends:
+            self.p2p.cache = c
             data = self.p2p.get_multi_content_items(ids=content_item_ids)
             data = self.p2p.get_content_item(self.content_item_slug)
             stats = self.p2p.cache.get_stats()
@@ -168,6 +199,1743 @@ class TestP2P(unittest.TestCase):
         #pp.pprint(data)
 
 
+class FakeUpsertP2P(P2P):
+    """
+    P2P client that records write calls instead of making them
+    """
+    def __init__(self, existing=()):
+        super(FakeUpsertP2P, self).__init__('http://p2p.invalid', 'token')
+        self.existing = set(existing)
+        self.calls = []
+
+    def put_json(self, url, data, idempotent=False):
+        self.calls.append(('PUT', url))
+        slug = url.split('/')[-1][:-len('.json')]
+        if slug not in self.existing:
+            raise P2PNotFound('not found')
+        return {}
+
+    def post_json(self, url, data, idempotent=False):
+        self.calls.append(('POST', url))
+        self.existing.add(data['content_item']['slug'])
+        return {}
+
+
+class TestUpsert(unittest.TestCase):
+    def test_update_existing(self):
+        p2p = FakeUpsertP2P(existing=['chi-existing'])
+        create, resp = p2p.create_or_update_content_item(
+            {'slug': 'chi-existing', 'title': 'hi'})
+        self.assertFalse(create)
+        self.assertEqual(p2p.calls, [('PUT', '/content_items/chi-existing.json')])
+
+    def test_create_new_without_sleep(self):
+        p2p = FakeUpsertP2P()
+        create, resp = p2p.create_or_update_content_item(
+            {'slug': 'chi-new', 'title': 'hi'})
+        self.assertTrue(create)
+        self.assertEqual(p2p.calls, [
+            ('PUT', '/content_items/chi-new.json'),
+            ('POST', '/content_items.json')])
+
+    def test_known_missing_goes_straight_to_create(self):
+        p2p = FakeUpsertP2P()
+        p2p._remember_slug('chi-new', False)
+        create, resp = p2p.create_or_update_content_item({'slug': 'chi-new'})
+        self.assertTrue(create)
+        self.assertEqual(p2p.calls, [('POST', '/content_items.json')])
+
+        # now it exists, so the next save is an update
+        create, resp = p2p.create_or_update_content_item({'slug': 'chi-new'})
+        self.assertFalse(create)
+
+    def test_retry_when_throttled(self):
+        server = StubServer().start()
+        try:
+            p2p = P2P(server.url, 'token', retry_policy=RetryPolicy(
+                backoff_base=0.001))
+            p2p._remember_slug('chi-new', False)
+            server.routes['/content_items.json'] = (201, {})
+            server.inject(429, headers={'Retry-After': '0'}, times=2)
+            create, resp = p2p.create_or_update_content_item(
+                {'slug': 'chi-new'})
+            self.assertTrue(create)
+            self.assertEqual(len(server.requests), 3)
+        finally:
+            server.stop()
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.routes['/content_items/chi-na-lorem-a.json'] = (
+            200, {'content_item': {'id': 1, 'slug': 'chi-na-lorem-a'}})
+        self.p2p = P2P(
+            self.server.url, 'token',
+            retry_policy=RetryPolicy(max_retries=2, backoff_base=0.001),
+            circuit_breakers=CircuitBreakerRegistry(
+                failure_threshold=3, reset_timeout=60),
+            max_stale_bytes=1024 * 1024)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry_server_errors(self):
+        self.server.inject(503, times=2)
+        data = self.p2p.get('/content_items/chi-na-lorem-a.json')
+        self.assertEqual(data['content_item']['id'], 1)
+        self.assertEqual(
+            self.p2p.metrics.snapshot()['counters']['retries.content_items'],
+            2)
+
+    def test_retry_dropped_connection(self):
+        self.server.inject(DROP)
+        data = self.p2p.get('/content_items/chi-na-lorem-a.json')
+        self.assertEqual(data['content_item']['id'], 1)
+
+    def test_give_up(self):
+        self.server.inject(502, times=3)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.p2p.get('/content_items/chi-na-lorem-a.json')
+
+    def test_post_not_retried(self):
+        self.server.inject(503)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.p2p.post_json('/content_items.json', {})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_prepend_not_retried(self):
+        self.server.routes['/collections/prepend.json'] = (200, {})
+        self.server.inject(502, times=2)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.p2p.push_into_collection('chi_collection', ['chi-a'])
+        self.assertEqual(len(self.server.requests), 1)
+
+        # plain updates are safe to retry
+        self.server.routes['/content_items/chi-a.json'] = (200, {})
+        self.server.inject(502)
+        self.p2p.update_content_item({'slug': 'chi-a', 'title': 'A'})
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_circuit_breaker_serves_stale(self):
+        url = '/content_items/chi-na-lorem-a.json'
+        self.p2p.get(url)
+
+        # 3 failures in a row opens the circuit...
+        self.server.inject(503, times=3)
+        data = self.p2p.get(url)
+        self.assertEqual(data['content_item']['id'], 1)
+        self.assertEqual(
+            self.p2p.circuit_breakers.open_circuits(), ['content_items'])
+
+        # ...and then we stop calling the API
+        num_requests = len(self.server.requests)
+        data = self.p2p.get(url)
+        self.assertEqual(data['content_item']['id'], 1)
+        self.assertEqual(len(self.server.requests), num_requests)
+
+        with self.assertRaises(P2PCircuitOpen):
+            self.p2p.get('/content_items/chi-na-lorem-b.json')
+
+    def test_unexpected_error_doesnt_trip_circuit(self):
+        url = '/content_items/chi-na-lorem-a.json'
+        breaker = self.p2p.circuit_breakers.get('content_items')
+        send = self.p2p._send
+
+        def broken(*args, **kwargs):
+            # our own code, not the endpoint, blowing up
+            raise RuntimeError('boom')
+
+        self.p2p._send = broken
+        for i in range(breaker.failure_threshold + 1):
+            with self.assertRaises(RuntimeError):
+                self.p2p.get(url)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+        self.p2p._send = send
+        breaker.reset_timeout = 0
+        self.server.inject(503, times=3)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.p2p.get(url)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # a trial call that blows up doesn't leave it half open
+        self.p2p._send = broken
+        with self.assertRaises(RuntimeError):
+            self.p2p.get(url)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # once the server's back, the next trial closes it
+        self.p2p._send = send
+        self.assertEqual(self.p2p.get(url)['content_item']['id'], 1)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_stale_responses_bounded(self):
+        self.assertEqual(P2P(self.server.url, 'token').max_stale_bytes, 0)
+
+        self.p2p.max_stale_bytes = 200
+        for i in range(10):
+            self.server.routes['/content_items/chi-%d.json' % i] = (
+                200, {'content_item': {'id': i, 'title': 'x' * 50}})
+            self.p2p.get('/content_items/chi-%d.json' % i)
+        self.assertTrue(self.p2p._stale_bytes <= 200)
+        self.assertEqual(self.p2p._stale_bytes,
+                         sum(len(v) for v in self.p2p._stale.values()))
+        self.assertTrue('/content_items/chi-9.json' in self.p2p._stale)
+        self.assertFalse('/content_items/chi-0.json' in self.p2p._stale)
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0, min_retries=1)
+        self.assertTrue(budget.can_retry())
+        self.assertFalse(budget.can_retry())
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, burst=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+
+        start = time.time()
+        waited = bucket.acquire()
+        self.assertTrue(waited > 0)
+        self.assertTrue(time.time() - start >= 0.009)
+
+    def test_max_in_flight(self):
+        limiter = RateLimiter(
+            max_in_flight=3, family_max_in_flight={'search': 1})
+        lock = threading.Lock()
+        state = {'search': 0, 'all': 0, 'max_search': 0, 'max_all': 0}
+
+        def worker(family):
+            with limiter.limit(family):
+                with lock:
+                    state[family] = state.get(family, 0) + 1
+                    state['all'] += 1
+                    state['max_search'] = max(
+                        state['max_search'], state['search'])
+                    state['max_all'] = max(state['max_all'], state['all'])
+                time.sleep(0.01)
+                with lock:
+                    state[family] -= 1
+                    state['all'] -= 1
+
+        threads = [threading.Thread(target=worker, args=(family,))
+                   for family in ['search', 'content_items'] * 5]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state['max_search'], 1)
+        self.assertTrue(state['max_all'] <= 3)
+
+    def test_client_records_wait(self):
+        server = StubServer().start()
+        try:
+            server.routes['/sections/show_collections.json'] = (200, {})
+            p2p = P2P(server.url, 'token', rate_limiter=RateLimiter(
+                buckets={'sections': TokenBucket(rate=100, burst=1)}))
+            p2p.get_section('/news')
+            p2p.get_section('/news')
+            timing = p2p.metrics.snapshot()['timings'][
+                'ratelimit_wait.sections']
+            self.assertEqual(timing['count'], 2)
+            self.assertTrue(timing['total'] > 0)
+        finally:
+            server.stop()
+
+
+
+class FakeStatsd(object):
+    def __init__(self):
+        self.counters = dict()
+        self.timings = dict()
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def timing(self, name, ms):
+        self.timings.setdefault(name, []).append(ms)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.routes['/content_items/chi-na-lorem-a.json'] = (
+            200, {'content_item': {'id': 1, 'slug': 'chi-na-lorem-a'}})
+        self.p2p = P2P(self.server.url, 'token',
+                       cache=cache.DictionaryCache())
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_request_hooks(self):
+        events = []
+        self.p2p.add_hook('before_request', lambda i: events.append(
+            ('before', dict(i))))
+        self.p2p.add_hook('after_request', lambda i: events.append(
+            ('after', dict(i))))
+        self.p2p.get('/content_items/chi-na-lorem-a.json')
+
+        self.assertEqual([e[0] for e in events], ['before', 'after'])
+        info = events[1][1]
+        self.assertEqual(info['endpoint'], 'content_items')
+        self.assertEqual(info['status'], 200)
+        self.assertTrue(info['bytes'] > 0)
+        for phase in ('ttfb', 'total', 'decode', 'parse'):
+            self.assertTrue(info[phase] >= 0)
+
+    def test_statsd_hooks(self):
+        statsd = FakeStatsd()
+        StatsdHooks(statsd).install(self.p2p)
+        self.p2p.get_content_item('chi-na-lorem-a', force_update=True)
+        self.p2p.get_content_item('chi-na-lorem-a')
+
+        self.assertEqual(
+            statsd.counters['p2p.content_items.status.200'], 1)
+        self.assertEqual(
+            statsd.counters['p2p.cache.content_item.hits'], 1)
+        self.assertIn('p2p.content_items.total', statsd.timings)
+
+    def test_bad_hook_doesnt_break_requests(self):
+        def bad_hook(info):
+            raise ValueError
+        self.p2p.add_hook('after_request', bad_hook)
+        data = self.p2p.get('/content_items/chi-na-lorem-a.json')
+        self.assertEqual(data['content_item']['id'], 1)
+
+
+
+class TestCacheStats(unittest.TestCase):
+    def test_stats_are_per_instance(self):
+        c1 = cache.DictionaryCache()
+        c2 = cache.DictionaryCache()
+        c1.save_content_item({'id': 1, 'slug': 'chi-stats-a'})
+        c1.get_content_item(slug='chi-stats-a')
+        c1.get_content_item(slug='chi-stats-missing')
+
+        stats = c1.get_stats()
+        self.assertEqual(stats['content_item_gets'], 2)
+        self.assertEqual(stats['content_item_hits'], 1)
+        self.assertEqual(stats['content_item_misses'], 1)
+        self.assertEqual(stats['content_item_sets'], 1)
+        self.assertEqual(c2.get_stats()['content_item_gets'], 0)
+
+    def test_nocache_counts_misses(self):
+        c = cache.NoCache()
+        c.get_content_item(slug='chi-stats-a')
+        c.get_section('/news')
+        stats = c.get_stats()
+        self.assertEqual(stats['content_item_misses'], 1)
+        self.assertEqual(stats['sections_misses'], 1)
+
+    def test_sections(self):
+        c = cache.DictionaryCache()
+        c.save_section({'collections': []}, path='/news/stats')
+        self.assertEqual(
+            c.get_section('/news/stats'), {'collections': []})
+        self.assertEqual(c.get_stats()['sections_hits'], 1)
+
+    def test_snapshot_reset_and_export(self):
+        c = cache.DictionaryCache()
+        c.save_collection({'id': 5, 'code': 'chi_stats'})
+        c.get_collection(slug='chi_stats')
+
+        snap = c.stats.snapshot()
+        self.assertEqual(snap['collections']['hits'], 1)
+        self.assertEqual(snap['collections']['get_latency']['count'], 1)
+
+        statsd = FakeStatsd()
+        statsd.gauge = lambda name, value: statsd.timing(name, value)
+        c.stats.export(statsd)
+        self.assertEqual(statsd.counters['p2p.cache.collections.hits'], 1)
+        self.assertIn(
+            'p2p.cache.collections.get_latency.p99', statsd.timings)
+        self.assertEqual(c.stats.snapshot()['collections']['gets'], 0)
+
+    def test_thread_safe_counting(self):
+        c = cache.NoCache()
+
+        def worker():
+            for i in range(1000):
+                c.get_content_item(slug='chi-stats-a')
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(c.get_stats()['content_item_gets'], 8000)
+
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_fixture_server(self):
+        fixtures = benchmarks.build_fixtures(num_items=30)
+        server = StubServer()
+        server.load_fixtures(fixtures)
+        server.start()
+        try:
+            p2p = P2P(server.url, 'token')
+            data = p2p.get_fancy_collection(
+                benchmarks.COLLECTION_CODE, with_collection=True)
+            self.assertEqual(len(data['items']), 25)
+            self.assertEqual(data['items'][0]['content_item']['slug'],
+                             'chi-bench-item-0')
+            self.assertEqual(
+                p2p.get_section(benchmarks.SECTION_PATH)['collections'],
+                [benchmarks.COLLECTION_CODE])
+        finally:
+            server.stop()
+
+    def test_run(self):
+        results = benchmarks.run(
+            benchmarks.build_fixtures(num_items=50),
+            scenarios=['parse_response', 'cache_backends'], iterations=2)
+        names = [r['name'] for r in results['results']]
+        self.assertIn('parse_response.50_items', names)
+        self.assertIn('cache.DictionaryCache.get_content_item.100', names)
+        json.dumps(results)
+
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        self.l1 = cache.MemoryCache(max_items=10, ttl=60)
+        self.l2 = cache.MemoryCache(max_items=100, ttl=600)
+        self.cache = cache.TieredCache(self.l2, self.l1)
+        self.item = {'id': 77, 'slug': 'chi-tiered-a', 'title': 'A'}
+
+    def test_write_through_and_fill(self):
+        self.cache.save_content_item(self.item)
+        self.assertEqual(self.l1.get_content_item(id=77), self.item)
+        self.assertEqual(self.l2.get_content_item(slug='chi-tiered-a'),
+                         self.item)
+
+        self.l1.clear()
+        self.assertEqual(
+            self.cache.get_content_item(slug='chi-tiered-a'), self.item)
+        # that read filled the first tier again
+        self.assertEqual(self.l1.get_content_item(slug='chi-tiered-a'),
+                         self.item)
+
+    def test_memory_cache_bounds(self):
+        c = cache.MemoryCache(max_items=4, ttl=60)
+        for i in range(3):
+            c.save_content_item({'id': i, 'slug': 'chi-bounded-%d' % i})
+        # two keys per item, so the first ones got pushed out
+        self.assertIsNone(c.get_content_item(slug='chi-bounded-0'))
+        self.assertIsNotNone(c.get_content_item(slug='chi-bounded-2'))
+        self.assertTrue(c.get_stats()['content_item_evictions'] > 0)
+
+        c = cache.MemoryCache(ttl=-1)
+        c.save_section({}, path='/news')
+        self.assertIsNone(c.get_section('/news'))
+
+    def test_copies(self):
+        self.cache.save_content_item(self.item)
+        ci = self.cache.get_content_item(slug='chi-tiered-a')
+        ci['title'] = 'changed'
+        self.assertEqual(
+            self.cache.get_content_item(slug='chi-tiered-a')['title'], 'A')
+
+    def test_invalidation(self):
+        self.cache.save_content_item(self.item, query={'include': ['a']})
+        self.cache.save_content_item(self.item)
+
+        other = cache.TieredCache(self.l2, cache.MemoryCache())
+        other.get_content_item(id=77)
+        other.handle_invalidation(json.dumps({
+            'origin': 'someone-else', 'kind': 'content_items',
+            'idents': ['chi-tiered-a', 77]}))
+        self.assertIsNone(other.l1.get_content_item(id=77))
+
+        # the notification only has the slug, but copies stored by id
+        # and under other queries go too
+        self.cache.notification_callback(
+            {'action': 'U', 'slug': 'chi-tiered-a'})
+        self.assertIsNone(self.l1.get_content_item(id=77))
+        self.assertIsNone(self.l1.get_content_item(
+            id=77, query={'include': ['a']}))
+        self.assertEqual(self.cache.get_content_item(id=77), self.item)
+
+    def test_aliases_bounded(self):
+        c = cache.MemoryCache(max_items=10)
+        for i in range(2500):
+            c.save_content_item({'id': i, 'slug': 'chi-%d' % i})
+        self.assertEqual(len(c._data), 10)
+        self.assertEqual(len(c._aliases), 10)
+        self.assertEqual(len(c._alias_of), 10)
+        c.invalidate('content_items', 'chi-2499')
+        self.assertEqual(len(c._data), 8)
+        self.assertEqual(len(c._aliases), 8)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'p2p', 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip_between_instances(self):
+        c = cache.DiskCache(self.path)
+        item = {'id': 5, 'slug': 'chi-disk-a', 'title': u'Caf\xe9'}
+        c.save_content_item(item, query={'include': ['web_url']})
+        c.save_collection_layout({'id': 9, 'code': 'chi_disk', 'items': []})
+        c.save_section({'collections': []}, path='/news')
+
+        # a new cache on the same file, like the next run of a job
+        c = cache.DiskCache(self.path)
+        self.assertEqual(c.get_content_item(
+            id=5, query={'include': ['web_url']}), item)
+        self.assertIsNone(c.get_content_item(slug='chi-disk-a'))
+        self.assertEqual(
+            c.get_collection_layout('chi_disk')['id'], 9)
+        self.assertEqual(c.get_section('/news'), {'collections': []})
+
+    def test_ttl(self):
+        c = cache.DiskCache(self.path, ttl=-1)
+        c.save_section({}, path='/news')
+        self.assertIsNone(c.get_section('/news'))
+        c.evict()
+        self.assertEqual(c.get_stats()['sections_evictions'], 1)
+
+    def test_size_bound(self):
+        c = cache.DiskCache(self.path, max_bytes=2000, check_every=1)
+        for i in range(1, 21):
+            c.save_content_item(
+                {'id': i, 'slug': 'chi-disk-%d' % i, 'body': 'x' * 100})
+        self.assertIsNone(c.get_content_item(id=1))
+        self.assertIsNotNone(c.get_content_item(id=20))
+
+    def test_threads(self):
+        c = cache.DiskCache(self.path)
+
+        def worker(n):
+            for i in range(1, 21):
+                c.save_content_item({'id': n * 100 + i,
+                                     'slug': 'chi-disk-%d-%d' % (n, i)})
+                c.get_content_item(id=n * 100 + i)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(c.get_stats()['content_item_hits'], 80)
+
+    def test_processes(self):
+        c = cache.DiskCache(self.path)
+        procs = [multiprocessing.Process(
+            target=_save_disk_items, args=(self.path, n)) for n in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        for n in range(3):
+            for i in range(1, 21):
+                self.assertIsNotNone(c.get_content_item(id=n * 100 + i))
+
+
+def _save_disk_items(path, n):
+    c = cache.DiskCache(path)
+    for i in range(1, 21):
+        c.save_content_item({'id': n * 100 + i,
+                             'slug': 'chi-disk-%d-%d' % (n, i)})
+
+
+
+class TestWarmer(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.server.load_fixtures(benchmarks.build_fixtures(num_items=30))
+        self.server.start()
+        self.p2p = P2P(self.server.url, 'token',
+                       cache=cache.MemoryCache(max_items=1000))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_warm_from_section(self):
+        warmer = CacheWarmer(self.p2p, sections=[benchmarks.SECTION_PATH])
+        self.assertEqual(warmer.run_once(), [benchmarks.COLLECTION_CODE])
+        # one layout request and one multi request for all 25 items
+        paths = [path.split('?')[0] for method, path, body
+                 in self.server.requests]
+        self.assertEqual(paths.count('/content_items/multi.json'), 1)
+
+        num_requests = len(self.server.requests)
+        self.p2p.get_fancy_collection(benchmarks.COLLECTION_CODE)
+        self.assertEqual(len(self.server.requests), num_requests)
+
+        # not due again yet
+        self.assertEqual(warmer.run_once(), [])
+
+    def test_refresh_ahead(self):
+        warmer = CacheWarmer(self.p2p,
+                             collections=[benchmarks.COLLECTION_CODE],
+                             interval=100, refresh_ahead=0.25)
+        start = time.time()
+        warmer.run_once()
+        due = warmer.due[benchmarks.COLLECTION_CODE]
+        self.assertTrue(start + 70 < due <= time.time() + 75)
+
+    def test_errors_are_retried(self):
+        warmer = CacheWarmer(self.p2p, collections=['chi_missing'])
+        self.assertEqual(warmer.run_once(), ['chi_missing'])
+        self.assertNotIn('chi_missing', warmer.due)
+        self.assertEqual(
+            self.p2p.metrics.snapshot()['counters']['warmer.errors'], 1)
+
+
+
+class TestRefresher(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=30)
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.p2p = P2P(self.server.url, 'token',
+                       cache=cache.MemoryCache(max_items=1000))
+        self.refresher = CollectionRefresher(
+            self.p2p, [benchmarks.COLLECTION_CODE])
+        self.refresher.prime()
+        del self.server.requests[:]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def multi_ids(self):
+        ids = []
+        for method, path, body in self.server.requests:
+            if path.startswith('/content_items/multi.json'):
+                ids.extend(i['id'] for i in json.loads(body)['content_items'])
+        return ids
+
+    def test_content_item_update(self):
+        ci = self.fixtures['content_items'][3]
+        ci['title'] = 'A new headline'
+        self.refresher({'action': 'U', 'id': ci['id'], 'slug': ci['slug']})
+        self.assertEqual(self.multi_ids(), [ci['id']])
+
+        data = self.p2p.get_fancy_collection(benchmarks.COLLECTION_CODE)
+        self.assertEqual(data['items'][3]['content_item']['title'],
+                         'A new headline')
+
+        # items that aren't in our collections are ignored
+        self.refresher({'action': 'U', 'id': 1, 'slug': 'chi-elsewhere'})
+        self.assertEqual(self.multi_ids(), [ci['id']])
+
+    def test_collection_update(self):
+        layout = self.fixtures['collection_layouts'][0]
+        new_ci = self.fixtures['content_items'][28]
+        layout['items'].insert(0, {'contentitem_id': new_ci['id'],
+                                   'slug': new_ci['slug']})
+        self.refresher({'action': 'U', 'code': benchmarks.COLLECTION_CODE})
+
+        # only the new item was fetched
+        self.assertEqual(self.multi_ids(), [new_ci['id']])
+        data = self.p2p.get_fancy_collection(benchmarks.COLLECTION_CODE)
+        self.assertEqual(data['items'][0]['content_item']['slug'],
+                         new_ci['slug'])
+        self.assertEqual(self.multi_ids(), [new_ci['id']])
+
+
+
+class ListenerTestCase(unittest.TestCase):
+    """
+    Runs listeners against kombu's in-memory transport.
+    """
+    def setUp(self):
+        self.conn = Connection('memory://')
+        self.exchange = Exchange('updated_content', type='topic')
+        self.exchange(self.conn.default_channel).declare()
+        self.producer = Producer(
+            self.conn.default_channel, exchange=self.exchange)
+
+    def tearDown(self):
+        self.conn.release()
+
+    def publish(self, data, routing_key='update.content_item.chinews.1'):
+        self.producer.publish(json.dumps(data), routing_key=routing_key)
+
+    def run_listener(self, listener, until, timeout=5):
+        t = threading.Thread(
+            target=listener.run, kwargs={'safety_interval': 0.05})
+        t.daemon = True
+        t.start()
+        deadline = time.time() + timeout
+        while not until() and time.time() < deadline:
+            time.sleep(0.01)
+        listener.should_stop = True
+        t.join(timeout)
+        listener.close()
+
+
+class TestListener(ListenerTestCase):
+    def test_synchronous(self):
+        received = []
+        listener = Listener(self.conn, 'test_sync', received.append)
+        for i in range(5):
+            self.publish({'action': 'U', 'id': i, 'slug': 'chi-%d' % i})
+        self.run_listener(listener, lambda: len(received) == 5)
+        self.assertEqual([m['id'] for m in received], range(5))
+
+    def test_workers_keep_order_and_coalesce(self):
+        received = []
+        lock = threading.Lock()
+        gate = threading.Event()
+
+        def callback(message):
+            gate.wait(5)
+            with lock:
+                received.append(message)
+
+        listener = Listener(self.conn, 'test_workers', callback,
+                            prefetch_count=50, workers=4)
+        for i in range(10):
+            self.publish({'action': 'U', 'id': 1, 'slug': 'chi-hot',
+                          'n': i})
+        for i in range(10):
+            self.publish({'action': 'U', 'id': 100 + i,
+                          'slug': 'chi-%d' % i})
+
+        t = threading.Thread(target=lambda: (time.sleep(0.3), gate.set()))
+        t.start()
+        self.run_listener(
+            listener, lambda: listener.metrics.snapshot()['counters'].get(
+                'acks') and not listener.backlog() and
+            listener.metrics.snapshot()['counters'].get('received') == 20)
+        t.join()
+
+        hot = [m['n'] for m in received if m['slug'] == 'chi-hot']
+        # in order, and the pile-up was collapsed to the latest
+        self.assertEqual(hot, sorted(hot))
+        self.assertEqual(hot[-1], 9)
+        self.assertTrue(len(hot) < 10)
+        self.assertEqual(
+            len([m for m in received if m['slug'] != 'chi-hot']), 10)
+        self.assertEqual(listener.backlog(), 0)
+
+    def test_acks_follow_delivery_tags(self):
+        gates = [threading.Event(), threading.Event()]
+        started = []
+        received = []
+
+        class Message(object):
+            def __init__(self, delivery_tag):
+                self.delivery_tag = delivery_tag
+                self.acked = False
+
+            def ack(self, multiple=False):
+                self.acked = True
+
+        def callback(data):
+            started.append(data['n'])
+            gates[data['n']].wait(5)
+            received.append(data['n'])
+
+        def wait_for(until):
+            deadline = time.time() + 5
+            while not until() and time.time() < deadline:
+                time.sleep(0.01)
+
+        listener = Listener(self.conn, 'test_tags', callback, workers=1)
+        self.addCleanup(listener.close)
+        old = Message(1)
+        listener.process_task(json.dumps({'slug': 'chi-1', 'n': 0}), old)
+        wait_for(lambda: started == [0])
+        # reconnected, and the new channel's tags start over
+        listener.on_consume_ready(None, None, [])
+        new = Message(1)
+        listener.process_task(json.dumps({'slug': 'chi-2', 'n': 1}), new)
+
+        gates[0].set()
+        wait_for(lambda: received == [0])
+        time.sleep(0.05)
+        listener.ack_finished()
+        self.assertFalse(old.acked)
+        self.assertFalse(new.acked)
+
+        gates[1].set()
+        wait_for(lambda: received == [0, 1])
+        time.sleep(0.05)
+        listener.ack_finished()
+        self.assertTrue(new.acked)
+        self.assertEqual(listener.backlog(), 0)
+
+    def test_slow_callback_doesnt_hold_up_acks(self):
+        gate = threading.Event()
+        fast = []
+
+        def callback(message):
+            if message['slug'] == 'chi-slow':
+                gate.wait(5)
+            else:
+                fast.append(message)
+
+        def until():
+            # the slow one is still going
+            if len(fast) == 30:
+                gate.set()
+                return True
+
+        listener = Listener(self.conn, 'test_slow', callback,
+                            prefetch_count=5, workers=4)
+        self.publish({'action': 'U', 'id': 1, 'slug': 'chi-slow'})
+        for i in range(30):
+            self.publish({'action': 'U', 'id': 100 + i,
+                          'slug': 'chi-%d' % i})
+        self.run_listener(listener, until)
+        self.assertEqual(len(fast), 30)
+        self.assertEqual(listener.backlog(), 0)
+
+    def test_workers_need_prefetch(self):
+        listener = Listener(self.conn, 'test_prefetch', lambda m: None,
+                            workers=4)
+        self.addCleanup(listener.close)
+        self.assertEqual(listener.prefetch_count, 40)
+        self.assertRaises(ValueError, Listener, self.conn, 'test_prefetch',
+                          lambda m: None, workers=4, prefetch_count=0)
+
+
+class TestCoalescer(unittest.TestCase):
+    def test_collapse_burst(self):
+        received = []
+        c = Coalescer(received.append, window=0.1)
+        for i in range(20):
+            c({'action': 'U', 'id': 1, 'slug': 'chi-hot', 'n': i})
+        c({'action': 'D', 'id': 1, 'slug': 'chi-hot'})
+        c({'action': 'U', 'code': 'chi_collection'})
+        time.sleep(0.3)
+
+        self.assertEqual(len(received), 3)
+        self.assertEqual(received[0]['n'], 19)
+        self.assertEqual(c.suppressed, 19)
+
+        # a new window starts after the flush
+        c({'action': 'U', 'id': 1, 'slug': 'chi-hot', 'n': 20})
+        c.close()
+        self.assertEqual(received[-1]['n'], 20)
+
+    def test_bounded(self):
+        received = []
+        c = Coalescer(received.append, window=60, max_pending=5)
+        for i in range(8):
+            c({'action': 'U', 'id': i, 'slug': 'chi-%d' % i})
+        self.assertEqual([m['id'] for m in received], [0, 1, 2])
+        c.close()
+        self.assertEqual([m['id'] for m in received], range(8))
+
+
+class TestResume(ListenerTestCase):
+    def setUp(self):
+        super(TestResume, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.resume_file = os.path.join(self.tmpdir, 'resume')
+
+    def tearDown(self):
+        super(TestResume, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_durable_queues(self):
+        listener = Listener(self.conn, 'test_durable', lambda m: None,
+                            durable=True)
+        for queue in listener.queues:
+            self.assertTrue(queue.durable)
+            self.assertFalse(queue.auto_delete)
+
+    def test_queues_declared_on_reconnect(self):
+        received = []
+        listener = Listener(self.conn, 'test_redeclare', received.append)
+        channel = self.conn.default_channel
+        for queue in listener.queues:
+            channel.queue_delete(queue.name)
+
+        # what happens when kombu reconnects
+        listener.get_consumers(lambda **kwargs: None, channel)
+        self.publish({'action': 'U', 'id': 1, 'slug': 'chi-1'})
+        self.run_listener(listener, lambda: received)
+        self.assertEqual(len(received), 1)
+
+    def test_catch_up_from_last_seen(self):
+        last_seen = time.time() - 3600
+        with open(self.resume_file, 'w') as f:
+            f.write(repr(last_seen))
+
+        since = []
+        received = []
+        listener = Listener(self.conn, 'test_resume', received.append,
+                            catch_up=since.append,
+                            resume_file=self.resume_file,
+                            catch_up_margin=60)
+        self.publish({'action': 'U', 'id': 1, 'slug': 'chi-1'})
+        self.run_listener(listener, lambda: since and received)
+
+        self.assertEqual(
+            since, [datetime.utcfromtimestamp(last_seen - 60)])
+        # the newer notification was saved for next time
+        with open(self.resume_file) as f:
+            self.assertTrue(float(f.read()) > last_seen + 3000)
+
+    def test_no_catch_up_first_time(self):
+        since = []
+        listener = Listener(self.conn, 'test_first', lambda m: None,
+                            catch_up=since.append,
+                            resume_file=self.resume_file)
+        self.run_listener(
+            listener, lambda: listener.metrics.snapshot()['counters'].get(
+                'connects'))
+        self.assertEqual(since, [])
+
+    def test_search_modified_since(self):
+        items = [{'id': i, 'slug': 'chi-%d' % i} for i in range(1, 6)]
+
+        def search(method, path, body):
+            page = int(re.search(r'[?&]page=(\d+)', path).group(1))
+            return 200, {'content_items': items[(page - 1) * 2:page * 2]}
+
+        server = StubServer().start()
+        self.addCleanup(server.stop)
+        server.routes['/content_items/search.json'] = search
+        p2p = P2P(server.url, 'token')
+
+        found = list(p2p.search_modified_since(
+            datetime(2012, 6, 25), per_page=2))
+        self.assertEqual(found, items)
+        self.assertEqual(len(server.requests), 3)
+        self.assertTrue('last_modified_time_after' in server.requests[0][1])
+
+
+class TestSupervisor(ListenerTestCase):
+    def test_shards(self):
+        received = [[], []]
+        listeners = [
+            Listener(self.conn, 'test_shards', received[i].append,
+                     shard=(i, 2))
+            for i in range(2)]
+        for i in range(20):
+            self.publish({'action': 'U', 'id': i, 'slug': 'chi-%d' % i})
+        threads = []
+        for listener in listeners:
+            t = threading.Thread(
+                target=self.run_listener,
+                args=(listener, lambda: sum(map(len, received)) == 20))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        for i, messages in enumerate(received):
+            self.assertTrue(messages)
+            for m in messages:
+                self.assertEqual(
+                    shard_for(('content_item', m['slug']), 2), i)
+        self.assertEqual(
+            sorted(m['id'] for m in received[0] + received[1]), range(20))
+
+    def test_restart_and_stats(self):
+        supervisor = Supervisor('test_supervisor', lambda m: None,
+                                processes=2, amqp_url='memory://',
+                                restart_delay=0, report_every=0.05)
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+
+        def wait_for(until):
+            deadline = time.time() + 10
+            while not until() and time.time() < deadline:
+                supervisor.check()
+                time.sleep(0.05)
+
+        wait_for(lambda: supervisor.stats()['processes'] == 2)
+        self.assertEqual(supervisor.stats()['counters']['connects'], 2)
+
+        pid = supervisor.pids()[0]
+        os.kill(pid, 9)
+        wait_for(lambda: supervisor.pids()[0] != pid)
+        self.assertNotEqual(supervisor.pids()[0], pid)
+        self.assertEqual(supervisor.stats()['counters']['restarts'], 1)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=30)
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token')
+
+    def run_batch(self, command, lines, **kwargs):
+        output = StringIO()
+        errors = run_batch(self.p2p, command, lines, output, **kwargs)
+        return errors, [json.loads(l) for l in output.getvalue().splitlines()]
+
+    def test_get(self):
+        items = self.fixtures['content_items']
+        lines = [str(ci['id']) for ci in items[:26]] + \
+            [items[26]['slug'], items[27]['slug'], 'chi-missing', '']
+        errors, results = self.run_batch('get', lines)
+
+        self.assertEqual(errors, 1)
+        self.assertEqual(len(results), 29)
+        by_slug = dict((r['slug'], r) for r in results)
+        self.assertEqual(by_slug[items[0]['slug']]['content_item']['title'],
+                         items[0]['title'])
+        self.assertTrue('error' in by_slug['chi-missing'])
+        # two multi.json calls for the ids, one call per slug
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_get_bad_lines(self):
+        items = self.fixtures['content_items']
+        lines = [json.dumps({'id': str(items[0]['id'])}),
+                 json.dumps({'id': 'chi-nope'}),
+                 json.dumps({'title': 'No slug or id'}),
+                 '{"slug": "chi-broken"',
+                 str(items[1]['id'])]
+        errors, results = self.run_batch('get', lines)
+
+        self.assertEqual(errors, 3)
+        self.assertEqual(len(results), 5)
+        found = [r for r in results if 'content_item' in r]
+        self.assertEqual(sorted(r['id'] for r in found),
+                         sorted([items[0]['id'], items[1]['id']]))
+        self.assertEqual(sorted(r['error'] for r in results if 'error' in r),
+                         ['Bad JSON', 'Bad id', 'No slug or id'])
+        self.assertEqual([r['line'] for r in results if 'line' in r], [4])
+
+    def test_get_failed_chunk(self):
+        multi = self.server.routes['/content_items/multi.json']
+        calls = []
+
+        def fail_first(method, path, body):
+            calls.append(path)
+            if len(calls) == 1:
+                return 500, {'error': 'boom'}
+            return multi(method, path, body)
+
+        self.server.routes['/content_items/multi.json'] = fail_first
+        items = self.fixtures['content_items']
+        errors, results = self.run_batch(
+            'get', [str(ci['id']) for ci in items])
+
+        # the first 25 failed, the other chunk still ran
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(errors, 25)
+        self.assertEqual(len(results), 30)
+        self.assertEqual(len([r for r in results if 'content_item' in r]), 5)
+
+    def test_save_and_mv(self):
+        saved = []
+
+        def update(method, path, body):
+            saved.append((path, json.loads(body)['content_item']))
+            return 200, {}
+
+        for i in range(3):
+            self.server.routes['/content_items/chi-%d.json' % i] = update
+        lines = [json.dumps({'slug': 'chi-%d' % i, 'body': 'Hi'})
+                 for i in range(3)]
+        errors, results = self.run_batch(
+            'save', lines, defaults={'content_item_type_code': 'blurb'})
+        self.assertEqual(errors, 0)
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(saved[0][1]['content_item_type_code'], 'blurb')
+
+        errors, results = self.run_batch(
+            'mv', ['chi-0 chi-new', 'chi-1',
+                   json.dumps({'id': 1, 'new_slug': 'chi-x'})])
+        self.assertEqual(errors, 2)
+        self.assertEqual([r['error'] for r in results if r['id'] == 1],
+                         ['mv needs slug and new_slug'])
+        self.assertEqual(saved[-1], ('/content_items/chi-0.json',
+                                     {'slug': 'chi-new'}))
+
+
+class TestImportTime(unittest.TestCase):
+    # Seconds we allow for `import p2p.command`, it's about 0.06 on a
+    # laptop
+    IMPORT_TIME_BUDGET = 0.25
+    HEAVY_MODULES = ('kombu', 'clint', 'redis', 'django', 'dateutil',
+                     'iso8601', 'requests', 'sqlite3', 'multiprocessing')
+
+    def test_command_imports_fast(self):
+        script = (
+            "import json, sys, time\n"
+            "start = time.time()\n"
+            "import p2p.command\n"
+            "print json.dumps([time.time() - start, sys.modules.keys()])\n")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        times = list()
+        for i in range(3):
+            out = subprocess.check_output(
+                [sys.executable, '-c', script], cwd=root)
+            elapsed, modules = json.loads(out)
+            times.append(elapsed)
+
+        for name in self.HEAVY_MODULES:
+            self.assertFalse(name in modules, '%s was imported' % name)
+        self.assertTrue(min(times) < self.IMPORT_TIME_BUDGET,
+                        'import p2p.command took %.3fs' % min(times))
+
+
+class TestExporter(unittest.TestCase):
+    def setUp(self):
+        fixtures = benchmarks.build_fixtures(num_items=60, layout_items=40)
+        layout = dict(fixtures['collection_layouts'][0], code='chi_other')
+        layout['items'] = [dict(item, contentitem_id=ci['id'])
+                           for item, ci in zip(
+                               layout['items'],
+                               fixtures['content_items'][30:])]
+        fixtures['collection_layouts'].append(layout)
+        fixtures['collections'].append(
+            dict(fixtures['collections'][0], code='chi_other'))
+        fixtures['sections'][benchmarks.SECTION_PATH]['collections'].append(
+            'chi_other')
+
+        self.server = StubServer()
+        self.server.load_fixtures(fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines(self):
+        path = os.path.join(self.tmpdir, 'export.jsonl')
+        writer = JSONLinesWriter(path)
+        written = Exporter(self.p2p, writer, concurrency=2).export(
+            sections=[benchmarks.SECTION_PATH])
+        writer.close()
+
+        records = self.read(path)
+        self.assertEqual(written, len(records))
+        types = [r['type'] for r in records]
+        self.assertEqual(types.count('section'), 1)
+        self.assertEqual(types.count('collection_layout'), 2)
+        # items in both collections are only written once
+        ids = [r['key'] for r in records if r['type'] == 'content_item']
+        self.assertEqual(sorted(ids), range(1000000, 1000060))
+
+    def test_resume(self):
+        path = os.path.join(self.tmpdir, 'export.jsonl')
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        writer = JSONLinesWriter(path)
+        Exporter(self.p2p, writer, checkpoint=checkpoint).export(
+            collections=[benchmarks.COLLECTION_CODE])
+        writer.close()
+
+        requests_before = len(self.server.requests)
+        writer = JSONLinesWriter(path, append=True)
+        Exporter(self.p2p, writer, checkpoint=checkpoint).export(
+            collections=[benchmarks.COLLECTION_CODE, 'chi_other'])
+        writer.close()
+
+        ids = [r['key'] for r in self.read(path)
+               if r['type'] == 'content_item']
+        self.assertEqual(sorted(ids), range(1000000, 1000060))
+        # the first collection wasn't fetched again
+        paths = [p for m, p, b in self.server.requests[requests_before:]]
+        self.assertFalse([p for p in paths if benchmarks.COLLECTION_CODE in p])
+
+    def test_collections_in_parallel(self):
+        fixtures = benchmarks.build_fixtures(num_items=40, layout_items=5)
+        codes = ['chi_parallel_%d' % i for i in range(8)]
+        for i, code in enumerate(codes):
+            layout = dict(fixtures['collection_layouts'][0], code=code)
+            layout['items'] = [
+                dict(item, contentitem_id=1000000 + i * 5 + j)
+                for j, item in enumerate(layout['items'])]
+            fixtures['collection_layouts'].append(layout)
+            fixtures['collections'].append(
+                dict(fixtures['collections'][0], code=code))
+        server = StubServer(latency=0.1)
+        server.load_fixtures(fixtures)
+        server.start()
+        self.addCleanup(server.stop)
+
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        writer = JSONLinesWriter(StringIO())
+        start = time.time()
+        written = Exporter(
+            P2P(server.url, 'token'), writer, checkpoint=checkpoint,
+            concurrency=8, checkpoint_every=4).export(collections=codes)
+        # one at a time that's 24 requests, 2.4 seconds
+        self.assertTrue(time.time() - start < 1.2)
+        self.assertEqual(written, 8 * 2 + 40)
+
+        # one checkpoint line per group of collections
+        lines = self.read(checkpoint)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(sorted(lines[0]['collections'] +
+                                lines[1]['collections']), codes)
+        self.assertEqual(len(lines[0]['content_items']), 20)
+
+    def test_sqlite(self):
+        path = os.path.join(self.tmpdir, 'export.db')
+        writer = SQLiteWriter(path)
+        Exporter(self.p2p, writer).export(collections=['chi_other'])
+        writer.close()
+
+        import sqlite3
+        conn = sqlite3.connect(path)
+        rows = conn.execute(
+            "SELECT type, COUNT(*) FROM export GROUP BY type").fetchall()
+        self.assertEqual(dict(rows), {'collection': 1,
+                                      'collection_layout': 1,
+                                      'content_item': 30})
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=50)
+        for i, ci in enumerate(self.fixtures['content_items']):
+            ci['last_modified_time'] = '2012-06-25T13:%02d:00Z' % i
+
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.routes['/content_items/search.json'] = self.search
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'sync.db')
+
+    def search(self, method, path, body):
+        query = urllib.unquote(path)
+        since = re.search(
+            r'last_modified_time_after\]=([\d:TZ-]+)', query).group(1)
+        page = int(re.search(r'[?&]page=(\d+)', query).group(1))
+        per_page = int(re.search(r'per_page=(\d+)', query).group(1))
+        items = sorted((ci for ci in self.fixtures['content_items']
+                        if ci['last_modified_time'] > since),
+                       key=lambda ci: ci['last_modified_time'])
+        return 200, {'content_items':
+                     items[(page - 1) * per_page:page * per_page]}
+
+    def test_backfill_and_reconcile(self):
+        store = SQLiteStore(self.path)
+        syncer = Syncer(self.p2p, store, per_page=20, overlap=120)
+        self.assertEqual(syncer.reconcile(), 50)
+        self.assertEqual(store.count(), 50)
+        self.assertEqual(syncer.high_water_mark, datetime(2012, 6, 25, 13, 49))
+        ci = store.get_content_item(slug='chi-bench-item-3')
+        self.assertEqual(ci['id'], 1000003)
+
+        # a restart only sweeps from the high-water mark, less the overlap
+        syncer = Syncer(self.p2p, SQLiteStore(self.path), overlap=120)
+        self.assertEqual(syncer.reconcile(), 2)
+
+    def test_edit_during_backfill(self):
+        searches = []
+
+        def search(method, path, body):
+            status, data = self.search(method, path, body)
+            # as it was when it was sent
+            ret = status, json.loads(utils.to_json(data))
+            searches.append(path)
+            if len(searches) == 1:
+                # one we've just read is edited, and moves to the end
+                self.fixtures['content_items'][5]['last_modified_time'] = \
+                    '2012-06-25T14:30:00Z'
+            return ret
+
+        self.server.routes['/content_items/search.json'] = search
+        store = SQLiteStore(self.path)
+        syncer = Syncer(self.p2p, store, per_page=20)
+        syncer.backfill()
+        self.assertEqual(store.count(), 50)
+        self.assertEqual(syncer.high_water_mark,
+                         datetime(2012, 6, 25, 14, 30))
+
+    def test_notifications(self):
+        store = SQLiteStore(self.path)
+        syncer = Syncer(self.p2p, store)
+        syncer({'action': 'U', 'id': '1000001', 'slug': 'chi-bench-item-1'})
+        syncer({'action': 'U', 'slug': 'chi-bench-item-2'})
+        self.assertEqual(store.count(), 2)
+
+        syncer({'action': 'D', 'id': 1000001, 'slug': 'chi-bench-item-1'})
+        self.assertEqual(store.get_content_item(id=1000001), None)
+        self.assertEqual(store.count(), 1)
+
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=30,
+                                                  layout_items=10)
+        for i, ci in enumerate(self.fixtures['content_items']):
+            ci['last_modified_time'] = '2012-06-25T13:%02d:00Z' % i
+            ci['display_time'] = '2012-06-25T14:%02d:00Z' % (30 - i)
+            if i % 3 == 0:
+                ci['content_item_type_code'] = 'blurb'
+            if i % 2:
+                ci['content_item_state_code'] = 'working'
+
+    def fill(self, c):
+        for ci in self.fixtures['content_items']:
+            c.save_content_item(ci)
+        c.save_collection_layout(self.fixtures['collection_layouts'][0])
+
+    def check_queries(self, c):
+        ids = [ci['id'] for ci in c.query_content_items(limit=5)]
+        self.assertEqual(ids, range(1000029, 1000024, -1))
+
+        ids = [ci['id'] for ci in c.query_content_items(
+            order_by='display_time', limit=2)]
+        self.assertEqual(ids, [1000000, 1000001])
+
+        ids = [ci['id'] for ci in c.query_content_items(
+            collection=benchmarks.COLLECTION_CODE, type_code='story',
+            state_code='live')]
+        self.assertEqual(ids, [1000008, 1000004, 1000002])
+
+        ids = [ci['id'] for ci in c.query_content_items(
+            type_code='blurb', since=datetime(2012, 6, 25, 13, 20))]
+        self.assertEqual(ids, [1000027, 1000024, 1000021])
+
+    def test_dictionary_cache(self):
+        c = cache.DictionaryCache(indexes=True)
+        self.fill(c)
+        self.check_queries(c)
+
+        # saving again moves an item between indexes
+        ci = dict(self.fixtures['content_items'][29],
+                  content_item_type_code='blurb')
+        c.save_content_item(ci)
+        self.assertEqual(c.query_content_items(
+            type_code='story', limit=1)[0]['id'], 1000028)
+
+    def test_memory_cache_eviction(self):
+        c = cache.MemoryCache(max_items=100, indexes=True)
+        self.fill(c)
+        self.check_queries(c)
+
+        c.invalidate('content_items', 1000029)
+        self.assertEqual(c.index.query(since=datetime(2012, 6, 25, 13, 28)),
+                         [1000028])
+
+    def test_redis_cache(self):
+        try:
+            c = cache.RedisCache(prefix='p2ptestindex', indexes=True)
+            c.r.ping()
+        except Exception:
+            return  # no redis here
+        self.addCleanup(lambda: [c.r.delete(k) for k in
+                                 c.r.keys('p2ptestindex_*')])
+        self.fill(c)
+        self.check_queries(c)
+
+    def test_without_indexes(self):
+        self.assertRaises(NotImplementedError,
+                          cache.MemoryCache().query_content_items)
+
+
+class TestRequestScope(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=60)
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token')
+        self.ids = [ci['id'] for ci in self.fixtures['content_items']]
+
+    def test_memoized(self):
+        with self.p2p.request_scope():
+            layout = self.p2p.get_fancy_collection(benchmarks.COLLECTION_CODE)
+            slug = layout['items'][0]['slug']
+            ci = self.p2p.get_content_item(slug)
+            self.assertTrue(ci is layout['items'][0]['content_item'])
+            # only the new ids are fetched
+            items = self.p2p.get_multi_content_items(self.ids[20:30])
+            self.assertEqual(len(items), 10)
+        # layout, one multi for the collection, one for the five new ids
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.p2p.get_content_item(slug)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_deferred_batch(self):
+        with self.p2p.request_scope() as scope:
+            deferred = [scope.load(id) for id in self.ids[:10] + self.ids[:5]]
+            missing = scope.load(42)
+            self.assertEqual(self.server.requests, [])
+
+            self.assertEqual(deferred[3].get()['id'], self.ids[3])
+            self.assertEqual(missing.get(), None)
+            self.assertEqual([d.get()['id'] for d in deferred],
+                             self.ids[:10] + self.ids[:5])
+            self.assertEqual(len(self.server.requests), 1)
+
+            # nested scopes share
+            with self.p2p.request_scope() as inner:
+                self.assertTrue(inner is scope)
+                self.p2p.get_multi_content_items(self.ids[:10])
+            self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.p2p.current_scope(), None)
+
+
+class TestQueryString(unittest.TestCase):
+    def test_encoding(self):
+        from utils import dict_to_qs
+        self.assertEqual(dict_to_qs({'include': ['web_url']}),
+                         'include[]=web_url')
+        self.assertEqual(
+            dict_to_qs({'q': 'this & that = 100%', 'page': 2,
+                        'title': u'caf\xe9'}),
+            'page=2&q=this%20%26%20that%20%3D%20100%25&title=caf%C3%A9')
+        self.assertEqual(
+            dict_to_qs({'conditions': {'state': ['live', 'working'],
+                                       'path': '/news/local'},
+                        'order': 'last_modified_time'}),
+            'conditions[path]=/news/local&conditions[state][]=live&'
+            'conditions[state][]=working&order=last_modified_time')
+        self.assertRaises(TypeError, dict_to_qs, {'q': None})
+        self.assertRaises(TypeError, dict_to_qs, {'q': {'a': [None]}})
+        # what would be taken for structure is encoded
+        self.assertEqual(dict_to_qs({'a&b': 'c=d', 'e': ['[f]']}),
+                         'a%26b=c%3Dd&e[]=%5Bf%5D')
+        self.assertEqual(dict_to_qs({'a': {'b': [1, 'x y']}}),
+                         'a[b][]=1&a[b][]=x%20y')
+        self.assertEqual(dict_to_qs({'a': '\x01', 'b': '\x00'}),
+                         'a=%01&b=%00')
+        self.assertEqual(dict_to_qs({'a': 'caf\xc3\xa9', 'b': u'caf\xe9'}),
+                         'a=caf%C3%A9&b=caf%C3%A9')
+
+    def test_frozen(self):
+        from utils import dict_to_qs, FrozenQuery
+        query = {'include': ['web_url'], 'conditions': {'a': 'b c'}}
+        frozen = FrozenQuery(query)
+        self.assertEqual(dict_to_qs(frozen), dict_to_qs(query))
+        self.assertEqual(frozen, {'include': ('web_url',),
+                                  'conditions': {'a': 'b c'}})
+        self.assertRaises(TypeError, frozen.__setitem__, 'page', 1)
+        self.assertRaises(TypeError, frozen.update, {'page': 1})
+
+        copy = frozen.copy()
+        copy['include'].append('related_items')
+        self.assertEqual(frozen.qs, dict_to_qs(query))
+
+        # the default query can still be extended, or changed in place
+        p2p = P2P('http://localhost', 'token')
+        query = deepcopy(p2p.default_content_item_query)
+        query['include'].append('related_items')
+        self.assertEqual(p2p._default_query().qs, 'include[]=web_url')
+        p2p.default_content_item_query['include'].append('related_items')
+        self.assertEqual(p2p._default_query().qs,
+                         'include[]=web_url&include[]=related_items')
+        p2p.default_content_item_query = {'include': ['web_url']}
+        self.assertEqual(p2p._default_query().qs, 'include[]=web_url')
+
+    def test_same_string_different_query(self):
+        from utils import dict_to_qs
+        self.assertEqual(dict_to_qs({'a': 'b', 'c': 'd'}), 'a=b&c=d')
+        self.assertEqual(dict_to_qs({'a': 'b&c=d'}), 'a=b%26c%3Dd')
+        self.assertEqual(dict_to_qs({'a': ['b]=c']}), 'a[]=b%5D%3Dc')
+        self.assertEqual(dict_to_qs({'a': {'b': 'c'}}), 'a[b]=c')
+        self.assertEqual(dict_to_qs({'a[b]': 'c'}), 'a%5Bb%5D=c')
+
+
+class TestThumbs(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=30)
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token',
+                       cache=cache.DictionaryCache(),
+                       image_services_url=self.server.url)
+        self.slugs = [ci['slug'] for ci in self.fixtures['content_items']]
+        # every other item has a thumbnail
+        for slug in self.slugs[::2]:
+            self.server.routes['/photos/turbine/%s.json' % slug] = (
+                200, {'slug': slug, 'size': [120, 80]})
+
+    def thumb_requests(self):
+        return [r for r in self.server.requests if '/photos/' in r[1]]
+
+    def test_cache_without_thumbs(self):
+        class ContentItemCache(cache.BaseCache):
+            def get_content_item(self, slug=None, id=None, query=None):
+                return None
+
+            def save_content_item(self, content_item, query=None):
+                pass
+
+        p2p = P2P(self.server.url, 'token', cache=ContentItemCache(),
+                  image_services_url=self.server.url)
+        self.assertEqual(p2p.get_thumb_for_slug(self.slugs[0])['slug'],
+                         self.slugs[0])
+
+    def test_cached(self):
+        self.assertEqual(self.p2p.get_thumb_for_slug(self.slugs[0])['slug'],
+                         self.slugs[0])
+        self.assertEqual(self.p2p.get_thumb_for_slug(self.slugs[1]), None)
+        # hits and misses are both cached
+        self.p2p.get_thumb_for_slug(self.slugs[0])
+        self.assertEqual(self.p2p.get_thumb_for_slug(self.slugs[1]), None)
+        self.assertEqual(len(self.thumb_requests()), 2)
+
+        self.p2p.get_thumb_for_slug(self.slugs[1], force_update=True)
+        self.assertEqual(len(self.thumb_requests()), 3)
+
+    def test_bulk(self):
+        self.p2p.get_thumb_for_slug(self.slugs[0])
+        thumbs = self.p2p.get_thumbs_for_slugs(self.slugs + self.slugs[:5])
+        self.assertEqual(sorted(thumbs.keys()), sorted(self.slugs))
+        for i, slug in enumerate(self.slugs):
+            if i % 2:
+                self.assertEqual(thumbs[slug], None)
+            else:
+                self.assertEqual(thumbs[slug]['slug'], slug)
+        # each slug fetched once
+        self.assertEqual(len(self.thumb_requests()), len(self.slugs))
+
+    def test_errors_not_cached(self):
+        self.p2p.retry_policy = RetryPolicy(max_retries=0)
+        self.server.inject(503)
+        self.assertEqual(self.p2p.get_thumb_for_slug(self.slugs[0]), None)
+        self.assertEqual(self.p2p.get_thumb_for_slug(self.slugs[0])['slug'],
+                         self.slugs[0])
+        self.assertEqual(self.p2p.metrics.counters['thumbs.errors'], 1)
+
+    def test_rate_limited(self):
+        self.p2p.rate_limiter = RateLimiter(
+            buckets={'image_services': TokenBucket(rate=20, burst=1)})
+        start = time.time()
+        thumbs = self.p2p.get_thumbs_for_slugs(self.slugs[:10])
+        self.assertTrue(time.time() - start >= 0.4)
+        self.assertEqual(thumbs[self.slugs[0]]['slug'], self.slugs[0])
+        self.assertEqual(
+            self.p2p.metrics.timings['ratelimit_wait.image_services']['count'],
+            10)
+        self.assertEqual(
+            self.p2p.metrics.counters['requests.image_services'], 10)
+
+    def test_backends(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'cache.db')
+        for c in (cache.MemoryCache(), cache.DiskCache(path),
+                  cache.TieredCache(cache.MemoryCache())):
+            c.save_thumb('a', {'slug': 'a'}, 60)
+            c.save_thumb('b', False, 60)
+            c.save_thumb('c', {'slug': 'c'}, -1)
+            self.assertEqual(c.get_thumb('a'), {'slug': 'a'})
+            self.assertEqual(c.get_thumb('b'), False)
+            self.assertEqual(c.get_thumb('c'), None)
+            self.assertEqual(c.get_thumb('d'), None)
+
+    def test_fancy_collection(self):
+        layout = self.p2p.get_fancy_collection(
+            benchmarks.COLLECTION_CODE, with_thumbs=True)
+        for item in layout['items']:
+            slug = item['content_item']['slug']
+            if self.slugs.index(slug) % 2:
+                self.assertEqual(item['thumb'], None)
+            else:
+                self.assertEqual(item['thumb']['slug'], slug)
+
+
+class TestAuth(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(latency=0.05)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.addCleanup(auth.auth_cache.clear)
+        self.auth_url = self.server.url + '/auth'
+
+        def login(method, path, body):
+            if 'password=secret' in path:
+                return 200, {'p2p_user': {'username': 'jdoe'}}
+            return 403, {'error': 'nope'}
+        self.server.routes['/auth'] = login
+
+    def login(self, password='secret'):
+        return authenticate(username='jdoe', password=password,
+                            auth_url=self.auth_url)
+
+    def test_cached(self):
+        self.assertEqual(self.login()['username'], 'jdoe')
+        self.login()['username'] = 'changed'
+        self.assertEqual(self.login()['username'], 'jdoe')
+        self.assertEqual(len(self.server.requests), 1)
+
+        # failures aren't cached
+        for i in range(2):
+            with self.assertRaises(P2PAuthError):
+                self.login('wrong')
+        self.assertEqual(len(self.server.requests), 3)
+
+        authenticate(username='jdoe', password='secret',
+                     auth_url=self.auth_url, use_cache=False)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_concurrent_logins_coalesced(self):
+        results = list()
+        threads = [threading.Thread(
+            target=lambda: results.append(self.login()))
+            for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_ttl_cache(self):
+        c = TTLCache(ttl=-1)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), None)
+        self.assertNotEqual(c.hash_key('jdoe', u'p\xe4ss'),
+                            TTLCache().hash_key('jdoe', u'p\xe4ss'))
+        self.assertTrue('pass' not in c.hash_key('jdoe', 'pass'))
+
+
+class TestThreadSafety(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=60)
+        self.server = StubServer()
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.slugs = [ci['slug'] for ci in self.fixtures['content_items']]
+        self.ids = [ci['id'] for ci in self.fixtures['content_items']]
+
+    def hammer(self, p2p, num_threads=16, rounds=5):
+        errors = list()
+        cache_events = list()
+
+        def hook(info):
+            cache_events.append(info)
+
+        def work(n):
+            try:
+                for i in range(rounds):
+                    layout = p2p.get_fancy_collection(
+                        benchmarks.COLLECTION_CODE, with_collection=True)
+                    self.assertEqual(len(layout['items']), 25)
+                    # changing what we got doesn't change the cache
+                    layout['items'][0]['content_item']['title'] = 'changed'
+                    del layout['items'][1:]
+                    slug = self.slugs[(n + i) % len(self.slugs)]
+                    self.assertEqual(p2p.get_content_item(slug)['slug'], slug)
+                    items = p2p.get_multi_content_items(self.ids[n:n + 30])
+                    self.assertEqual(len(items), 30)
+                    p2p.add_hook('cache', hook)
+                    p2p.remove_hook('cache', hook)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+        layout = p2p.get_fancy_collection(benchmarks.COLLECTION_CODE)
+        self.assertEqual(len(layout['items']), 25)
+        self.assertEqual(layout['items'][0]['content_item']['title'],
+                         'Benchmark item number 0')
+        return p2p.cache.stats.snapshot()
+
+    def test_shared_client(self):
+        for c in (cache.DictionaryCache(indexes=True),
+                  cache.MemoryCache(max_items=50),
+                  cache.TieredCache(cache.DictionaryCache())):
+            p2p = P2P(self.server.url, 'token', cache=c)
+            stats = self.hammer(p2p)
+            for kind in stats.values():
+                self.assertEqual(kind['gets'], kind['hits'] + kind['misses'])
+            # 16 threads * 5 rounds, plus the check at the end
+            self.assertEqual(stats['collection_layouts']['gets'], 81)
+
+    def test_dictionary_caches_separate(self):
+        a = cache.DictionaryCache()
+        a.save_section({'collections': []}, path='/news')
+        self.assertEqual(cache.DictionaryCache().get_section('/news'), None)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = benchmarks.build_fixtures(num_items=30)
+        self.server = StubServer(compress=True)
+        self.server.load_fixtures(self.fixtures)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.p2p = P2P(self.server.url, 'token',
+                       cache=cache.MemoryCache())
+        self.ids = [ci['id'] for ci in self.fixtures['content_items']]
+
+    def test_iter_json_array(self):
+        doc = json.dumps({
+            'total': 3,
+            'content_items': [{'id': i, 'title': u'Caf\xe9 %d' % i,
+                               'score': 1234.5} for i in range(20)] + [7],
+            'more': [1, 2]})
+        arr = json.dumps([1, 234, {'a': [1, 2]}, [], None])
+        for size in (1, 3, 64, len(doc)):
+            chunks = [doc[i:i + size] for i in range(0, len(doc), size)]
+            self.assertEqual(
+                list(utils.iter_json_array(chunks, key='content_items')),
+                json.loads(doc)['content_items'])
+            self.assertEqual(
+                list(utils.iter_json_array(chunks, key='missing')), [])
+            chunks = [arr[i:i + size] for i in range(0, len(arr), size)]
+            self.assertEqual(list(utils.iter_json_array(chunks)),
+                             json.loads(arr))
+            self.assertEqual(
+                list(utils.iter_json_array(chunks, key='content_items')),
+                json.loads(arr))
+        with self.assertRaises(ValueError):
+            list(utils.iter_json_array(['[1, 2']))
+
+    def test_multi_streamed_and_compressed(self):
+        infos = list()
+        self.p2p.add_hook('after_request', infos.append)
+        self.p2p.stream_chunk_size = 1024
+        items = self.p2p.get_multi_content_items(self.ids[:25])
+        self.assertEqual([ci['id'] for ci in items], self.ids[:25])
+        self.assertTrue(isinstance(items[0]['last_modified_time'], datetime))
+        self.assertEqual(infos[0]['bytes'], None)
+        # every entry was cached as it came in
+        self.assertEqual(self.p2p.cache.get_content_item(
+            id=self.ids[24], query=self.p2p.default_content_item_query)['id'],
+            self.ids[24])
+
+        counters = self.p2p.metrics.counters
+        self.assertEqual(counters['stream_items.content_items'], 25)
+        body = json.dumps([{'id': ci['id'], 'status': 200,
+                            'body': {'content_item': ci}}
+                           for ci in self.fixtures['content_items'][:25]])
+        self.assertTrue(counters['wire_bytes.content_items'] < len(body) / 4)
+
+        layout = self.p2p.get_collection_layout(benchmarks.COLLECTION_CODE)
+        self.assertEqual(len(layout['items']), 25)
+        self.assertTrue(infos[-1]['wire_bytes'] < infos[-1]['bytes'])
+
+    def test_stream_errors(self):
+        self.server.inject(404)
+        with self.assertRaises(P2PNotFound):
+            self.p2p.get('/content_items/search.json', stream=True,
+                         key='content_items')
+
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig()
@@ -1,8 +1,8 @@
-import iso8601
+import json
+import random
 import re
-from iso8601.iso8601 import ISO8601_REGEX
+import urllib
 from datetime import datetime
-from dateutil.parser import parse
 
 _slugify_strip_re = re.compile(r'[^\w\s./-]')
 _slugify_hyphenate_re = re.compile(r'[-./\s]+')
@@ -25,34 +25,177 @@ def slugify(value):
     return _slugify_hyphenate_re.sub('-', value)
 
 
+_SCALARS = (str, unicode, int, long, float, bool)
+_SCALAR_TYPES = frozenset(_SCALARS)
+
+# Characters that go in a query string as they are. The rest, and any
+# & = [ ] in keys and values, are percent-encoded.
+_QS_SAFE = '/:@'
+_QS_PLAIN = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+             '0123456789_.-' + _QS_SAFE)
+
+# Query strings `dict_to_qs` found need no encoding, with how many
+# separators they have. Emptied when it gets big.
+_plain_qs = dict()
+_PLAIN_QS_MAX = 1000
+
+
 def dict_to_qs(dictionary):
     """
     Takes a dictionary of query parameters and returns a query string
-    that the p2p API will handle.
+    that the p2p API will handle. Nested dictionaries and lists become
+    `key[key2][]=value`, and keys and values are URL encoded. Keys are
+    sorted, so equal dictionaries give the same string, which makes it
+    safe to use in cache keys.
+
+    A `FrozenQuery` remembers its query string, use one for queries you
+    make over and over.
     """
-    qs = list()
+    if type(dictionary) is FrozenQuery:
+        return dictionary.qs
+
+    # Most queries have nothing to encode, so build the string as it is
+    # and only encode piece by piece if it turns out something needs it.
+    # `separators` counts the & = [ ] we put in.
+    parts = list()
+    append = parts.append
+    separators = -1
+    try:
+        keys = dictionary.keys()
+        if len(keys) > 1:
+            keys.sort()
+        for k in keys:
+            v = dictionary[k]
+            t = type(v)
+            if t in _SCALAR_TYPES:
+                append('%s=%s' % (k, v))
+                separators += 2
+            elif t is list or t is tuple:
+                for v2 in v:
+                    if type(v2) not in _SCALAR_TYPES:
+                        return _encoded_qs(dictionary)
+                    append('%s[]=%s' % (k, v2))
+                separators += 4 * len(v)
+            elif isinstance(v, dict):
+                keys2 = v.keys()
+                if len(keys2) > 1:
+                    keys2.sort()
+                for k2 in keys2:
+                    v2 = v[k2]
+                    t = type(v2)
+                    if t in _SCALAR_TYPES:
+                        append('%s[%s]=%s' % (k, k2, v2))
+                        separators += 4
+                    elif t is list or t is tuple:
+                        for v3 in v2:
+                            if type(v3) not in _SCALAR_TYPES:
+                                return _encoded_qs(dictionary)
+                            append('%s[%s][]=%s' % (k, k2, v3))
+                        separators += 6 * len(v2)
+                    else:
+                        return _encoded_qs(dictionary)
+            else:
+                return _encoded_qs(dictionary)
+        qs = '&'.join(parts)
+    except UnicodeDecodeError:
+        # non-ASCII str mixed with unicode, which needs encoding anyway
+        return _encoded_qs(dictionary)
+
+    # If the separators are all there is besides plain characters,
+    # nothing needs encoding. That only depends on the string and the
+    # number of separators, so strings we've seen are only looked up.
+    if type(qs) is str:
+        if _plain_qs.get(qs) == separators:
+            return qs
+        if len(qs.translate(None, _QS_PLAIN)) == separators:
+            if len(_plain_qs) >= _PLAIN_QS_MAX:
+                _plain_qs.clear()
+            _plain_qs[qs] = separators
+            return qs
+    return _encoded_qs(dictionary)
 
-    for k, v in dictionary.items():
-        if isinstance(v, dict):
-            for k2, v2 in v.items():
-                if type(v2) in (str, unicode, int, float, bool):
-                    qs.append("%s[%s]=%s" % (k, k2, v2))
-                elif type(v2) in (list, tuple):
-                    for v3 in v2:
-                        qs.append("%s[%s][]=%s" % (k, k2, v3))
-                else:
-                    raise TypeError
-        elif type(v) in (str, unicode, int, float, bool):
-            qs.append("%s=%s" % (k, v))
-        elif type(v) in (list, tuple):
-            for v2 in v:
-                qs.append("%s[]=%s" % (k, v2))
-        else:
-            raise TypeError
 
+def _quote(value):
+    if isinstance(value, unicode):
+        return urllib.quote(value.encode('utf-8'), safe=_QS_SAFE)
+    elif isinstance(value, str):
+        return urllib.quote(value, safe=_QS_SAFE)
+    # numbers and bools have nothing to encode
+    return str(value)
+
+
+def _encoded_qs(dictionary):
+    qs = list()
+    for k in sorted(dictionary):
+        _encode(qs, _quote(k), dictionary[k])
     return "&".join(qs)
 
 
+def _encode(qs, prefix, value):
+    if isinstance(value, _SCALARS):
+        qs.append(prefix + '=' + _quote(value))
+    elif isinstance(value, dict):
+        for k in sorted(value):
+            _encode(qs, prefix + '[' + _quote(k) + ']', value[k])
+    elif isinstance(value, (list, tuple)):
+        prefix += '[]'
+        for v in value:
+            _encode(qs, prefix, v)
+    else:
+        raise TypeError("Can't put %r in a query string" % (value,))
+
+
+class FrozenQuery(dict):
+    """
+    A query that can't be changed, so its query string is worked out
+    once::
+
+        query = FrozenQuery({'include': ['web_url']})
+        utils.dict_to_qs(query)  # no work
+
+    Lists become tuples. Copies are ordinary, changeable dictionaries.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FrozenQuery, self).__init__(*args, **kwargs)
+        for k, v in self.items():
+            dict.__setitem__(self, k, _freeze(v))
+        self.qs = dict_to_qs(dict(self))
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenQuery can't be changed, copy it first")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return _thaw(self)
+
+    def __copy__(self):
+        return _thaw(self)
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+    def __reduce__(self):
+        return (FrozenQuery, (_thaw(self),))
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenQuery(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, dict):
+        return dict((k, _thaw(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_thaw(v) for v in value]
+    return value
+
+
 def parse_response(resp):
     """
     Recurse through a dictionary from an API call, and fix weird values,
@@ -82,8 +225,172 @@ def formatdate(d=datetime.utcnow()):
     return d.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
+def to_json(obj):
+    """
+    Serialize API data, which has had its dates parsed, back to JSON.
+    """
+    return json.dumps(obj, default=_json_default)
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
 def parsedate(d):
     if _iso8601_full_date.match(d) is not None:
+        import iso8601
         return iso8601.parse_date(d)
     else:
+        from dateutil.parser import parse
         return parse(d)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """
+    Exponential backoff with full jitter. Returns how many seconds to wait
+    before retry number `attempt` (starting at 0).
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header into seconds. Returns None if the header
+    is missing or we can't make sense of it.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from dateutil.parser import parse
+    try:
+        when = parse(value)
+    except (ValueError, OverflowError):
+        return None
+    if when.tzinfo is not None:
+        when = when.replace(tzinfo=None) - when.utcoffset()
+    return max(0.0, (when - datetime.utcnow()).total_seconds())
+
+
+def endpoint_family(url):
+    """
+    Figure out which group of API endpoints a url belongs to:
+    content_items, collections, sections, search, image_services or other.
+    """
+    path = url.split('?', 1)[0]
+    if '/photos/' in path:
+        return 'image_services'
+    elif path.startswith('/content_items/search'):
+        return 'search'
+    elif path.startswith('/content_items'):
+        return 'content_items'
+    elif path.startswith(('/collections', '/current_collections')):
+        return 'collections'
+    elif path.startswith('/sections'):
+        return 'sections'
+    return 'other'
+
+
+def iter_json_array(chunks, key=None):
+    """
+    Decode a JSON array from an iterable of strings, like
+    `resp.iter_content()`, yielding each element as soon as it's
+    complete, so the whole document never has to be in memory. With
+    `key`, the document is an object and we go through the array under
+    `key`, skipping everything else (a bare array is fine too).
+    """
+    reader = _JSONReader(chunks)
+    if key is None or reader.peek() == '[':
+        for item in reader.array():
+            yield item
+        return
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            for item in reader.array():
+                yield item
+        else:
+            reader.value()
+        if reader.next_char() == '}':
+            return
+
+
+class _JSONReader(object):
+    """
+    Reads JSON values one at a time from a stream of strings, keeping
+    only what hasn't been read yet.
+    """
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _more(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of JSON")
+
+    def next_char(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, c):
+        got = self.next_char()
+        if got != c:
+            raise ValueError("Expected %r in JSON, got %r" % (c, got))
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                end = None
+            # a number at the very end of what we have might go on
+            if end is not None and end < len(self.buf):
+                self.pos = end
+                return value
+            if not self._more():
+                if end is None:
+                    raise ValueError("Invalid JSON")
+                self.pos = end
+                return value
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            c = self.next_char()
+            if c == ']':
+                return
+            elif c != ',':
+                raise ValueError("Expected ',' or ']' in JSON, got %r" % c)
@@ -0,0 +1,143 @@
+"""
+Cache Warmer
+------------
+Keep hot collections and sections in the cache, so visitors never pay
+for a cold `get_fancy_collection`::
+
+    warmer = CacheWarmer(get_connection(),
+                         collections=['chi_homepage_top'],
+                         sections=['/news/local/breaking'],
+                         interval=300)
+    warmer.run_forever()
+
+Every collection is refreshed `interval` seconds apart. Set `interval` to
+the TTL of your cache, and `refresh_ahead` to the fraction of it that we
+refresh early, so entries are replaced before they expire. Collections
+listed in the sections are discovered on every pass.
+
+Or from the command line, use `p2pwarmer`.
+"""
+from multiprocessing.pool import ThreadPool
+import logging
+import time
+
+log = logging.getLogger('p2p')
+
+
+class CacheWarmer(object):
+    def __init__(self, p2p, collections=(), sections=(), interval=300,
+                 refresh_ahead=0.2, concurrency=4, limit_items=25,
+                 with_collection=False, content_item_query=None):
+        self.p2p = p2p
+        self.collections = list(collections)
+        self.sections = list(sections)
+        self.interval = interval
+        self.refresh_ahead = refresh_ahead
+        self.concurrency = concurrency
+        self.limit_items = limit_items
+        self.with_collection = with_collection
+        self.content_item_query = content_item_query
+
+        # collection code -> when it's next due for a refresh
+        self.due = dict()
+        self._stopped = False
+
+    @property
+    def refresh_every(self):
+        return self.interval * (1 - self.refresh_ahead)
+
+    def discover(self):
+        """
+        Refresh the sections and return the codes of every collection we
+        should keep warm.
+        """
+        codes = list(self.collections)
+        for path in self.sections:
+            try:
+                section = self.p2p.get_section(path, force_update=True)
+            except Exception:
+                log.exception("Couldn't warm section %s" % path)
+                self.p2p.metrics.incr('warmer.errors')
+                continue
+            for code in section_collection_codes(section):
+                if code not in codes:
+                    codes.append(code)
+        return codes
+
+    def warm_collection(self, code):
+        """
+        Refetch a collection layout and its content items. The items
+        are fetched in batches of 25 by `get_multi_content_items`.
+        """
+        start = time.time()
+        try:
+            self.p2p.get_fancy_collection(
+                code, with_collection=self.with_collection,
+                limit_items=self.limit_items,
+                content_item_query=self.content_item_query,
+                force_update=True)
+        except Exception:
+            log.exception("Couldn't warm collection %s" % code)
+            self.p2p.metrics.incr('warmer.errors')
+            return False
+        self.p2p.metrics.incr('warmer.collections')
+        self.p2p.metrics.timing('warmer.collection', time.time() - start)
+        return True
+
+    def run_once(self, force=False):
+        """
+        Refresh every collection that's due, `concurrency` at a time.
+        Returns the codes of the collections we refreshed.
+        """
+        now = time.time()
+        codes = [code for code in self.discover()
+                 if force or self.due.get(code, 0) <= now]
+        if not codes:
+            return []
+
+        pool = ThreadPool(min(self.concurrency, len(codes)))
+        try:
+            results = pool.map(self.warm_collection, codes)
+        finally:
+            pool.close()
+            pool.join()
+
+        for code, ok in zip(codes, results):
+            if ok:
+                self.due[code] = time.time() + self.refresh_every
+            else:
+                # try again on the next pass
+                self.due.pop(code, None)
+        return codes
+
+    def run_forever(self, poll=1.0):
+        """
+        Keep refreshing until `stop` is called.
+        """
+        self._stopped = False
+        while not self._stopped:
+            self.run_once()
+            if self.due:
+                wait = min(self.due.values()) - time.time()
+            else:
+                wait = self.refresh_every
+            time.sleep(max(poll, min(wait, self.refresh_every)))
+
+    def stop(self):
+        self._stopped = True
+
+
+def section_collection_codes(section):
+    """
+    Pull the collection codes out of a `get_section` response.
+    """
+    if not section:
+        return []
+    collections = section.get('collections', section.get('items', []))
+    codes = list()
+    for c in collections:
+        if isinstance(c, dict):
+            c = c.get('code')
+        if c:
+            codes.append(c)
+    return codes
@@ -17,6 +17,9 @@ setup(
         'console_scripts': [
             'p2pci = p2p.command:content_item_cli',
             'p2pwatcher = p2p.command:runwatcher',
+            'p2pwarmer = p2p.command:runwarmer',
+            'p2pbench = p2p.benchmarks:main',
+            'p2pexport = p2p.exporter:main',
         ],
     },
     test_suite='p2p.tests',